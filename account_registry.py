@@ -0,0 +1,129 @@
+"""
+Shared in-memory registry of PikPak accounts (both servers).
+Loaded once from Supabase, refreshed on a timer and patched locally on
+writes, so routes and the smart cache hit path resolve accounts without
+a DB round trip.
+"""
+
+import os
+import time
+import threading
+from typing import Optional, Dict, List, Iterable
+from supabase_client import db, is_db_error
+
+# ============================================
+# CONFIGURATION
+# ============================================
+
+REGISTRY_SERVER_IDS = (1, 2)
+REGISTRY_REFRESH_INTERVAL = int(os.environ.get("ACCOUNT_REGISTRY_REFRESH", 60))  # seconds
+
+
+# ============================================
+# ACCOUNT REGISTRY
+# ============================================
+
+class AccountRegistry:
+    """
+    Holds every account row keyed by id. All getters return copies, so
+    callers can map device_id etc. without touching the shared state.
+    """
+
+    def __init__(self, server_ids: Iterable[int] = REGISTRY_SERVER_IDS):
+        self.server_ids = tuple(server_ids)
+        self._accounts: Dict[int, Dict] = {}
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def refresh(self) -> bool:
+        """Reload all accounts from the DB; keeps the old snapshot on failure"""
+        rows = []
+        for server_id in self.server_ids:
+            server_rows = db.get_all_server_accounts(server_id)
+            if is_db_error(server_rows):
+                self.refresh_failures += 1
+                return False
+            rows.extend(server_rows)
+
+        # An empty result right after a successful load is more likely a DB hiccup
+        if not rows and self._accounts:
+            self.refresh_failures += 1
+            print("⚠️ Account Registry: Refresh returned no accounts, keeping previous snapshot")
+            return False
+
+        with self._lock:
+            self._accounts = {row['id']: row for row in rows}
+            self._loaded_at = time.time()
+            self.refreshes += 1
+        return True
+
+    def ensure_loaded(self):
+        if self._loaded_at is None:
+            self.refresh()
+
+    def get(self, account_id: int) -> Optional[Dict]:
+        self.ensure_loaded()
+        with self._lock:
+            row = self._accounts.get(account_id)
+            return dict(row) if row else None
+
+    def get_many(self, account_ids: Iterable[int]) -> List[Dict]:
+        self.ensure_loaded()
+        with self._lock:
+            return [dict(self._accounts[i]) for i in account_ids if i in self._accounts]
+
+    def get_server_accounts(self, server_id: int) -> List[Dict]:
+        """Same shape and order as db.get_all_server_accounts(server_id)"""
+        self.ensure_loaded()
+        with self._lock:
+            rows = [dict(row) for row in self._accounts.values() if row.get('server_id') == server_id]
+        return sorted(rows, key=lambda row: row['id'])
+
+    def all_accounts(self) -> List[Dict]:
+        self.ensure_loaded()
+        with self._lock:
+            rows = [dict(row) for row in self._accounts.values()]
+        return sorted(rows, key=lambda row: row['id'])
+
+    def update(self, account_id: int, **fields):
+        """Patch a cached row after we changed it in the DB (device rotation, status, quota...)"""
+        with self._lock:
+            row = self._accounts.get(account_id)
+            if row is not None:
+                row.update(fields)
+
+    def increment(self, account_id: int, field: str, by: int = 1):
+        with self._lock:
+            row = self._accounts.get(account_id)
+            if row is not None:
+                row[field] = (row.get(field) or 0) + by
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'accounts': len(self._accounts),
+                'loaded_at': self._loaded_at,
+                'age_seconds': round(time.time() - self._loaded_at, 1) if self._loaded_at else None,
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures
+            }
+
+    def _refresh_loop(self, interval: int):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"❌ Account Registry: Refresh error: {e}")
+            time.sleep(interval)
+
+    def start_refresher(self, interval: int = REGISTRY_REFRESH_INTERVAL) -> threading.Thread:
+        """Load now and keep refreshing every `interval` seconds in the background"""
+        thread = threading.Thread(target=self._refresh_loop, args=(interval,), daemon=True)
+        thread.start()
+        return thread
+
+
+# Singleton instance
+registry = AccountRegistry()
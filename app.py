@@ -18,10 +18,25 @@ from pyrogram import Client, enums
 from pyrogram.errors import FloodWait, ChannelPrivate, ChatAdminRequired
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import gofile_client
+from telegram_client import SharedTelegramClient, is_telegram_error
+from upload_pool import UploadPool, BandwidthLimiter, run_blocking
+from ranged_prefetch import RangedPrefetcher, STREAM_CONNECTIONS, STREAM_MAX_CONNECTIONS
+from telegram_upload import ResumableUpload
 from smart_cache import (
-    check_smart_cache,
+    get_cache_replicas,
+    get_cache_replicas_by_hash,
+    get_popular_magnet_hashes,
     save_to_smart_cache,
-    sync_all_accounts_to_cache,
+    mark_files_as_trash,
+    record_cache_hit,
+    record_cache_lookup,
+    plan_cache_eviction,
+    start_bloom_refresher,
+    start_cache_mirror,
+    start_sync_job,
+    cancel_sync_job,
+    get_sync_progress,
+    resume_interrupted_sync,
     get_cache_stats
 )
 
@@ -49,6 +64,15 @@ if API_ID:
     except:
         pass
 
+# One started client for every upload and notification (see telegram_client.py)
+tg_client = SharedTelegramClient(lambda: Client(
+    SESSION_NAME,
+    api_id=API_ID,
+    api_hash=API_HASH,
+    bot_token=BOT_TOKEN,
+    workdir="/tmp"
+))
+
 HEADERS_STREAM = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
     "Content-Type": "application/x-www-form-urlencoded"
@@ -58,6 +82,10 @@ class EmergencyStopError(Exception):
     """Custom exception for emergency stop."""
     pass
 
+class StreamResumeError(IOError):
+    """Source can't be reopened mid-file (Range ignored or size unknown)."""
+    pass
+
 EMERGENCY_STOP = False
 
 # Message collection storage
@@ -112,7 +140,9 @@ def update_daily_stats(stat_type, value=1):
     if stat_type in DAILY_STATS:
         DAILY_STATS[stat_type] += value
 
-from supabase_client import db
+from supabase_client import db, db_metrics, is_db_error
+from account_registry import registry
+from magnet_parser import parse_magnet, extract_hash, normalize_hash, magnet_matches
 
 # ============================================================
 # DB CONFIG
@@ -150,10 +180,11 @@ PIKPAK_SALTS = [
 ]
 
 PIKPAK_TOKENS_FILE = f"/tmp/pikpak_tokens_{SERVER_ID}.json"
-PIKPAK_LOCK = threading.Lock()
+PIKPAK_LOCK = threading.Lock()  # guards the tokens file's read-modify-write
 MAGNET_ADD_LOCK = threading.Lock()
 PIKPAK_STORAGE_CACHE = {}
 PIKPAK_STORAGE_CACHE_TIME = {}
+PIKPAK_BATCH_TRASH_SIZE = 100  # file ids per batchTrash call
 
 def get_account_storage(account):
     """Get storage info for account with caching"""
@@ -215,6 +246,13 @@ def get_account_storage(account):
                 storage_used=used_bytes,
                 storage_limit=total_bytes
             )
+            registry.update(
+                account_id,
+                quota_used=real_usage,
+                storage_used_bytes=used_bytes,
+                storage_limit_bytes=total_bytes,
+                storage_percent=percent
+            )
             print(f"PIKPAK [{SERVER_ID}]: Synced ALL stats for account {account_id}: Quota={real_usage}/{real_limit}, Storage={used_gb}GB/{total_gb}GB", flush=True)
         except Exception as e:
             print(f"PIKPAK [{SERVER_ID}]: Failed to sync stats: {e}", flush=True)
@@ -241,7 +279,7 @@ def check_all_accounts_quota():
     print(f"PIKPAK [{SERVER_ID}]: Checking account quotas on startup...", flush=True)
     
     try:
-        accounts = db.get_all_server_accounts(DB_SERVER_ID)
+        accounts = registry.get_server_accounts(DB_SERVER_ID)
         if not accounts:
             print(f"PIKPAK [{SERVER_ID}]: No accounts found in DB for server {DB_SERVER_ID}.", flush=True)
             return
@@ -274,10 +312,12 @@ def load_pikpak_tokens():
         return {}
 
 def save_pikpak_tokens(tokens):
-    """Save tokens to file"""
+    """Save tokens to file (temp file + rename, so readers never see it half-written)"""
+    tmp_path = f"{PIKPAK_TOKENS_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
     try:
-        with open(PIKPAK_TOKENS_FILE, 'w') as f:
+        with open(tmp_path, 'w') as f:
             json.dump(tokens, f)
+        os.replace(tmp_path, PIKPAK_TOKENS_FILE)
     except Exception as e:
         print(f"PIKPAK [{SERVER_ID}]: Failed to save tokens: {e}", flush=True)
 
@@ -294,14 +334,17 @@ def get_captcha_for_sync(action, device_id, user_id):
 
 def get_account_tokens(account_id):
     """Get tokens for specific account"""
-    tokens = load_pikpak_tokens()
+    with PIKPAK_LOCK:
+        tokens = load_pikpak_tokens()
     return tokens.get(f"account_{account_id}", {})
 
 def set_account_tokens(account_id, token_data):
     """Save tokens for specific account"""
-    tokens = load_pikpak_tokens()
-    tokens[f"account_{account_id}"] = token_data
-    save_pikpak_tokens(tokens)
+    # Concurrent sync workers log in at the same time - don't lose each other's tokens
+    with PIKPAK_LOCK:
+        tokens = load_pikpak_tokens()
+        tokens[f"account_{account_id}"] = token_data
+        save_pikpak_tokens(tokens)
 
 def generate_captcha_sign(device_id):
     """Generate PikPak captcha_sign using MD5 + 15 salts"""
@@ -423,6 +466,7 @@ def pikpak_login(account, retry_count=0):
             new_device_id = db.rotate_device(account['id'])
             if not new_device_id:
                 raise Exception("db.rotate_device did not return a new device ID.")
+            registry.update(account['id'], current_device_id=new_device_id)
             
             # Update account object and retry
             account['device_id'] = new_device_id
@@ -665,7 +709,7 @@ def pikpak_poll_download(file_id, account, tokens, timeout=120, filename=None, f
                                 try:
                                     f_info = pikpak_get_file_info(f['id'], account, tokens)
                                     params_url = f_info.get("params", {}).get("url", "")
-                                    if file_hash.upper() in params_url.upper():
+                                    if magnet_matches(file_hash, params_url):
                                         found_file = f_info
                                         print(f"PIKPAK [{SERVER_ID}]: Recovery: Found match by HASH: {f_info.get('name')}", flush=True)
                                         break
@@ -916,11 +960,25 @@ def pikpak_delete_file(file_id, account, tokens):
 # ============================================================
 
 class SmartStream(IOBase):
-    """High-speed streaming class with large buffer and prefetch"""
+    """
+    High-speed streaming class backed by a preallocated ring buffer.
+    The response body is read straight into the ring (readinto) and parts
+    are handed out through memoryview slices, so a 512KB read costs one
+    copy instead of re-concatenating and re-slicing multi-MB bytes objects.
     
-    BUFFER_SIZE = 4 * 1024 * 1024  # 4MB buffer
+    With STREAM_CONNECTIONS > 1 and a source that supports ranges, the ring
+    is fed by a RangedPrefetcher (several parallel range requests) instead
+    of a single GET. A single GET that drops mid-file is reopened with
+    `Range: bytes=<pos>-` and continues where it stopped.
     
-    def __init__(self, url, name):
+    `start` opens the stream at a byte offset (resumed Telegram uploads).
+    """
+    
+    BUFFER_SIZE = 4 * 1024 * 1024  # 4MB ring buffer
+    FILL_SIZE = 1024 * 1024  # max bytes per source read (bounds what a dropped read loses)
+    RESUME_RETRIES = 5  # consecutive reconnects before giving up
+    
+    def __init__(self, url, name, start=0):
         super().__init__()
         self.url = url
         self.name = name
@@ -929,34 +987,159 @@ class SmartStream(IOBase):
         
         print(f"STREAM [{SERVER_ID}]: Connecting to {url[:60]}...", flush=True)
         
+        accepts_ranges = False
+        source_url = url
         try:
             head = requests.head(url, allow_redirects=True, timeout=15, headers=HEADERS_STREAM)
             self.total_size = int(head.headers.get('content-length', 0))
+            accepts_ranges = head.headers.get('accept-ranges', '').lower() == 'bytes'
+            source_url = head.url or url
             print(f"STREAM [{SERVER_ID}]: Size {self.total_size} bytes ({self.total_size/1024/1024:.1f}MB)", flush=True)
         except Exception as e:
             print(f"STREAM [{SERVER_ID}] WARNING: HEAD failed: {e}", flush=True)
             self.total_size = 0
         
+        # Without a size there is no way to tell a resumed tail from a truncated one
+        if start and not self.total_size:
+            raise StreamResumeError(f"Can't resume at byte {start}: source size unknown")
+        
         self.session = requests.Session()
         adapter = requests.adapters.HTTPAdapter(
             pool_connections=10,
-            pool_maxsize=10,
+            pool_maxsize=max(10, STREAM_MAX_CONNECTIONS),
             max_retries=3
         )
         self.session.mount('http://', adapter)
         self.session.mount('https://', adapter)
         
+        self.prefetcher = None
+        self.response = None
+        self.resumes = 0
+        self._source_pos = start  # source offset of the next byte to receive
+        if STREAM_CONNECTIONS > 1 and accepts_ranges and self.total_size > 0:
+            print(f"STREAM [{SERVER_ID}]: Parallel prefetch ({STREAM_CONNECTIONS} connections, up to {STREAM_MAX_CONNECTIONS})", flush=True)
+            self.prefetcher = RangedPrefetcher(
+                self.session,
+                source_url,
+                self.total_size,
+                headers=HEADERS_STREAM,
+                start=start,
+                log_prefix=f"STREAM [{SERVER_ID}]"
+            )
+            self.raw = self.prefetcher
+        else:
+            try:
+                self._open(start)
+            except Exception:
+                self.session.close()
+                raise
+            if not self.total_size and not start:
+                self.total_size = int(self.response.headers.get('content-length', 0))
+        
+        # Ring state: _ring_start is the next unread byte, _ring_count how many are buffered
+        self._ring = bytearray(self.BUFFER_SIZE)
+        self._view = memoryview(self._ring)
+        self._ring_start = 0
+        self._ring_count = 0
+        self._eof = False
+        self.current_pos = start
+    
+    def _open(self, offset=0):
+        """(Re)open the single streaming GET at byte `offset`"""
+        headers = dict(HEADERS_STREAM)
+        if offset:
+            headers['Range'] = f"bytes={offset}-"
+        
         self.response = self.session.get(
-            url,
+            self.url,
             stream=True,
             timeout=(10, 1800),
-            headers=HEADERS_STREAM
+            headers=headers
         )
         self.response.raise_for_status()
+        if offset and self.response.status_code != 206:
+            self.response.close()
+            raise StreamResumeError(f"Source ignored Range request (HTTP {self.response.status_code})")
+        self.raw = self.response.raw
+        self.raw.decode_content = True
+    
+    def _resume(self, error):
+        """Reconnect after a dropped/short read; raises once retries run out"""
+        reason = error or "connection closed early"
+        for attempt in range(1, self.RESUME_RETRIES + 1):
+            print(f"STREAM [{SERVER_ID}]: ⚠️ Source dropped at {self._source_pos}/{self.total_size} ({reason}), "
+                  f"resuming (attempt {attempt}/{self.RESUME_RETRIES})", flush=True)
+            if attempt > 1:
+                time.sleep(min(2 ** (attempt - 2), 15))
+            try:
+                self.response.close()
+            except Exception:
+                pass
+            try:
+                self._open(self._source_pos)
+                self.resumes += 1
+                return
+            except StreamResumeError:
+                raise  # retrying won't make the source honour Range
+            except Exception as e:
+                reason = e
+        raise IOError(f"Source connection lost at byte {self._source_pos}/{self.total_size} "
+                      f"after {self.RESUME_RETRIES} resume attempts: {reason}")
+    
+    def _fill(self):
+        """Read from the source into the free space of the ring; sets _eof when done"""
+        if self._eof or self._ring_count == self.BUFFER_SIZE:
+            return
+        write_at = (self._ring_start + self._ring_count) % self.BUFFER_SIZE
+        free = min(self.BUFFER_SIZE - self._ring_count, self.BUFFER_SIZE - write_at, self.FILL_SIZE)
         
-        self.iterator = self.response.iter_content(chunk_size=self.BUFFER_SIZE)
-        self.current_pos = 0
-        self._leftover = b''
+        for _ in range(self.RESUME_RETRIES + 1):
+            error = None
+            try:
+                n = self.raw.readinto(self._view[write_at:write_at + free])
+            except Exception as e:
+                print(f"STREAM [{SERVER_ID}] ERROR: {e}", flush=True)
+                error, n = e, 0
+            
+            if n:
+                self._ring_count += n
+                self._source_pos += n
+                return
+            
+            # Clean end: all bytes arrived, or no size to check against
+            if (self.total_size and self._source_pos >= self.total_size) or (not self.total_size and error is None):
+                self._eof = True
+                return
+            
+            # Truncated. Prefetch segments already retried on their own
+            if self.prefetcher:
+                raise IOError(f"Parallel prefetch failed at byte {self._source_pos}: {error}")
+            self._resume(error)
+        
+        raise IOError(f"Source keeps returning no data at byte {self._source_pos}/{self.total_size}")
+    
+    def _consume(self, n):
+        self._ring_start = (self._ring_start + n) % self.BUFFER_SIZE
+        self._ring_count -= n
+        self.current_pos += n
+    
+    def readinto(self, b):
+        if self._closed:
+            raise ValueError("I/O operation on closed file")
+        
+        out = memoryview(b).cast('B')
+        filled = 0
+        while filled < len(out):
+            if not self._ring_count:
+                self._fill()
+                if not self._ring_count:
+                    break
+            # Copy the contiguous run up to the ring's end, then wrap
+            n = min(len(out) - filled, self._ring_count, self.BUFFER_SIZE - self._ring_start)
+            out[filled:filled + n] = self._view[self._ring_start:self._ring_start + n]
+            self._consume(n)
+            filled += n
+        return filled
     
     def read(self, size=-1):
         if self._closed:
@@ -965,35 +1148,18 @@ class SmartStream(IOBase):
         if size == -1 or size is None:
             size = self.BUFFER_SIZE
         
-        if self._leftover:
-            if len(self._leftover) >= size:
-                data = self._leftover[:size]
-                self._leftover = self._leftover[size:]
-                self.current_pos += len(data)
-                return data
-            else:
-                data = self._leftover
-                self._leftover = b''
-        else:
-            data = b''
-        
-        try:
-            while len(data) < size:
-                chunk = next(self.iterator, None)
-                if chunk is None:
-                    break
-                data += chunk
-        except StopIteration:
-            pass
-        except Exception as e:
-            print(f"STREAM [{SERVER_ID}] ERROR: {e}", flush=True)
+        # Top up so the part can usually be sliced out in one piece
+        while self._ring_count < size and not self._eof and self._ring_count < self.BUFFER_SIZE:
+            self._fill()
         
-        if len(data) > size:
-            self._leftover = data[size:]
-            data = data[:size]
+        if self._ring_count >= size and self._ring_start + size <= self.BUFFER_SIZE:
+            data = bytes(self._view[self._ring_start:self._ring_start + size])
+            self._consume(size)
+            return data
         
-        self.current_pos += len(data)
-        return data
+        buf = bytearray(size)
+        n = self.readinto(buf)
+        return bytes(buf) if n == size else bytes(memoryview(buf)[:n])
     
     def seek(self, offset, whence=0):
         if whence == 0:
@@ -1020,10 +1186,15 @@ class SmartStream(IOBase):
         if not self._closed:
             self._closed = True
             try:
-                if hasattr(self, 'response'):
+                if getattr(self, 'prefetcher', None):
+                    print(f"STREAM [{SERVER_ID}]: Prefetch stats {self.prefetcher.stats()}", flush=True)
+                    self.prefetcher.close()
+                if getattr(self, 'response', None):
                     self.response.close()
                 if hasattr(self, 'session'):
                     self.session.close()
+                if hasattr(self, '_view'):
+                    self._view.release()
             except:
                 pass
     
@@ -1107,12 +1278,143 @@ def detect_quality_from_size(size_bytes):
     else:
         return None
 
+# ============================================================
+# TELEGRAM FILE CACHE
+# ============================================================
+
+def probe_source_size(url):
+    """Content-Length of a download link via HEAD (0 if unknown)"""
+    try:
+        head = requests.head(url, allow_redirects=True, timeout=15, headers=HEADERS_STREAM)
+        return int(head.headers.get('content-length', 0))
+    except Exception as e:
+        print(f"WORKER [{SERVER_ID}]: HEAD for size failed: {e}", flush=True)
+        return 0
+
+def telegram_content_key(data, file_size=0):
+    """
+    Content identity of an upload job: normalized file name + exact size,
+    prefixed by the magnet info hash when the job carries one ('magnet' or
+    'magnet_hash'), so files of one multi-file torrent never share a key.
+    Returns (content_key, magnet_hash); content_key is None without a size.
+    """
+    magnet_hash = extract_hash(data.get('magnet')) or normalize_hash(data.get('magnet_hash'))
+    if not file_size:
+        return None, magnet_hash
+    name = re.sub(r'\s+', ' ', unquote(data.get('filename', 'video.mp4'))).strip().lower()
+    if magnet_hash:
+        return f"btih:{magnet_hash}:{name}:{file_size}", magnet_hash
+    return f"name:{name}:{file_size}", None
+
+# '@username' (lowercased) -> numeric chat id, filled in by resolve_chat_id
+RESOLVED_CHATS = {}
+
+async def resolve_chat_id(tg_app, chat_target):
+    """Numeric chat id for an '@username' or numeric chat target"""
+    chat_str = str(chat_target).strip()
+    
+    if chat_str.startswith("@"):
+        if chat_str.lower() in RESOLVED_CHATS:
+            return RESOLVED_CHATS[chat_str.lower()]
+        chat = await tg_app.get_chat(chat_str)
+        RESOLVED_CHATS[chat_str.lower()] = chat.id
+        print(f"WORKER [{SERVER_ID}]: ✅ Resolved {chat_str} to ID: {chat.id}", flush=True)
+        return chat.id
+    elif chat_str.lstrip("-").isdigit():
+        return int(chat_str)
+    else:
+        raise Exception(f"Invalid chat format: {chat_str}")
+
+# RPC errors saying a cached file_id or its source message is gone for good
+TG_CACHED_COPY_GONE = (
+    'FILE_REFERENCE_', 'FILE_ID_INVALID', 'MEDIA_EMPTY', 'MEDIA_INVALID',
+    'MESSAGE_ID_INVALID', 'CHANNEL_PRIVATE', 'CHANNEL_INVALID', 'PEER_ID_INVALID'
+)
+
+def cached_copy_gone(error):
+    """True if `error` means the cached copy can't be used again (vs. a transient failure)"""
+    if isinstance(error, ValueError):
+        return True  # pyrogram couldn't decode the stored file_id
+    return str(getattr(error, 'ID', '')).startswith(TG_CACHED_COPY_GONE)
+
+async def send_cached_document(tg_app, content_key, chat_id, caption, file_size):
+    """
+    Re-post a document Telegram already has: send it by file_id, or copy the
+    original message if the file_id is gone. Returns the upload result dict,
+    or None when there is no usable cached copy (entry is dropped).
+    Transient errors (timeouts, dropped connections, FloodWait) are raised
+    so perform_upload checks the client and retries.
+    """
+    cached = await run_blocking(db.get_telegram_file, content_key)
+    if not cached:
+        return None
+    if cached.get('file_size') != file_size:
+        print(f"WORKER [{SERVER_ID}]: Cached document for {content_key} is {cached.get('file_size')} bytes, "
+              f"expected {file_size} - uploading", flush=True)
+        return None
+    
+    start_time = time.time()
+    msg = None
+    try:
+        msg = await tg_app.send_document(
+            chat_id=chat_id,
+            document=cached['tg_file_id'],
+            caption=caption,
+            parse_mode=enums.ParseMode.HTML
+        )
+    except Exception as e:
+        if not cached_copy_gone(e):
+            raise
+        print(f"WORKER [{SERVER_ID}]: Cached file_id rejected ({e}), trying copy_message", flush=True)
+        if cached.get('chat_id') and cached.get('message_id'):
+            try:
+                msg = await tg_app.copy_message(
+                    chat_id=chat_id,
+                    from_chat_id=cached['chat_id'],
+                    message_id=cached['message_id'],
+                    caption=caption,
+                    parse_mode=enums.ParseMode.HTML
+                )
+            except Exception as e:
+                if not cached_copy_gone(e):
+                    raise
+                print(f"WORKER [{SERVER_ID}]: copy_message failed: {e}", flush=True)
+    
+    if msg is None or not msg.document:
+        await run_blocking(db.delete_telegram_file, content_key)
+        return None
+    
+    db.record_telegram_repost(content_key)
+    elapsed = time.time() - start_time
+    clean_id = str(msg.chat.id).replace('-100', '')
+    private_link = f"https://t.me/c/{clean_id}/{msg.id}"
+    print(f"WORKER [{SERVER_ID}]: ⚡ Re-posted cached {cached.get('file_name') or content_key} in {elapsed:.2f}s (0 bytes uploaded)", flush=True)
+    
+    return {
+        "success": True,
+        "message_id": msg.id,
+        "chat_id": msg.chat.id,
+        "file_id": msg.document.file_id,
+        "private_link": private_link,
+        "file_size": msg.document.file_size,
+        "duration": 0,
+        "upload_time": elapsed,
+        "avg_speed_mbps": 0,
+        "cached": True,
+        "server": SERVER_ID
+    }
+
 # ============================================================
 # ASYNC UPLOAD LOGIC
 # ============================================================
 
-async def perform_upload(file_url, chat_target, caption, filename, file_size_mb=0):
-    """Upload video with optimized speed"""
+async def perform_upload(file_url, chat_target, caption, filename, file_size_mb=0,
+                         content_key=None, magnet_hash=None, content_size=0):
+    """
+    Upload video with optimized speed.
+    With a content_key, a document already on Telegram is re-posted instead
+    and a fresh upload is recorded for next time.
+    """
     # Check emergency stop before starting
     if EMERGENCY_STOP:
         raise EmergencyStopError("Emergency stop activated - upload cancelled")
@@ -1122,14 +1424,21 @@ async def perform_upload(file_url, chat_target, caption, filename, file_size_mb=
     
     max_retries = 3
     retry_count = 0
+    upload = None  # kept across retries so they resume from the first missing part
+    start_time = None
     last_log_time = [time.time()]
     last_log_bytes = [0]
+    last_sent_bytes = [0]
     
-    def progress_callback(current, total):
+    async def progress_callback(current, total):
         # Check emergency stop during upload
         if EMERGENCY_STOP:
             raise EmergencyStopError("Emergency stop activated during upload")
         
+        # Shared ceiling across all concurrent uploads
+        await UPLOAD_BANDWIDTH.consume(current - last_sent_bytes[0])
+        last_sent_bytes[0] = current
+        
         now = time.time()
         elapsed = now - last_log_time[0]
         
@@ -1144,90 +1453,136 @@ async def perform_upload(file_url, chat_target, caption, filename, file_size_mb=
             last_log_bytes[0] = current
     
     while retry_count < max_retries:
+        acked_before = len(upload.acked) if upload else 0
+        tg_app = None
         try:
-            async with Client(
-                SESSION_NAME,
-                api_id=API_ID,
-                api_hash=API_HASH,
-                bot_token=BOT_TOKEN,
-                workdir="/tmp"
-            ) as tg_app:
-                print(f"WORKER [{SERVER_ID}]: Bot connected! (Attempt {retry_count + 1}/{max_retries})", flush=True)
-                
-                final_chat_id = None
-                chat_str = str(chat_target).strip()
-                
-                if chat_str.startswith("@"):
-                    chat = await tg_app.get_chat(chat_str)
-                    final_chat_id = chat.id
-                    print(f"WORKER [{SERVER_ID}]: ✅ Resolved {chat_str} to ID: {final_chat_id}", flush=True)
-                elif chat_str.lstrip("-").isdigit():
-                    final_chat_id = int(chat_str)
-                else:
-                    raise Exception(f"Invalid chat format: {chat_str}")
-                
+            tg_app = await tg_client.acquire()
+            print(f"WORKER [{SERVER_ID}]: Bot ready! (Attempt {retry_count + 1}/{max_retries})", flush=True)
+            
+            final_chat_id = await resolve_chat_id(tg_app, chat_target)
+            
+            if content_key and upload is None:
+                cached_result = await send_cached_document(tg_app, content_key, final_chat_id, caption, content_size)
+                if cached_result:
+                    return cached_result
+            
+            if start_time is None:
                 start_time = time.time()
-                
-                with SmartStream(file_url, filename) as stream:
+            
+            if upload is None or not upload.complete:
+                offset = upload.resume_offset if upload else 0
+                # Opening does a HEAD and a GET - keep them off the upload loop
+                try:
+                    stream = await run_blocking(SmartStream, file_url, filename, offset)
+                except StreamResumeError as e:
+                    print(f"WORKER [{SERVER_ID}]: Can't resume ({e}), restarting from part 0", flush=True)
+                    upload.restart()
+                    offset = 0
+                    stream = await run_blocking(SmartStream, file_url, filename, offset)
+                try:
                     if stream.total_size == 0:
                         raise Exception("File size is 0. Link may be expired.")
                     
-                    print(f"WORKER [{SERVER_ID}]: Uploading {filename} ({stream.total_size/1024/1024:.1f}MB)...", flush=True)
-                    last_log_bytes[0] = 0
+                    if upload is not None and stream.total_size != upload.file_size:
+                        # Source changed under us - parts sent so far belong to another file
+                        print(f"WORKER [{SERVER_ID}]: Source size changed ({upload.file_size} -> {stream.total_size}), starting over", flush=True)
+                        await run_blocking(stream.close)
+                        upload = None
+                        stream = await run_blocking(SmartStream, file_url, filename, 0)
+                        if stream.total_size == 0:
+                            raise Exception("File size is 0. Link may be expired.")
+                    
+                    if upload is None:
+                        upload = ResumableUpload(tg_app, stream.total_size, filename)
+                        print(f"WORKER [{SERVER_ID}]: Uploading {filename} ({stream.total_size/1024/1024:.1f}MB)...", flush=True)
+                    else:
+                        print(f"WORKER [{SERVER_ID}]: Resuming {filename} at part {upload.first_missing}/{upload.total_parts} "
+                              f"({offset/1024/1024:.1f}MB already acknowledged)", flush=True)
+                    last_log_bytes[0] = upload.acked_bytes
+                    last_sent_bytes[0] = upload.acked_bytes
                     last_log_time[0] = time.time()
                     
-                    msg = await tg_app.send_document(
-                        chat_id=final_chat_id,
-                        document=stream,
-                        caption=caption,
-                        file_name=filename,
-                        force_document=True,
-                        progress=progress_callback,
-                        parse_mode=enums.ParseMode.HTML,
-                        thumb="thumbnail.jpg" if os.path.exists("thumbnail.jpg") else None
-                    )
-
-                    elapsed = time.time() - start_time
-                    avg_speed = (stream.total_size / elapsed) / (1024 * 1024)
-
-                    clean_id = str(msg.chat.id).replace('-100', '')
-                    private_link = f"https://t.me/c/{clean_id}/{msg.id}"
-
-                    print(f"WORKER [{SERVER_ID}]: ✅ Upload complete! {elapsed:.1f}s ({avg_speed:.1f} MB/s avg)", flush=True)
-                    print(f"WORKER [{SERVER_ID}]: Link: {private_link}", flush=True)
+                    await upload.upload_parts(tg_app, stream, progress=progress_callback)
+                finally:
+                    await run_blocking(stream.close)
+            
+            msg = await upload.send(
+                tg_app,
+                final_chat_id,
+                caption=caption,
+                parse_mode=enums.ParseMode.HTML,
+                thumb="thumbnail.jpg" if os.path.exists("thumbnail.jpg") else None
+            )
 
-                    return {
-                        "success": True,
-                        "message_id": msg.id,
-                        "chat_id": msg.chat.id,
-                        "file_id": msg.document.file_id,
-                        "private_link": private_link,
-                        "file_size": msg.document.file_size,
-                        "duration": 0,
-                        "upload_time": elapsed,
-                        "avg_speed_mbps": avg_speed,
-                        "server": SERVER_ID
-                    }
+            elapsed = time.time() - start_time
+            avg_speed = (upload.file_size / elapsed) / (1024 * 1024)
+
+            clean_id = str(msg.chat.id).replace('-100', '')
+            private_link = f"https://t.me/c/{clean_id}/{msg.id}"
+
+            print(f"WORKER [{SERVER_ID}]: ✅ Upload complete! {elapsed:.1f}s ({avg_speed:.1f} MB/s avg, {upload.attempts} attempt(s))", flush=True)
+            print(f"WORKER [{SERVER_ID}]: Link: {private_link}", flush=True)
+            
+            # Only record under the key if we uploaded exactly the probed file
+            if content_key and upload.file_size == content_size:
+                db.save_telegram_file({
+                    'content_key': content_key,
+                    'magnet_hash': magnet_hash,
+                    'file_name': filename,
+                    'file_size': upload.file_size,
+                    'tg_file_id': msg.document.file_id,
+                    'chat_id': msg.chat.id,
+                    'message_id': msg.id
+                })
+
+            return {
+                "success": True,
+                "message_id": msg.id,
+                "chat_id": msg.chat.id,
+                "file_id": msg.document.file_id,
+                "private_link": private_link,
+                "file_size": msg.document.file_size,
+                "duration": 0,
+                "upload_time": elapsed,
+                "avg_speed_mbps": avg_speed,
+                "server": SERVER_ID
+            }
         
         except EmergencyStopError:
-            # Re-raise to be caught by worker_loop without retrying
+            # Upload was aborted mid-transfer; check the shared client before its next use
+            tg_client.invalidate()
+            # Re-raise to be caught by process_upload_job without retrying
             raise
             
         except FloodWait as e:
             print(f"WORKER [{SERVER_ID}]: FloodWait {e.value}s, waiting...", flush=True)
             await asyncio.sleep(e.value)
-            retry_count += 1
+            if not (upload and len(upload.acked) > acked_before):
+                retry_count += 1
             
         except Exception as e:
-            retry_count += 1
             error_msg = str(e)
             print(f"WORKER [{SERVER_ID}]: Error: {error_msg}", flush=True)
+            if is_telegram_error(e):
+                # Connection may be broken - verify it before the retry reuses it
+                tg_client.invalidate()
+            
+            # An attempt that got new parts acknowledged doesn't use up a retry
+            if upload and len(upload.acked) > acked_before:
+                print(f"WORKER [{SERVER_ID}]: Progress kept ({len(upload.acked)}/{upload.total_parts} parts), resuming...", flush=True)
+                await asyncio.sleep(3)
+                continue
+            retry_count += 1
             
             if retry_count >= max_retries:
                 raise Exception(f"Upload failed after {max_retries} retries: {error_msg}")
             
             print(f"WORKER [{SERVER_ID}]: Retry {retry_count}/{max_retries}...", flush=True)
             await asyncio.sleep(3)
+        
+        finally:
+            if tg_app is not None:
+                tg_client.release()
 
 # ============================================================
 # SEND NOTIFICATION
@@ -1239,22 +1594,22 @@ async def send_admin_notification(message, reply_markup=None):
         print(f"NOTIFICATION [{SERVER_ID}]: {message}", flush=True)
         return
     
+    tg_app = None
     try:
-        async with Client(
-            SESSION_NAME,
-            api_id=API_ID,
-            api_hash=API_HASH,
-            bot_token=BOT_TOKEN,
-            workdir="/tmp"
-        ) as tg_app:
-            await tg_app.send_message(
-                chat_id=int(ADMIN_CHAT_ID),
-                text=f"[{SERVER_ID.upper()}] {message}",
-                reply_markup=reply_markup
-            )
-            print(f"NOTIFICATION [{SERVER_ID}] SENT", flush=True)
+        tg_app = await tg_client.acquire()
+        await tg_app.send_message(
+            chat_id=int(ADMIN_CHAT_ID),
+            text=f"[{SERVER_ID.upper()}] {message}",
+            reply_markup=reply_markup
+        )
+        print(f"NOTIFICATION [{SERVER_ID}] SENT", flush=True)
     except Exception as e:
+        if is_telegram_error(e):
+            tg_client.invalidate()
         print(f"NOTIFICATION [{SERVER_ID}] ERROR: {e}", flush=True)
+    finally:
+        if tg_app is not None:
+            tg_client.release()
 
 # ============================================================
 # QUEUE WORKER
@@ -1262,93 +1617,101 @@ async def send_admin_notification(message, reply_markup=None):
 
 JOB_QUEUE = queue.Queue()
 JOBS = {} 
-WORKER_THREAD = None
-WORKER_LOCK = threading.Lock()
 
-def worker_loop():
-    """Background worker"""
-    print(f"SYSTEM [{SERVER_ID}]: Queue Worker Started", flush=True)
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    
-    while True:
-        job_id = None
-        try:
-            job_id, data = JOB_QUEUE.get()
-            print(f"WORKER [{SERVER_ID}]: Job {job_id}", flush=True)
-            JOBS[job_id]['status'] = 'processing'
-            JOBS[job_id]['started'] = time.time()
-            JOBS[job_id]['server'] = SERVER_ID
-            
-            file_size_mb = data.get('file_size_mb', 0)
-            
-            if file_size_mb > 2048:
-                movie_name = data.get('caption', 'Unknown')
-                notification_msg = f"⚠️ **Skipped Upload**\n\n" \
-                                   f"Movie: {movie_name}\n" \
-                                   f"File size: {file_size_mb:.1f}MB\n" \
-                                   f"Reason: Exceeds 2GB limit"
-                loop.run_until_complete(send_admin_notification(notification_msg))
-                raise Exception(f"File too large: {file_size_mb:.1f}MB")
-            
-            result = loop.run_until_complete(perform_upload(
-                file_url=data['url'],
-                chat_target=data['chat_id'],
-                caption=data.get('caption', ''),
-                filename=data.get('filename', 'video.mp4'),
-                file_size_mb=file_size_mb
-            ))
-            
-            JOBS[job_id]['status'] = 'done'
-            JOBS[job_id]['result'] = result
-            JOBS[job_id]['completed'] = time.time()
-            print(f"WORKER [{SERVER_ID}]: ✅ Job {job_id} done!", flush=True)
-            
+async def process_upload_job(job_id, data):
+    """Run one queued upload job (awaited by an upload pool worker)"""
+    try:
+        print(f"WORKER [{SERVER_ID}]: Job {job_id}", flush=True)
+        JOBS[job_id]['status'] = 'processing'
+        JOBS[job_id]['started'] = time.time()
+        JOBS[job_id]['server'] = SERVER_ID
+        
+        file_size_mb = data.get('file_size_mb', 0)
+        
+        if file_size_mb > 2048:
+            movie_name = data.get('caption', 'Unknown')
+            notification_msg = f"⚠️ **Skipped Upload**\n\n" \
+                               f"Movie: {movie_name}\n" \
+                               f"File size: {file_size_mb:.1f}MB\n" \
+                               f"Reason: Exceeds 2GB limit"
+            await send_admin_notification(notification_msg)
+            raise Exception(f"File too large: {file_size_mb:.1f}MB")
+        
+        # Same content already on Telegram? (skip with force_upload)
+        content_key, magnet_hash, content_size = None, None, 0
+        if not data.get('force_upload'):
+            content_size = await run_blocking(probe_source_size, data['url'])
+            content_key, magnet_hash = telegram_content_key(data, content_size)
+        
+        result = await perform_upload(
+            file_url=data['url'],
+            chat_target=data['chat_id'],
+            caption=data.get('caption', ''),
+            filename=data.get('filename', 'video.mp4'),
+            file_size_mb=file_size_mb,
+            content_key=content_key,
+            magnet_hash=magnet_hash,
+            content_size=content_size
+        )
+        
+        JOBS[job_id]['status'] = 'done'
+        JOBS[job_id]['result'] = result
+        JOBS[job_id]['completed'] = time.time()
+        print(f"WORKER [{SERVER_ID}]: ✅ Job {job_id} done!", flush=True)
+        
+        if result.get('cached'):
+            # Nothing was transferred - keep it out of the throughput stats
+            log_activity("success", f"Re-posted (cached): {data.get('filename', 'video.mp4')}")
+            update_daily_stats("uploads")
+        else:
             log_activity("success", f"Uploaded: {data.get('filename', 'video.mp4')}")
             update_daily_stats("uploads")
             update_daily_stats("total_bytes", result.get('file_size', 0))
             update_daily_stats("total_time", result.get('upload_time', 0))
-            
-        except EmergencyStopError as e:
-            error_msg = "cancelled by emergency stop"
-            print(f"WORKER [{SERVER_ID}] CANCELLED: Job {job_id} cancelled by emergency stop.", flush=True)
-            if job_id:
-                JOBS[job_id]['status'] = 'failed'
-                log_activity("failed", f"Upload cancelled: Emergency Stop")
-                update_daily_stats("failed")
-                JOBS[job_id]['error'] = error_msg
-                JOBS[job_id]['failed'] = time.time()
+        
+    except EmergencyStopError as e:
+        error_msg = "cancelled by emergency stop"
+        print(f"WORKER [{SERVER_ID}] CANCELLED: Job {job_id} cancelled by emergency stop.", flush=True)
+        JOBS[job_id]['status'] = 'failed'
+        log_activity("failed", f"Upload cancelled: Emergency Stop")
+        update_daily_stats("failed")
+        JOBS[job_id]['error'] = error_msg
+        JOBS[job_id]['failed'] = time.time()
 
-        except Exception as e:
-            error_msg = str(e)
-            print(f"WORKER [{SERVER_ID}] ERROR: {error_msg}", flush=True)
-            
-            if "failed after" in error_msg or "too large" in error_msg:
-                loop.run_until_complete(send_admin_notification(f"Job {job_id}: {error_msg}"))
-            
-            if job_id:
-                JOBS[job_id]['status'] = 'failed'
-                log_activity("failed", f"Upload failed: {error_msg[:50]}")
-                update_daily_stats("failed")
-                JOBS[job_id]['error'] = error_msg
-                JOBS[job_id]['failed'] = time.time()
-        finally:
-            if job_id:
-                JOB_QUEUE.task_done()
-            
-            if len(JOBS) > 100:
-                old_jobs = sorted(JOBS.items(), key=lambda x: x[1].get('created', 0))[:50]
-                for old_id, _ in old_jobs:
-                    del JOBS[old_id]
+    except Exception as e:
+        error_msg = str(e)
+        print(f"WORKER [{SERVER_ID}] ERROR: {error_msg}", flush=True)
+        
+        if "failed after" in error_msg or "too large" in error_msg:
+            await send_admin_notification(f"Job {job_id}: {error_msg}")
+        
+        JOBS[job_id]['status'] = 'failed'
+        log_activity("failed", f"Upload failed: {error_msg[:50]}")
+        update_daily_stats("failed")
+        JOBS[job_id]['error'] = error_msg
+        JOBS[job_id]['failed'] = time.time()
+    finally:
+        if len(JOBS) > 100:
+            # Never drop jobs a worker is still running
+            finished = [item for item in JOBS.items() if item[1].get('status') in ('done', 'failed')]
+            old_jobs = sorted(finished, key=lambda x: x[1].get('created', 0))[:50]
+            for old_id, _ in old_jobs:
+                JOBS.pop(old_id, None)
+
+# Concurrent upload workers (UPLOAD_WORKERS, UPLOAD_PER_CHAT_LIMIT, UPLOAD_BANDWIDTH_LIMIT_MBPS)
+UPLOAD_BANDWIDTH = BandwidthLimiter()
+def upload_chat_key(data):
+    """Per-chat cap key: '@name' counts as its numeric id once it has been resolved"""
+    chat_str = str(data.get('chat_id', '')).strip()
+    if chat_str.startswith("@"):
+        return str(RESOLVED_CHATS.get(chat_str.lower(), chat_str.lower()))
+    return chat_str
+
+upload_pool = UploadPool(JOB_QUEUE, process_upload_job, bandwidth=UPLOAD_BANDWIDTH, chat_key=upload_chat_key)
 
 def ensure_worker_alive():
-    """Start worker thread"""
-    global WORKER_THREAD
-    with WORKER_LOCK:
-        if WORKER_THREAD is None or not WORKER_THREAD.is_alive():
-            print(f"SYSTEM [{SERVER_ID}]: Starting worker thread...", flush=True)
-            WORKER_THREAD = threading.Thread(target=worker_loop, daemon=True)
-            WORKER_THREAD.start()
+    """Start the upload pool, or restart its thread / any dead workers"""
+    upload_pool.ensure_running()
 
 # ============================================================
 # ADMIN DASHBOARD ROUTES
@@ -1363,7 +1726,7 @@ def admin_dashboard():
 def admin_get_storage(account_id):
     """Get storage usage for a specific account from DB"""
     try:
-        all_accounts = db.get_all_server_accounts(DB_SERVER_ID)
+        all_accounts = registry.get_server_accounts(DB_SERVER_ID)
         account = next((acc for acc in all_accounts if acc['id'] == account_id), None)
         
         if not account:
@@ -1379,7 +1742,7 @@ def admin_get_storage(account_id):
 def admin_clear_trash(account_id):
     """Empty trash for a specific account using DB"""
     try:
-        all_accounts = db.get_all_server_accounts(DB_SERVER_ID)
+        all_accounts = registry.get_server_accounts(DB_SERVER_ID)
         account = next((acc for acc in all_accounts if acc['id'] == account_id), None)
 
         if not account:
@@ -1389,47 +1752,14 @@ def admin_clear_trash(account_id):
         
         print(f"PIKPAK [{SERVER_ID}]: Clearing trash for account {account_id}", flush=True)
         tokens = ensure_logged_in(account)
-        
-        # Empty trash
-        device_id = account["device_id"]
-        captcha_sign, timestamp = generate_captcha_sign(device_id)
-        captcha_token = get_pikpak_captcha(
-            action="PATCH:/drive/v1/files/trash:empty",
-            device_id=device_id,
-            user_id=tokens["user_id"],
-            captcha_sign=captcha_sign,
-            timestamp=timestamp
-        )
-        
-        url = f"{PIKPAK_API_DRIVE}/drive/v1/files/trash:empty"
-        headers = {
-            "Authorization": f"Bearer {tokens['access_token']}",
-            "x-device-id": device_id,
-            "x-captcha-token": captcha_token
-        }
-        requests.patch(url, headers=headers, json={}, timeout=30)
-        
-        # Invalidate cache
-        cache_key = f"account_{account_id}"
-        if cache_key in PIKPAK_STORAGE_CACHE:
-            del PIKPAK_STORAGE_CACHE[cache_key]
-        if cache_key in PIKPAK_STORAGE_CACHE_TIME:
-            del PIKPAK_STORAGE_CACHE_TIME[cache_key]
-
+        pikpak_empty_trash(account, tokens)
         get_account_storage(account)
         
         # Sync cache after clearing trash
         try:
-            log_activity("info", "Trash cleared, starting cache sync.")
-            sync_thread = threading.Thread(
-                target=sync_all_accounts_to_cache,
-                kwargs={
-                    'login_func': pikpak_login, 
-                    'get_account_func': None,
-                    'captcha_func': get_captcha_for_sync
-                }
-            )
-            sync_thread.start()
+            job, started = start_sync_job(pikpak_login, get_captcha_for_sync, evict_func=evict_cold_files)
+            if started:
+                log_activity("info", f"Trash cleared, started cache sync {job.id}.")
         except Exception as sync_e:
             print(f"CACHE [{SERVER_ID}]: Failed to start sync after trash clear: {sync_e}", flush=True)
 
@@ -1438,11 +1768,75 @@ def admin_clear_trash(account_id):
         print(f"PIKPAK [{SERVER_ID}]: Failed to clear trash for account {account_id}: {e}", flush=True)
         return jsonify({"success": False, "error": str(e)}), 500
 
+def pikpak_empty_trash(account, tokens):
+    """Permanently delete everything in the account's PikPak trash"""
+    device_id = account["device_id"]
+    captcha_sign, timestamp = generate_captcha_sign(device_id)
+    captcha_token = get_pikpak_captcha(
+        action="PATCH:/drive/v1/files/trash:empty",
+        device_id=device_id,
+        user_id=tokens["user_id"],
+        captcha_sign=captcha_sign,
+        timestamp=timestamp
+    )
+    
+    url = f"{PIKPAK_API_DRIVE}/drive/v1/files/trash:empty"
+    headers = {
+        "Authorization": f"Bearer {tokens['access_token']}",
+        "x-device-id": device_id,
+        "x-captcha-token": captcha_token
+    }
+    requests.patch(url, headers=headers, json={}, timeout=30)
+    
+    # Invalidate cache
+    cache_key = f"account_{account['id']}"
+    if cache_key in PIKPAK_STORAGE_CACHE:
+        del PIKPAK_STORAGE_CACHE[cache_key]
+    if cache_key in PIKPAK_STORAGE_CACHE_TIME:
+        del PIKPAK_STORAGE_CACHE_TIME[cache_key]
+
+def pikpak_batch_trash(file_ids, account, tokens):
+    """
+    Move files to the PikPak trash, PIKPAK_BATCH_TRASH_SIZE per call.
+    Returns the ids PikPak accepted; ids in a rejected call are left out.
+    """
+    device_id = account["device_id"]
+    captcha_sign, timestamp = generate_captcha_sign(device_id)
+    captcha_token = get_pikpak_captcha(
+        action="POST:/drive/v1/files:batchTrash",
+        device_id=device_id,
+        user_id=tokens["user_id"],
+        captcha_sign=captcha_sign,
+        timestamp=timestamp
+    )
+    
+    url = f"{PIKPAK_API_DRIVE}/drive/v1/files:batchTrash"
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {tokens['access_token']}",
+        "x-device-id": device_id,
+        "x-captcha-token": captcha_token
+    }
+    accepted = []
+    for start in range(0, len(file_ids), PIKPAK_BATCH_TRASH_SIZE):
+        chunk = file_ids[start:start + PIKPAK_BATCH_TRASH_SIZE]
+        try:
+            response = requests.post(url, headers=headers, json={"ids": chunk}, timeout=30)
+            data = response.json() if response.content else {}
+            if response.ok and not data.get("error"):
+                accepted.extend(chunk)
+            else:
+                print(f"PIKPAK [{SERVER_ID}]: batchTrash rejected {len(chunk)} files "
+                      f"(HTTP {response.status_code}): {data.get('error_description') or data.get('error')}", flush=True)
+        except Exception as e:
+            print(f"PIKPAK [{SERVER_ID}]: batchTrash failed for {len(chunk)} files: {e}", flush=True)
+    return accepted
+
 @app.route('/admin/api/clear-mypack/<int:account_id>', methods=['POST'])
 def admin_clear_mypack(account_id):
     """Delete ALL files in the My Pack folder for an account from DB"""
     try:
-        all_accounts = db.get_all_server_accounts(DB_SERVER_ID)
+        all_accounts = registry.get_server_accounts(DB_SERVER_ID)
         account = next((acc for acc in all_accounts if acc['id'] == account_id), None)
 
         if not account:
@@ -1466,28 +1860,15 @@ def admin_clear_mypack(account_id):
         print(f"PIKPAK [{SERVER_ID}]: Clearing folder: {parent_id}", flush=True)
         
         files = pikpak_list_files(parent_id, account, tokens)
-        deleted_count = len(files)
+        deleted_count = 0
         
         if files:
-            device_id = account["device_id"]
-            captcha_sign, timestamp = generate_captcha_sign(device_id)
-            captcha_token = get_pikpak_captcha(
-                action="POST:/drive/v1/files:batchTrash",
-                device_id=device_id,
-                user_id=tokens["user_id"],
-                captcha_sign=captcha_sign,
-                timestamp=timestamp
-            )
+            file_ids = pikpak_batch_trash([f["id"] for f in files], account, tokens)
+            deleted_count = len(file_ids)
             
-            url = f"{PIKPAK_API_DRIVE}/drive/v1/files:batchTrash"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {tokens['access_token']}",
-                "x-device-id": device_id,
-                "x-captcha-token": captcha_token
-            }
-            body = {"ids": [f["id"] for f in files]}
-            requests.post(url, headers=headers, json=body, timeout=30)
+            # Keep the smart cache (and its memory front) from serving trashed files
+            mark_files_as_trash(account_id, file_ids)
+            drop_warm_links(account_id, file_ids)
             
             # Clear trash after moving files
             admin_clear_trash(account_id)
@@ -1500,12 +1881,110 @@ def admin_clear_mypack(account_id):
         print(f"PIKPAK [{SERVER_ID}]: Failed to clear My Pack for account {account_id}: {e}", flush=True)
         return jsonify({"success": False, "error": str(e)}), 500
 
+def _plan_account_eviction(account, target_percent=None):
+    """Refresh storage stats for an account and build its eviction plan"""
+    get_account_storage(account)
+    stats = registry.get(account['id']) or account
+    return plan_cache_eviction(
+        account['id'],
+        used_bytes=stats.get('storage_used_bytes') or 0,
+        limit_bytes=stats.get('storage_limit_bytes') or 0,
+        target_percent=target_percent
+    )
+
+def evict_cold_files(account, target_percent=None):
+    """
+    Trash the least popular cached files until the account is under its
+    storage target. Returns the plan plus files_evicted / bytes_evicted
+    (counting only the files PikPak accepted).
+    Also run by cache syncs for accounts over EVICTION_TRIGGER_PERCENT.
+    """
+    account_id = account['id']
+    account['device_id'] = account.get('current_device_id') or account.get('device_id')
+    plan = _plan_account_eviction(account, target_percent)
+    plan['files_evicted'] = 0
+    plan['bytes_evicted'] = 0
+    
+    file_ids = [f['file_id'] for f in plan['files']]
+    if not file_ids:
+        return plan
+    
+    print(f"CACHE [{SERVER_ID}]: Evicting {len(file_ids)} cold files from account {account_id}", flush=True)
+    tokens = ensure_logged_in(account)
+    trashed = pikpak_batch_trash(file_ids, account, tokens)
+    if trashed:
+        mark_files_as_trash(account_id, trashed)
+        drop_warm_links(account_id, trashed)
+        pikpak_empty_trash(account, tokens)
+        get_account_storage(account)
+        trashed_set = set(trashed)
+        plan['bytes_evicted'] = sum(f['file_size'] for f in plan['files'] if f['file_id'] in trashed_set)
+        log_activity("info", f"Evicted {len(trashed)} cold files ({round(plan['bytes_evicted'] / (1024**3), 2)} GB) from account {account_id}")
+    plan['files_evicted'] = len(trashed)
+    return plan
+
+@app.route('/admin/api/eviction-plan/<int:account_id>', methods=['GET'])
+def admin_eviction_plan(account_id):
+    """Preview which cached files would be evicted (least popular first)"""
+    try:
+        all_accounts = registry.get_server_accounts(DB_SERVER_ID)
+        account = next((acc for acc in all_accounts if acc['id'] == account_id), None)
+
+        if not account:
+            return jsonify({"error": "Account not found"}), 404
+        
+        account['device_id'] = account.get('current_device_id')
+        target = request.args.get('target', type=float)
+        return jsonify(_plan_account_eviction(account, target))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/admin/api/evict-cold/<int:account_id>', methods=['POST'])
+def admin_evict_cold(account_id):
+    """Delete the least popular cached files until the account is under its storage target"""
+    try:
+        all_accounts = registry.get_server_accounts(DB_SERVER_ID)
+        account = next((acc for acc in all_accounts if acc['id'] == account_id), None)
+
+        if not account:
+            return jsonify({"error": "Account not found"}), 404
+        
+        target = (request.get_json(silent=True) or {}).get('target')
+        plan = evict_cold_files(account, target)
+        
+        return jsonify({
+            "success": True,
+            "files_evicted": plan['files_evicted'],
+            "bytes_freed": plan['bytes_evicted'],
+            "files_kept": plan['kept']
+        })
+    except Exception as e:
+        print(f"CACHE [{SERVER_ID}]: Failed to evict cold files for account {account_id}: {e}", flush=True)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/admin/api/evict-all-cold', methods=['POST'])
+def admin_evict_all_cold():
+    """Run popularity eviction on ALL accounts"""
+    count = 0
+    try:
+        all_accounts = registry.get_server_accounts(DB_SERVER_ID)
+        for account in all_accounts:
+            try:
+                response = admin_evict_cold(account["id"])
+                if response.get_json().get("files_evicted"):
+                    count += 1
+            except Exception as e:
+                print(f"CACHE [{SERVER_ID}]: Failed to evict cold files for account {account['id']}: {e}", flush=True)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    return jsonify({"success": True, "accounts_evicted": count})
+
 @app.route('/admin/api/clear-all-trash', methods=['POST'])
 def admin_clear_all_trash():
     """Empty trash for ALL accounts by fetching from DB"""
     count = 0
     try:
-        all_accounts = db.get_all_server_accounts(DB_SERVER_ID)
+        all_accounts = registry.get_server_accounts(DB_SERVER_ID)
         for account in all_accounts:
             try:
                 response = admin_clear_trash(account["id"])
@@ -1522,7 +2001,7 @@ def admin_clear_all_mypack():
     """Clear My Pack for ALL accounts by fetching from DB"""
     count = 0
     try:
-        all_accounts = db.get_all_server_accounts(DB_SERVER_ID)
+        all_accounts = registry.get_server_accounts(DB_SERVER_ID)
         for account in all_accounts:
             try:
                 response = admin_clear_mypack(account["id"])
@@ -1539,6 +2018,8 @@ def _get_gofile_stats():
     """Helper to get and calculate Gofile stats."""
     try:
         uploads = db.get_active_gofile_uploads()
+        if is_db_error(uploads):
+            raise Exception(f"DB read failed: {uploads.error}")
         if not uploads:
             return {
                 "total_files": 0,
@@ -1592,7 +2073,7 @@ def admin_api_status():
     total_remaining = 0
     
     try:
-        db_accounts = db.get_all_server_accounts(DB_SERVER_ID)
+        db_accounts = registry.get_server_accounts(DB_SERVER_ID)
         
         for account in db_accounts:
             account['device_id'] = account.get('current_device_id')
@@ -1658,13 +2139,15 @@ def admin_api_status():
         "system": {
             "status": "online",
             "version": "2.0.0",
-            "queue": JOB_QUEUE.qsize(),
+            "queue": upload_pool.queued(),
             "completed": completed,
             "failed": failed,
             "processing": processing,
             "sessions": len(sessions_list),
             "emergency_stop": EMERGENCY_STOP,
-            "worker_alive": WORKER_THREAD.is_alive() if WORKER_THREAD else False
+            "worker_alive": upload_pool.is_alive(),
+            "upload_pool": upload_pool.stats(),
+            "telegram": tg_client.stats()
         },
         "accounts": {
             "list": accounts_list,
@@ -1687,6 +2170,7 @@ def admin_reset_quota(account_id):
     try:
         success = db.reset_account_quota(account_id)
         if success:
+            registry.update(account_id, quota_used=0)
             log_activity("info", f"Account {account_id} quota reset manually via DB")
             return jsonify({"success": True, "message": f"Account {account_id} quota reset"})
         else:
@@ -1696,23 +2180,34 @@ def admin_reset_quota(account_id):
 
 @app.route('/admin/api/sync-cache', methods=['POST'])
 def admin_sync_cache():
-    """Sync all PikPak accounts to the smart cache"""
+    """Start a smart cache sync job (incremental unless {"full": true})"""
     try:
-        # This can be a long-running process, so maybe run in a thread
-        sync_thread = threading.Thread(
-            target=sync_all_accounts_to_cache,
-            kwargs={
-                'login_func': pikpak_login, 
-                'get_account_func': None,
-                'captcha_func': get_captcha_for_sync
-            }
-        )
-        sync_thread.start()
-        log_activity("info", "Started full cache sync.")
-        return jsonify({"success": True, "message": "Cache sync started in background."})
+        full_sync = bool((request.get_json(silent=True) or {}).get('full', False))
+        
+        job, started = start_sync_job(pikpak_login, get_captcha_for_sync, full_sync=full_sync,
+                                      evict_func=evict_cold_files)
+        if not started:
+            return jsonify({"success": False, "error": "A sync is already running.", "progress": job.progress()}), 409
+        
+        log_activity("info", f"Started {'full' if full_sync else 'incremental'} cache sync {job.id}.")
+        return jsonify({"success": True, "message": "Cache sync started in background.", "job_id": job.id})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/admin/api/sync-cache/status', methods=['GET'])
+def admin_sync_cache_status():
+    """Live progress of the current (or last) smart cache sync job"""
+    return jsonify(get_sync_progress())
+
+@app.route('/admin/api/sync-cache/cancel', methods=['POST'])
+def admin_sync_cache_cancel():
+    """Cancel the running smart cache sync job"""
+    job = cancel_sync_job()
+    if not job:
+        return jsonify({"success": False, "error": "No sync is running."}), 404
+    log_activity("warning", f"Cache sync {job.id} cancelled.")
+    return jsonify({"success": True, "job_id": job.id})
+
 @app.route('/admin/api/cache-stats', methods=['GET'])
 def admin_cache_stats():
     """Get statistics for the smart cache"""
@@ -1722,6 +2217,18 @@ def admin_cache_stats():
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/admin/api/db-metrics', methods=['GET'])
+def admin_db_metrics():
+    """Per-method Supabase latency, error and retry counters (?reset=1 clears them)"""
+    metrics = {
+        "server": SERVER_ID,
+        "methods": db_metrics.snapshot(),
+        "write_behind": db.writes.stats()
+    }
+    if request.args.get('reset') == '1':
+        db_metrics.reset()
+    return jsonify(metrics)
+
 
 # ============================================================
 # FLASK ROUTES
@@ -1735,7 +2242,7 @@ def home():
     num_accounts = 0
     account_ids = []
     try:
-        db_accounts = db.get_all_server_accounts(DB_SERVER_ID)
+        db_accounts = registry.get_server_accounts(DB_SERVER_ID)
         num_accounts = len(db_accounts)
         account_ids = [acc['id'] for acc in db_accounts]
     except Exception as e:
@@ -1750,12 +2257,12 @@ def home():
             "handles": "1080p, 2160p, 4K (large files)"
         },
         "service": "PikPak-Telegram Bridge",
-        "queue": JOB_QUEUE.qsize(),
+        "queue": upload_pool.queued(),
         "jobs": len(JOBS),
         "sessions": len(MESSAGE_SESSIONS),
         "pikpak_accounts": num_accounts,
         "pikpak_account_ids": account_ids,
-        "worker_alive": WORKER_THREAD.is_alive() if WORKER_THREAD else False
+        "worker_alive": upload_pool.is_alive()
     })
 
 @app.route('/static/<path:filename>')
@@ -1912,24 +2419,9 @@ def get_magnet_name(magnet_link):
     return None
 
 def extract_magnet_info(magnet_link):
-    """Extracts name and BTIH hash from a magnet link."""
-    import re
-    from urllib.parse import unquote
-    
-    name_match = re.search(r'dn=([^&]+)', magnet_link)
-    name = unquote(name_match.group(1)).replace('+', ' ') if name_match else None
-    
-    hash_match = re.search(r'xt=urn:btih:([^&]+)', magnet_link, re.IGNORECASE)
-    btih_hash = hash_match.group(1).lower() if hash_match else None
-    
-    return {"name": name, "hash": btih_hash}
-
-def extract_hash(magnet_link):
-    """Extracts the BTIH hash from a magnet link and normalizes it."""
-    match = re.search(r'xt=urn:btih:([a-zA-Z0-9]+)', magnet_link, re.IGNORECASE)
-    if match:
-        return match.group(1).upper()
-    return None
+    """Extracts name and canonical info hash from a magnet link."""
+    magnet_info = parse_magnet(magnet_link)
+    return {"name": magnet_info["name"], "hash": magnet_info["hash"]}
 
 def normalize_name(name):
     """Normalizes a name for fuzzy matching by lowercasing and removing symbols."""
@@ -1958,7 +2450,7 @@ def check_duplicate(magnet_link, account, tokens, user_quality):
                     file_info = pikpak_get_file_info(file['id'], account, tokens)
                     params_url = file_info.get("params", {}).get("url", "")
                     
-                    if magnet_info["hash"] in params_url.lower():
+                    if magnet_matches(magnet_info["hash"], params_url):
                         log_activity("info", f"Found duplicate: {file_name}")
                         download_url = pikpak_get_download_link(file['id'], account, tokens)
                         file_size = int(file.get('size', 0))
@@ -1985,7 +2477,7 @@ def check_duplicate(magnet_link, account, tokens, user_quality):
         return None
 
 def check_duplicate_by_hash(magnet_link, account, tokens, user_quality):
-    """Checks for duplicates by BTIH hash."""
+    """Checks for duplicates by canonical info hash."""
     try:
         print(f"PIKPAK [{SERVER_ID}]: Running robust duplicate check by hash...", flush=True)
         input_hash = extract_hash(magnet_link)
@@ -2002,7 +2494,7 @@ def check_duplicate_by_hash(magnet_link, account, tokens, user_quality):
                 file_info = pikpak_get_file_info(file['id'], account, tokens)
                 params_url = file_info.get("params", {}).get("url", "")
                 
-                is_match = input_hash in params_url.upper()
+                is_match = magnet_matches(input_hash, params_url)
                 
                 if is_match:
                     print(f"PIKPAK [{SERVER_ID}]: ✅ Quota Saved! Found existing file by hash: '{file_name}'", flush=True)
@@ -2034,10 +2526,191 @@ def check_duplicate_by_hash(magnet_link, account, tokens, user_quality):
         return None
 
 
+# ============================================================
+# SMART CACHE HIT PATH
+# ============================================================
+
+REPLICA_FAILURES = {}  # account_id -> time of last failed cache hit
+REPLICA_FAILURE_PENALTY = 600  # seconds a failing account is ranked last
+
+def rank_cache_replicas(replicas):
+    """
+    Orders cache replicas best-first by account health and token warmth.
+    Returns a list of (replica, account) pairs; replicas whose account is
+    missing or has no device_id are dropped.
+    """
+    accounts = {acc['id']: acc for acc in registry.get_many({r['account_id'] for r in replicas})}
+    now = time.time()
+    ranked = []
+    
+    for replica in replicas:
+        account = accounts.get(replica['account_id'])
+        if not account or not account.get('current_device_id'):
+            continue
+        
+        tokens = get_account_tokens(account['id'])
+        token_warm = bool(tokens.get('access_token')) and now < tokens.get('expires_at', 0)
+        recently_failed = now - REPLICA_FAILURES.get(account['id'], 0) < REPLICA_FAILURE_PENALTY
+        
+        rank = (
+            account.get('status') != 'active',
+            recently_failed,
+            not token_warm,
+            account.get('storage_percent') or 0
+        )
+        ranked.append((rank, replica, account))
+    
+    ranked.sort(key=lambda item: item[0])
+    return [(replica, account) for _, replica, account in ranked]
+
+def serve_from_cache_replicas(replicas, record_hit=True):
+    """
+    Tries each replica in rank order until one yields a fresh download link.
+    Replicas whose file is gone are marked as trash. Returns the response
+    dict, or None if every replica failed.
+    """
+    for replica, account in rank_cache_replicas(replicas):
+        account_id = account['id']
+        pikpak_file_id = replica['file_id']
+        
+        try:
+            # Map device_id for compatibility, which is needed for login
+            account['device_id'] = account.get('current_device_id')
+            
+            # Login to the account to get fresh tokens
+            tokens = ensure_logged_in(account)
+            
+            # Generate a fresh download link
+            download_url = pikpak_get_download_link(pikpak_file_id, account, tokens)
+            
+            REPLICA_FAILURES.pop(account_id, None)
+            if record_hit:
+                record_cache_hit(replica)
+            return {
+                "file_id": pikpak_file_id,
+                "result": True,
+                "file_name": replica.get('file_name', 'Unknown'),
+                "file_size": replica.get('file_size', 0),
+                "url": download_url,
+                "account_used": account_id,
+                "server": SERVER_ID,
+                "cached": True
+            }
+            
+        except Exception as e:
+            error_msg = str(e)
+            REPLICA_FAILURES[account_id] = time.time()
+            print(f"CACHE [{SERVER_ID}]: ⚠️ Replica on account {account_id} failed: {error_msg}", flush=True)
+            
+            if "file_not_found" in error_msg or "file_deleted" in error_msg:
+                mark_files_as_trash(account_id, [pikpak_file_id])
+                drop_warm_links(account_id, [pikpak_file_id])
+    
+    return None
+
+# ============================================================
+# PRE-WARMED LINKS (top-N popular cache entries)
+# ============================================================
+
+WARM_LINKS = {}  # magnet_hash -> {"result": response dict, "expires_at": ts}
+WARM_LINKS_LOCK = threading.Lock()
+WARM_LINKS_TOP_N = int(os.environ.get("WARM_LINKS_TOP_N", 20))
+WARM_LINKS_INTERVAL = int(os.environ.get("WARM_LINKS_INTERVAL", 300))  # seconds between refresh passes
+WARM_LINK_TTL = int(os.environ.get("WARM_LINK_TTL", 1800))  # assumed link lifetime when the URL carries none
+WARM_LINK_MARGIN = 120  # never hand out a link this close to expiry
+
+def _warm_link_expiry(url):
+    """When a prefetched link should stop being served"""
+    now = time.time()
+    expires_at = now + WARM_LINK_TTL
+    try:
+        from urllib.parse import urlparse, parse_qs
+        query = parse_qs(urlparse(url).query)
+        for key in ("e", "expire", "expires"):
+            if key in query and query[key][0].isdigit():
+                expires_at = min(expires_at, int(query[key][0]))
+                break
+    except Exception:
+        pass
+    return expires_at - WARM_LINK_MARGIN
+
+def get_warm_link(magnet_hash):
+    """Returns a copy of the prefetched response for this hash, or None"""
+    if not magnet_hash:
+        return None
+    with WARM_LINKS_LOCK:
+        entry = WARM_LINKS.get(magnet_hash)
+        if not entry:
+            return None
+        if time.time() >= entry["expires_at"]:
+            del WARM_LINKS[magnet_hash]
+            return None
+        return dict(entry["result"])
+
+def drop_warm_links(account_id, file_ids):
+    """Forget prefetched links pointing at files that are gone"""
+    file_ids = set(file_ids)
+    with WARM_LINKS_LOCK:
+        for magnet_hash in [h for h, e in WARM_LINKS.items()
+                            if e["result"]["account_used"] == account_id and e["result"]["file_id"] in file_ids]:
+            del WARM_LINKS[magnet_hash]
+
+def refresh_warm_links():
+    """Prefetch links for the current top-N and drop the ones that fell out"""
+    popular = get_popular_magnet_hashes(WARM_LINKS_TOP_N)
+    now = time.time()
+    refreshed = 0
+    
+    for magnet_hash in popular:
+        with WARM_LINKS_LOCK:
+            entry = WARM_LINKS.get(magnet_hash)
+        # Still good until the next pass - leave it
+        if entry and entry["expires_at"] - now > WARM_LINKS_INTERVAL:
+            continue
+        
+        replicas = get_cache_replicas_by_hash(magnet_hash)
+        result = serve_from_cache_replicas(replicas, record_hit=False) if replicas else None
+        with WARM_LINKS_LOCK:
+            if result:
+                WARM_LINKS[magnet_hash] = {"result": result, "expires_at": _warm_link_expiry(result["url"])}
+                refreshed += 1
+            else:
+                WARM_LINKS.pop(magnet_hash, None)
+    
+    with WARM_LINKS_LOCK:
+        for magnet_hash in [h for h in WARM_LINKS if h not in popular]:
+            del WARM_LINKS[magnet_hash]
+    
+    if refreshed:
+        print(f"CACHE [{SERVER_ID}]: 🔥 Pre-warmed {refreshed} links ({len(WARM_LINKS)}/{len(popular)} popular titles ready)", flush=True)
+
+def warm_links_loop():
+    """Background thread keeping popular download links fresh"""
+    while True:
+        try:
+            refresh_warm_links()
+        except Exception as e:
+            print(f"CACHE [{SERVER_ID}] WARM LINKS ERROR: {e}", flush=True)
+        time.sleep(WARM_LINKS_INTERVAL)
+
 @app.route('/add-magnet', methods=['POST'])
 def add_magnet():
     """Add magnet to PikPak and return download link"""
     global EMERGENCY_STOP
+    
+    # Popular titles are answered from memory, without login or API calls
+    magnet_hash = extract_hash((request.json or {}).get('magnet'))
+    warm_result = get_warm_link(magnet_hash)
+    if warm_result:
+        record_cache_lookup(True)
+        record_cache_hit({
+            'magnet_hash': magnet_hash,
+            'account_id': warm_result['account_used'],
+            'file_id': warm_result['file_id']
+        })
+        log_activity("success", f"Cache Hit (pre-warmed): {warm_result['file_name']}")
+        return jsonify(warm_result)
+    
     with MAGNET_ADD_LOCK:
         # Add random delay to prevent simultaneous requests
         import random
@@ -2048,50 +2721,18 @@ def add_magnet():
         if not magnet:
             return jsonify({"error": "Missing magnet parameter"}), 400
 
-        # Smart Cache Check
-        cached_file = check_smart_cache(magnet)
-        if cached_file:
-            print(f"CACHE [{SERVER_ID}]: ✅ Hit for magnet. Generating fresh link.", flush=True)
-            log_activity("success", f"Cache Hit: {cached_file.get('file_name', 'Unknown')}")
-            try:
-                # 1. Get account details from DB
-                account_id = cached_file['account_id']
-                
-                # Fetch account details directly from Supabase
-                acc_response = db.client.table('accounts').select('*').eq('id', account_id).limit(1).execute()
-                account = acc_response.data[0] if (acc_response.data and len(acc_response.data) > 0) else None
-                
-                if not account:
-                    raise Exception(f"Account {account_id} for cached file not found in DB.")
-
-                # Map device_id for compatibility, which is needed for login
-                account['device_id'] = account.get('current_device_id')
-                if not account['device_id']:
-                     raise Exception(f"Account {account_id} has no device_id.")
-
-                # 2. Login to the account to get fresh tokens
-                tokens = ensure_logged_in(account)
-
-                # 3. Generate a fresh download link
-                pikpak_file_id = cached_file['file_id']
-                download_url = pikpak_get_download_link(pikpak_file_id, account, tokens)
-
-                return jsonify({
-                    "result": True,
-                    "file_name": cached_file.get('file_name', 'Unknown'),
-                    "file_size": cached_file.get('file_size', 0),
-                    "url": download_url,
-                    "account_used": cached_file['account_id'],
-                    "server": SERVER_ID,
-                    "cached": True
-                })
-            except Exception as e:
-                print(f"CACHE [{SERVER_ID}]: ❌ Failed to process cache hit: {e}", flush=True)
-                log_activity("error", f"Cache hit processing failed: {e}")
-                # Return an error instead of falling through to a normal download
-                return jsonify({"error": f"Failed to retrieve cached file link: {str(e)}", "retry": False, "server": SERVER_ID}), 500
+        # Smart Cache Check (fails over across every account holding the file)
+        replicas = get_cache_replicas(magnet)
+        if replicas:
+            print(f"CACHE [{SERVER_ID}]: ✅ Hit for magnet ({len(replicas)} replicas). Generating fresh link.", flush=True)
+            cached_result = serve_from_cache_replicas(replicas)
+            if cached_result:
+                log_activity("success", f"Cache Hit: {cached_result['file_name']}")
+                return jsonify(cached_result)
+            
+            print(f"CACHE [{SERVER_ID}]: ❌ All {len(replicas)} replicas failed, falling back to fresh download", flush=True)
+            log_activity("warning", f"Cache hit unusable on all {len(replicas)} accounts, downloading fresh")
 
-        
         exhausted_accounts = []
         max_total_retries = 8
         attempt = 0
@@ -2160,6 +2801,7 @@ def add_magnet():
                 file_size = int(video_file.get("size", 0))
                 # SUCCESS: Increment quota in DB
                 db.increment_quota(account["id"])
+                registry.increment(account["id"], 'quota_used')
                 
                 detected_quality = detect_quality(user_quality, magnet, file_size)
                 
@@ -2169,12 +2811,13 @@ def add_magnet():
 
                 # Save to Smart Cache
                 save_to_smart_cache(
+                    file_id=video_file.get("id", folder_id),
+                    account_id=account["id"],
                     magnet_link=magnet,
                     file_name=video_file.get("name", file_name),
-                    direct_link=download_url,
-                    size=file_size,
-                    pikpak_account_id=account["id"],
-                    pikpak_file_id=video_file.get("id", folder_id)
+                    file_size=file_size,
+                    file_hash=video_file.get("hash"),
+                    parent_id=video_file.get("parent_id")
                 )
                 
                 return jsonify({
@@ -2199,7 +2842,9 @@ def add_magnet():
 
                 if last_account_id and last_account_id not in exhausted_accounts:
                     if "Captcha failed" in error_msg:
-                        db.rotate_device(last_account_id)
+                        new_device_id = db.rotate_device(last_account_id)
+                        if new_device_id:
+                            registry.update(last_account_id, current_device_id=new_device_id)
                         exhausted_accounts.append(last_account_id)
                         continue 
                     if "task_daily_create_limit" in error_msg:
@@ -2406,6 +3051,25 @@ def cleanup_sessions():
 cleanup_thread = threading.Thread(target=cleanup_sessions, daemon=True)
 cleanup_thread.start()
 
+# Keep the shared account registry fresh (also picks up the other server's changes)
+registry_thread = registry.start_refresher()
+
+# Mirror pikpak_files into local SQLite so cache lookups survive Supabase outages
+mirror_thread = start_cache_mirror()
+
+# Build the smart cache Bloom filter in the background and keep it fresh
+bloom_thread = start_bloom_refresher()
+
+# Keep download links for the most requested titles ready in memory
+warm_links_thread = threading.Thread(target=warm_links_loop, daemon=True)
+warm_links_thread.start()
+
+# Pick up a smart cache sync that was interrupted by a restart
+try:
+    resume_interrupted_sync(pikpak_login, get_captcha_for_sync, evict_func=evict_cold_files)
+except Exception as e:
+    print(f"CACHE [{SERVER_ID}]: Failed to resume interrupted sync: {e}", flush=True)
+
 # ============================================================
 # MAIN
 # ============================================================
@@ -2454,6 +3118,8 @@ def gofile_status_list():
     """Get active Gofile uploads for dashboard"""
     try:
         active_files = db.get_active_gofile_uploads()
+        if is_db_error(active_files):
+            return jsonify({"success": False, "error": f"DB read failed: {active_files.error}"}), 503
         return jsonify({
             "success": True,
             "count": len(active_files),
@@ -2474,7 +3140,10 @@ def gofile_keep_alive():
     failed_count = 0
 
     try:
-        files = db.get_active_gofile_uploads()
+        files = db.get_active_gofile_uploads(columns='id,file_id,folder_code,server,file_name')
+        if is_db_error(files):
+            print(f"GOFILE: Could not load active files: {files.error}", flush=True)
+            return {"success": False, "error": f"DB read failed: {files.error}"}, 503
         if not files:
             print("GOFILE: No active files to keep alive.", flush=True)
             return {
@@ -2587,7 +3256,7 @@ if __name__ == '__main__':
     
     # Run startup checks
     try:
-        db_accounts = db.get_all_server_accounts(DB_SERVER_ID)
+        db_accounts = registry.get_server_accounts(DB_SERVER_ID)
         print(f"📦 Loaded {len(db_accounts)} PikPak accounts from DB", flush=True)
         check_all_accounts_quota()
     except Exception as e:
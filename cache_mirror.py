@@ -0,0 +1,332 @@
+"""
+Local SQLite (WAL) mirror of the Supabase pikpak_files table.
+Kept current by write-through from the smart cache and periodic pulls of
+changed rows, so cache lookups stay local and keep working while
+Supabase is slow or unreachable.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, List, Iterable, Callable, Set
+from supabase_client import db, is_db_error, summarize_cache_groups
+
+# ============================================
+# CONFIGURATION
+# ============================================
+
+MIRROR_PATH = os.environ.get("SMART_CACHE_MIRROR_PATH", "/tmp/smart_cache_mirror.db")
+MIRROR_PULL_INTERVAL = int(os.environ.get("SMART_CACHE_MIRROR_PULL_INTERVAL", 30))  # seconds
+MIRROR_FULL_RELOAD_INTERVAL = int(os.environ.get("SMART_CACHE_MIRROR_FULL_RELOAD", 3600))  # seconds
+MIRROR_PAGE_SIZE = 1000  # rows per range() page
+# Re-read rows this far behind the watermark - other servers' clocks drift
+MIRROR_PULL_OVERLAP = 60  # seconds
+SQLITE_IN_CHUNK = 500  # values per IN (...) - under SQLite's host parameter limit
+
+MIRROR_COLUMNS = (
+    'id', 'magnet_hash', 'account_id', 'file_id', 'file_hash', 'file_name',
+    'file_size', 'parent_id', 'is_trash', 'updated_at', 'hit_count', 'last_hit_at'
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pikpak_files (
+    id INTEGER,
+    magnet_hash TEXT NOT NULL,
+    account_id INTEGER NOT NULL,
+    file_id TEXT NOT NULL,
+    file_hash TEXT,
+    file_name TEXT,
+    file_size INTEGER,
+    parent_id TEXT,
+    is_trash INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT,
+    hit_count INTEGER DEFAULT 0,
+    last_hit_at TEXT,
+    PRIMARY KEY (magnet_hash, account_id, file_id)
+);
+CREATE INDEX IF NOT EXISTS idx_pikpak_files_magnet_hash ON pikpak_files (magnet_hash);
+CREATE INDEX IF NOT EXISTS idx_pikpak_files_account_file ON pikpak_files (account_id, file_id);
+CREATE TABLE IF NOT EXISTS mirror_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+# ============================================
+# CACHE MIRROR
+# ============================================
+
+class CacheMirror:
+    """
+    One SQLite file shared by every worker process (WAL lets readers run
+    alongside the writer). Each thread gets its own connection.
+    """
+
+    def __init__(self, path: str = MIRROR_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._pull_lock = threading.Lock()
+        self.pulls = 0
+        self.pull_failures = 0
+        self.rows_pulled = 0
+        self.last_pull_at = None
+        # Called as on_pull(rows, full, new_live_hashes) after each applied pull;
+        # new_live_hashes are hashes with no live row in the mirror before it
+        # (empty on a full pull, where the whole table was replaced)
+        self.on_pull: Optional[Callable[[List[Dict], bool, Set[str]], None]] = None
+        self._init_schema()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        self._conn().executescript(SCHEMA)
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._conn().execute("SELECT value FROM mirror_meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else None
+
+    def _set_meta(self, conn: sqlite3.Connection, key: str, value: str):
+        conn.execute(
+            "INSERT INTO mirror_meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+
+    @property
+    def ready(self) -> bool:
+        """True once a full load has completed (survives restarts)"""
+        return self._get_meta('full_load_at') is not None
+
+    # ---------- Reads ----------
+
+    def get_replicas(self, magnet_hash: str) -> List[Dict]:
+        rows = self._conn().execute(
+            "SELECT * FROM pikpak_files WHERE magnet_hash = ? AND is_trash = 0",
+            (magnet_hash,)
+        ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def get_entries_by_account(self, account_id: int) -> List[Dict]:
+        rows = self._conn().execute(
+            "SELECT file_id, magnet_hash, file_name, file_size FROM pikpak_files "
+            "WHERE account_id = ? AND is_trash = 0",
+            (account_id,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_active_magnet_hashes(self) -> List[str]:
+        rows = self._conn().execute(
+            "SELECT DISTINCT magnet_hash FROM pikpak_files WHERE is_trash = 0"
+        ).fetchall()
+        return [row['magnet_hash'] for row in rows]
+
+    def get_hit_counts(self, limit: int) -> Dict[str, int]:
+        """Total hit_count per magnet_hash for the `limit` most hit hashes"""
+        rows = self._conn().execute(
+            "SELECT magnet_hash, SUM(hit_count) AS hits FROM pikpak_files "
+            "WHERE is_trash = 0 AND hit_count > 0 "
+            "GROUP BY magnet_hash ORDER BY hits DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return {row['magnet_hash']: row['hits'] for row in rows}
+
+    def cache_stats(self) -> Dict:
+        """Same shape as db.get_smart_cache_stats, from one local GROUP BY"""
+        rows = self._conn().execute(
+            "SELECT account_id, is_trash, COUNT(*) AS files, "
+            "COALESCE(SUM(file_size), 0) AS size_bytes, COALESCE(SUM(hit_count), 0) AS hits "
+            "FROM pikpak_files GROUP BY account_id, is_trash"
+        ).fetchall()
+        return summarize_cache_groups([dict(row) for row in rows])
+
+    # ---------- Writes (write-through from the smart cache) ----------
+
+    def upsert(self, rows: Iterable[Dict]):
+        records = [self._to_record(row) for row in rows]
+        if not records:
+            return
+        placeholders = ", ".join("?" for _ in MIRROR_COLUMNS)
+        updates = ", ".join(
+            f"{col} = COALESCE(excluded.{col}, pikpak_files.{col})"
+            for col in MIRROR_COLUMNS
+            if col not in ('magnet_hash', 'account_id', 'file_id')
+        )
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                f"INSERT INTO pikpak_files ({', '.join(MIRROR_COLUMNS)}) VALUES ({placeholders}) "
+                f"ON CONFLICT(magnet_hash, account_id, file_id) DO UPDATE SET {updates}",
+                records
+            )
+
+    def mark_trash(self, account_id: int, file_ids: List[str]):
+        if not file_ids:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "UPDATE pikpak_files SET is_trash = 1, updated_at = ? WHERE account_id = ? AND file_id = ?",
+                [(now, account_id, file_id) for file_id in file_ids]
+            )
+
+    def rekey(self, account_id: int, changes: List[tuple]):
+        """Mirror of db.rekey_cache_hashes: (file_id, old_hash, new_hash) tuples"""
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            for file_id, old_hash, new_hash in changes:
+                conn.execute(
+                    "UPDATE OR IGNORE pikpak_files SET magnet_hash = ? "
+                    "WHERE account_id = ? AND file_id = ? AND magnet_hash = ?",
+                    (new_hash, account_id, file_id, old_hash)
+                )
+                conn.execute(
+                    "DELETE FROM pikpak_files WHERE account_id = ? AND file_id = ? AND magnet_hash = ?",
+                    (account_id, file_id, old_hash)
+                )
+
+    def delete_trashed(self, account_id: int = None):
+        conn = self._conn()
+        with conn:
+            if account_id:
+                conn.execute("DELETE FROM pikpak_files WHERE is_trash = 1 AND account_id = ?", (account_id,))
+            else:
+                conn.execute("DELETE FROM pikpak_files WHERE is_trash = 1")
+
+    # ---------- Pulls from Supabase ----------
+
+    def pull(self, full: bool = False) -> bool:
+        """
+        Fetch rows changed since the last pull (or everything when `full`,
+        which also drops rows deleted upstream). Keeps the current mirror
+        on failure.
+        """
+        with self._pull_lock:
+            since = None
+            if not full:
+                watermark = self._get_meta('watermark')
+                if watermark is None:
+                    full = True
+                else:
+                    since = (datetime.fromisoformat(watermark) - timedelta(seconds=MIRROR_PULL_OVERLAP)).isoformat()
+
+            started = time.time()
+            rows = db.get_cache_rows_since(since, page_size=MIRROR_PAGE_SIZE)
+            if is_db_error(rows):
+                self.pull_failures += 1
+                return False
+
+            records = [self._to_record(row) for row in rows]
+            watermark = max((row['updated_at'] for row in rows if row.get('updated_at')), default=None)
+
+            conn = self._conn()
+            new_live_hashes = set()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if not full:
+                    new_live_hashes = {row['magnet_hash'] for row in rows if not row.get('is_trash')}
+                    new_live_hashes -= self._live_hashes(conn, new_live_hashes)
+                if full:
+                    conn.execute("DELETE FROM pikpak_files")
+                if records:
+                    conn.executemany(
+                        f"INSERT OR REPLACE INTO pikpak_files ({', '.join(MIRROR_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' for _ in MIRROR_COLUMNS)})",
+                        records
+                    )
+                if watermark:
+                    self._set_meta(conn, 'watermark', watermark)
+                if full:
+                    self._set_meta(conn, 'full_load_at', str(time.time()))
+
+            self.pulls += 1
+            self.rows_pulled += len(rows)
+            self.last_pull_at = time.time()
+            if self.on_pull:
+                self.on_pull(rows, full, new_live_hashes)
+            kind = "Full load" if full else "Pull"
+            print(f"🪞 Cache Mirror: {kind} applied {len(rows)} rows in {(time.time() - started) * 1000:.0f}ms")
+            return True
+
+    @staticmethod
+    def _live_hashes(conn: sqlite3.Connection, hashes: Set[str]) -> Set[str]:
+        """Which of `hashes` already have a non-trashed row"""
+        found = set()
+        hashes = list(hashes)
+        for start in range(0, len(hashes), SQLITE_IN_CHUNK):
+            chunk = hashes[start:start + SQLITE_IN_CHUNK]
+            found.update(r[0] for r in conn.execute(
+                f"SELECT DISTINCT magnet_hash FROM pikpak_files WHERE is_trash = 0 "
+                f"AND magnet_hash IN ({', '.join('?' for _ in chunk)})",
+                chunk
+            ))
+        return found
+
+    def needs_full_reload(self) -> bool:
+        full_load_at = self._get_meta('full_load_at')
+        return full_load_at is None or time.time() - float(full_load_at) >= MIRROR_FULL_RELOAD_INTERVAL
+
+    def _sync_loop(self, interval: int):
+        while True:
+            try:
+                self.pull(full=self.needs_full_reload())
+            except Exception as e:
+                self.pull_failures += 1
+                print(f"❌ Cache Mirror: Pull error: {e}")
+            time.sleep(interval)
+
+    def start_syncer(self, interval: int = MIRROR_PULL_INTERVAL) -> threading.Thread:
+        """Pull now and keep pulling every `interval` seconds in the background"""
+        thread = threading.Thread(target=self._sync_loop, args=(interval,), daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> Dict:
+        full_load_at = self._get_meta('full_load_at')
+        return {
+            'ready': full_load_at is not None,
+            'path': self.path,
+            'rows': self._conn().execute("SELECT COUNT(*) FROM pikpak_files").fetchone()[0],
+            'watermark': self._get_meta('watermark'),
+            'full_load_age_seconds': round(time.time() - float(full_load_at), 1) if full_load_at else None,
+            'last_pull_age_seconds': round(time.time() - self.last_pull_at, 1) if self.last_pull_at else None,
+            'pulls': self.pulls,
+            'pull_failures': self.pull_failures,
+            'rows_pulled': self.rows_pulled
+        }
+
+    # ---------- Helpers ----------
+
+    @staticmethod
+    def _to_record(row: Dict) -> tuple:
+        record = []
+        for col in MIRROR_COLUMNS:
+            value = row.get(col)
+            if col == 'is_trash':
+                value = 1 if value else 0
+            record.append(value)
+        return tuple(record)
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict:
+        data = dict(row)
+        data['is_trash'] = bool(data['is_trash'])
+        return data
+
+
+# Singleton instance
+cache_mirror = CacheMirror()
@@ -0,0 +1,315 @@
+"""
+In-memory stand-in for the Supabase client, for benchmarks and offline runs.
+Implements the slice of the PostgREST query builder SupabaseDB uses
+(select/insert/update/upsert/delete with eq, in_, lt, gt, gte, match,
+order, limit, range and exact counts) plus the rotate_account_device and
+smart_cache_stats RPCs, with optional injected latency per request.
+
+Enable with SUPABASE_BACKEND=memory. Optional:
+    SUPABASE_FAKE_LATENCY_MS  base latency added to every execute() (default 0)
+    SUPABASE_FAKE_JITTER_MS   +/- uniform jitter on top (default 0)
+    SUPABASE_FAKE_SEED        JSON file of {"table": [rows...]} to preload
+    SUPABASE_FAKE_RANDOM_SEED seed for jitter and generated device ids (default 0)
+"""
+
+import os
+import copy
+import json
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from typing import Optional, Dict, List, Any
+
+# ============================================
+# CONFIGURATION
+# ============================================
+
+FAKE_LATENCY_MS = float(os.getenv("SUPABASE_FAKE_LATENCY_MS", 0))
+FAKE_JITTER_MS = float(os.getenv("SUPABASE_FAKE_JITTER_MS", 0))
+FAKE_SEED_FILE = os.getenv("SUPABASE_FAKE_SEED")
+FAKE_RANDOM_SEED = int(os.getenv("SUPABASE_FAKE_RANDOM_SEED", 0))
+
+# Column defaults the real schema fills in on insert
+TABLE_DEFAULTS = {
+    'accounts': {'status': 'active', 'quota_used': 0, 'storage_used_bytes': 0, 'storage_limit_bytes': 0, 'storage_percent': 0},
+    'pikpak_files': {'is_trash': False, 'hit_count': 0, 'last_hit_at': None},
+    'gofile_uploads': {'status': 'active', 'last_keep_alive': None},
+    'telegram_files': {'reposts': 0},
+}
+
+
+class FakeResponse:
+    """Same shape as postgrest's APIResponse (data + count)"""
+
+    def __init__(self, data: Any, count: Optional[int] = None):
+        self.data = data
+        self.count = count
+
+
+# ============================================
+# QUERY BUILDER
+# ============================================
+
+class FakeQuery:
+    def __init__(self, client: "FakeSupabaseClient", table: str):
+        self.client = client
+        self.table = table
+        self._action = 'select'
+        self._columns = '*'
+        self._count = None
+        self._payload = None
+        self._on_conflict = None
+        self._filters = []
+        self._order = []
+        self._limit = None
+        self._range = None
+
+    # ---------- Actions ----------
+
+    def select(self, columns: str = '*', count: Optional[str] = None):
+        self._action, self._columns, self._count = 'select', columns, count
+        return self
+
+    def insert(self, rows):
+        self._action, self._payload = 'insert', rows
+        return self
+
+    def update(self, fields: Dict):
+        self._action, self._payload = 'update', fields
+        return self
+
+    def upsert(self, rows, on_conflict: str = 'id'):
+        self._action, self._payload, self._on_conflict = 'upsert', rows, on_conflict
+        return self
+
+    def delete(self):
+        self._action = 'delete'
+        return self
+
+    # ---------- Filters ----------
+
+    def eq(self, column: str, value):
+        self._filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def neq(self, column: str, value):
+        self._filters.append(lambda row: row.get(column) != value)
+        return self
+
+    def lt(self, column: str, value):
+        self._filters.append(lambda row: row.get(column) is not None and row.get(column) < value)
+        return self
+
+    def lte(self, column: str, value):
+        self._filters.append(lambda row: row.get(column) is not None and row.get(column) <= value)
+        return self
+
+    def gt(self, column: str, value):
+        self._filters.append(lambda row: row.get(column) is not None and row.get(column) > value)
+        return self
+
+    def gte(self, column: str, value):
+        self._filters.append(lambda row: row.get(column) is not None and row.get(column) >= value)
+        return self
+
+    def in_(self, column: str, values):
+        values = list(values)
+        self._filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def match(self, query: Dict):
+        for column, value in query.items():
+            self.eq(column, value)
+        return self
+
+    # ---------- Modifiers ----------
+
+    def order(self, column: str, desc: bool = False):
+        self._order.append((column, desc))
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def range(self, start: int, end: int):
+        self._range = (start, end)
+        return self
+
+    def execute(self) -> FakeResponse:
+        self.client._inject_latency()
+        with self.client._lock:
+            return getattr(self, f"_execute_{self._action}")()
+
+    # ---------- Execution ----------
+
+    def _matches(self, row: Dict) -> bool:
+        return all(f(row) for f in self._filters)
+
+    def _project(self, row: Dict) -> Dict:
+        if self._columns.strip() == '*':
+            return copy.deepcopy(row)
+        return {col.strip(): copy.deepcopy(row.get(col.strip())) for col in self._columns.split(',')}
+
+    def _execute_select(self) -> FakeResponse:
+        rows = [row for row in self.client._rows(self.table) if self._matches(row)]
+        total = len(rows)
+
+        # Apply orders last-to-first so the first one is the primary key (stable sort)
+        for column, desc in reversed(self._order):
+            present = [r for r in rows if r.get(column) is not None]
+            missing = [r for r in rows if r.get(column) is None]
+            present.sort(key=lambda r: r[column], reverse=desc)
+            # Postgres: NULLS LAST ascending, NULLS FIRST descending
+            rows = missing + present if desc else present + missing
+
+        if self._range:
+            rows = rows[self._range[0]:self._range[1] + 1]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+
+        return FakeResponse([self._project(row) for row in rows], total if self._count else None)
+
+    def _execute_insert(self) -> FakeResponse:
+        rows = self._payload if isinstance(self._payload, list) else [self._payload]
+        return FakeResponse([copy.deepcopy(self.client._insert(self.table, row)) for row in rows])
+
+    def _execute_update(self) -> FakeResponse:
+        updated = []
+        for row in self.client._rows(self.table):
+            if self._matches(row):
+                row.update(copy.deepcopy(self._payload))
+                updated.append(copy.deepcopy(row))
+        return FakeResponse(updated)
+
+    def _execute_upsert(self) -> FakeResponse:
+        rows = self._payload if isinstance(self._payload, list) else [self._payload]
+        keys = [k.strip() for k in self._on_conflict.split(',')]
+        result = []
+        for new in rows:
+            existing = next(
+                (row for row in self.client._rows(self.table) if all(row.get(k) == new.get(k) for k in keys)),
+                None
+            )
+            if existing:
+                existing.update(copy.deepcopy(new))
+                result.append(copy.deepcopy(existing))
+            else:
+                result.append(copy.deepcopy(self.client._insert(self.table, new)))
+        return FakeResponse(result)
+
+    def _execute_delete(self) -> FakeResponse:
+        table = self.client._rows(self.table)
+        deleted = [row for row in table if self._matches(row)]
+        table[:] = [row for row in table if not self._matches(row)]
+        return FakeResponse(deleted)
+
+
+class FakeRPC:
+    def __init__(self, client: "FakeSupabaseClient", name: str, params: Dict):
+        self.client = client
+        self.name = name
+        self.params = params or {}
+
+    def execute(self) -> FakeResponse:
+        self.client._inject_latency()
+        handler = getattr(self.client, f"_rpc_{self.name}", None)
+        if handler is None:
+            raise Exception(f"Fake Supabase: unknown RPC '{self.name}'")
+        with self.client._lock:
+            return FakeResponse(handler(**self.params))
+
+
+# ============================================
+# CLIENT
+# ============================================
+
+class FakeSupabaseClient:
+    """Drop-in for supabase.Client as far as SupabaseDB is concerned"""
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, seed: Dict[str, List[Dict]] = None,
+                 random_seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self._random = random.Random(random_seed)
+        self._tables: Dict[str, List[Dict]] = {}
+        self._next_id: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self.requests = 0
+        for table, rows in (seed or {}).items():
+            self.seed(table, rows)
+
+    @classmethod
+    def from_env(cls) -> "FakeSupabaseClient":
+        seed = None
+        if FAKE_SEED_FILE:
+            with open(FAKE_SEED_FILE, 'r') as f:
+                seed = json.load(f)
+        return cls(FAKE_LATENCY_MS, FAKE_JITTER_MS, seed, FAKE_RANDOM_SEED)
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: Dict = None) -> FakeRPC:
+        return FakeRPC(self, name, params)
+
+    def seed(self, table: str, rows: List[Dict]):
+        """Preload rows (ids are kept if given)"""
+        with self._lock:
+            for row in rows:
+                self._insert(table, row)
+
+    def dump(self, table: str) -> List[Dict]:
+        with self._lock:
+            return copy.deepcopy(self._rows(table))
+
+    # ---------- Internals ----------
+
+    def _inject_latency(self):
+        self.requests += 1
+        if self.latency_ms or self.jitter_ms:
+            delay = self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)
+            time.sleep(max(delay, 0) / 1000)
+
+    def _rows(self, table: str) -> List[Dict]:
+        return self._tables.setdefault(table, [])
+
+    def _insert(self, table: str, row: Dict) -> Dict:
+        record = dict(TABLE_DEFAULTS.get(table, {}))
+        record.update(copy.deepcopy(row))
+        if record.get('id') is None:
+            record['id'] = self._next_id.get(table, 1)
+        self._next_id[table] = max(self._next_id.get(table, 1), record['id'] + 1)
+        record.setdefault('created_at', datetime.now(timezone.utc).isoformat())
+        self._rows(table).append(record)
+        return record
+
+    def _rpc_smart_cache_stats(self) -> List[Dict]:
+        groups = {}
+        for row in self._rows('pikpak_files'):
+            key = (row.get('account_id'), bool(row.get('is_trash')))
+            group = groups.setdefault(key, {'account_id': key[0], 'is_trash': key[1], 'files': 0, 'size_bytes': 0, 'hits': 0})
+            group['files'] += 1
+            group['size_bytes'] += row.get('file_size') or 0
+            group['hits'] += row.get('hit_count') or 0
+        return list(groups.values())
+
+    def _rpc_record_cache_hits(self, hits: List[Dict]) -> None:
+        for hit in hits:
+            for row in self._rows('pikpak_files'):
+                if (row.get('magnet_hash'), row.get('account_id'), row.get('file_id')) == \
+                        (hit['magnet_hash'], hit['account_id'], hit['file_id']):
+                    row['hit_count'] = (row.get('hit_count') or 0) + hit['hits']
+                    row['last_hit_at'] = max(filter(None, (row.get('last_hit_at'), hit['last_hit_at'])))
+                    row['updated_at'] = datetime.now(timezone.utc).isoformat()
+        return None
+
+    def _rpc_rotate_account_device(self, target_account_id: int) -> str:
+        account = next((row for row in self._rows('accounts') if row.get('id') == target_account_id), None)
+        if account is None:
+            raise Exception(f"Fake Supabase: account {target_account_id} not found")
+        new_id = '%032x' % self._random.getrandbits(128)
+        account['current_device_id'] = new_id
+        account['updated_at'] = datetime.now(timezone.utc).isoformat()
+        return new_id
@@ -0,0 +1,141 @@
+"""
+Canonical magnet link parsing.
+Every cache key, duplicate check and recovery match goes through here, so
+the same torrent always maps to the same hash whatever form the magnet
+uses (hex or base32 btih, v2 btmh, mixed case).
+
+Canonical form:
+    v1 (btih): 40-char upper-case hex SHA-1 info hash
+    v2 (btmh): 64-char upper-case hex SHA-256 info hash (multihash prefix stripped)
+Hybrid magnets carrying both use the v1 hash, which is what PikPak and
+existing cache rows are keyed on.
+"""
+
+import re
+import base64
+import binascii
+from urllib.parse import unquote_plus
+from typing import Optional, Dict, List
+
+# ============================================
+# CONFIGURATION
+# ============================================
+
+BTIH_PATTERN = re.compile(r'xt=urn:btih:([a-z0-9]+)', re.IGNORECASE)
+BTMH_PATTERN = re.compile(r'xt=urn:btmh:([a-f0-9]+)', re.IGNORECASE)
+NAME_PATTERN = re.compile(r'[?&]dn=([^&]+)', re.IGNORECASE)
+
+# Multihash prefix for SHA2-256 (code 0x12, length 0x20 bytes)
+SHA256_MULTIHASH_PREFIX = '1220'
+
+
+# ============================================
+# NORMALIZATION
+# ============================================
+
+def normalize_btih(raw: Optional[str]) -> Optional[str]:
+    """
+    Canonical hex form of a v1 info hash given as 40-char hex or
+    32-char base32. Returns None if it is neither.
+    """
+    if not raw:
+        return None
+    raw = raw.strip()
+
+    if len(raw) == 40 and re.fullmatch(r'[0-9a-fA-F]{40}', raw):
+        return raw.upper()
+
+    if len(raw) == 32:
+        try:
+            return base64.b32decode(raw.upper()).hex().upper()
+        except (binascii.Error, ValueError):
+            return None
+
+    return None
+
+
+def normalize_btmh(raw: Optional[str]) -> Optional[str]:
+    """Canonical hex form of a v2 info hash given as a SHA-256 multihash"""
+    if not raw:
+        return None
+    raw = raw.strip().lower()
+
+    if len(raw) == 68 and raw.startswith(SHA256_MULTIHASH_PREFIX):
+        raw = raw[len(SHA256_MULTIHASH_PREFIX):]
+    if len(raw) == 64 and re.fullmatch(r'[0-9a-f]{64}', raw):
+        return raw.upper()
+
+    return None
+
+
+def normalize_hash(raw: Optional[str]) -> Optional[str]:
+    """
+    Canonical form of any stored or supplied hash (hex/base32 v1 or v2).
+    Anything unrecognised is only upper-cased, so it still matches itself.
+    """
+    if not raw:
+        return None
+    raw = raw.strip()
+    # 32 hex digits is an md5 content hash (sync fallback), not base32
+    if len(raw) == 32 and re.fullmatch(r'[0-9a-fA-F]{32}', raw):
+        return raw.upper()
+    return normalize_btih(raw) or normalize_btmh(raw) or raw.upper()
+
+
+# ============================================
+# PARSING
+# ============================================
+
+def parse_magnet(magnet_link: Optional[str]) -> Dict:
+    """
+    Parse a magnet link.
+
+    Returns:
+        Dict with:
+            hash: canonical cache key (v1 if present, else v2), or None
+            hashes: every canonical hash the link carries (v1 first)
+            name: display name (dn), or None
+    """
+    result = {"hash": None, "hashes": [], "name": None}
+    if not magnet_link:
+        return result
+
+    hashes: List[str] = []
+    for match in BTIH_PATTERN.finditer(magnet_link):
+        btih = normalize_btih(match.group(1))
+        if btih and btih not in hashes:
+            hashes.append(btih)
+    for match in BTMH_PATTERN.finditer(magnet_link):
+        btmh = normalize_btmh(match.group(1))
+        if btmh and btmh not in hashes:
+            hashes.append(btmh)
+
+    name_match = NAME_PATTERN.search(magnet_link)
+    if name_match:
+        result["name"] = unquote_plus(name_match.group(1))
+
+    result["hashes"] = hashes
+    result["hash"] = hashes[0] if hashes else None
+    return result
+
+
+def extract_hash(magnet_link: Optional[str]) -> Optional[str]:
+    """Canonical info hash of a magnet link, or None"""
+    return parse_magnet(magnet_link)["hash"]
+
+
+def magnet_matches(magnet_hash: Optional[str], url: Optional[str]) -> bool:
+    """
+    True if `url` (e.g. a PikPak file's params.url) is a magnet for the
+    torrent identified by `magnet_hash`, whichever encoding either side uses.
+    """
+    if not magnet_hash or not url:
+        return False
+
+    target = normalize_hash(magnet_hash)
+    hashes = parse_magnet(url)["hashes"]
+    if hashes:
+        return target in hashes
+
+    # Not a parsable magnet - fall back to a plain substring check
+    return target in url.upper()
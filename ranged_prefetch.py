@@ -0,0 +1,235 @@
+"""
+Parallel ranged prefetch for SmartStream.
+Downloads upcoming byte ranges of a file over several pooled connections
+into a bounded reorder buffer and hands them out in order through
+readinto(), so a CDN that throttles per connection no longer caps upload
+speed. The number of connections in use is hill-climbed against measured
+throughput.
+"""
+
+import os
+import time
+import threading
+from typing import Optional, Dict
+import requests
+
+# ============================================
+# CONFIGURATION
+# ============================================
+
+# 1 disables parallel prefetch (single streaming GET)
+STREAM_CONNECTIONS = int(os.environ.get("STREAM_CONNECTIONS", 1))
+STREAM_MAX_CONNECTIONS = int(os.environ.get("STREAM_MAX_CONNECTIONS", 6))
+STREAM_SEGMENT_SIZE = int(os.environ.get("STREAM_SEGMENT_SIZE_MB", 4)) * 1024 * 1024
+STREAM_PREFETCH_SEGMENTS = int(os.environ.get("STREAM_PREFETCH_SEGMENTS", 8))  # reorder buffer bound
+STREAM_SEGMENT_RETRIES = 3
+STREAM_TUNE_INTERVAL = 3.0  # seconds between connection-count adjustments
+STREAM_TUNE_THRESHOLD = 0.10  # throughput change that counts as better / worse
+
+
+class RangedPrefetcher:
+    """
+    File-like source (readinto only) for byte range [start, total_size).
+    Segment i covers start + i * segment_size. Worker threads claim the next
+    unfetched segment while fewer than `max_buffered` are waiting to be read.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        url: str,
+        total_size: int,
+        headers: Dict = None,
+        start: int = 0,
+        connections: int = None,
+        max_connections: int = STREAM_MAX_CONNECTIONS,
+        segment_size: int = STREAM_SEGMENT_SIZE,
+        max_buffered: int = STREAM_PREFETCH_SEGMENTS,
+        log_prefix: str = "STREAM"
+    ):
+        self.session = session
+        self.url = url
+        self.total_size = total_size
+        self.headers = dict(headers or {})
+        self.start = start
+        self.segment_size = segment_size
+        self.max_connections = max(1, max_connections)
+        self.connections = min(max(1, connections or STREAM_CONNECTIONS), self.max_connections)
+        self.max_buffered = max(self.max_connections, max_buffered)
+        self.segment_count = max(0, -(-(total_size - start) // segment_size))
+        self.log_prefix = log_prefix
+
+        self._cond = threading.Condition()
+        self._segments: Dict[int, memoryview] = {}
+        self._next_claim = 0
+        self._read_index = 0
+        self._read_offset = 0
+        self._closed = False
+        self.error: Optional[Exception] = None
+
+        # Auto-tuning
+        self._window_bytes = 0
+        self._window_started = time.monotonic()
+        self._window_blocked = False
+        self._last_rate = None
+        self._direction = 1
+        self.bytes_fetched = 0
+        self.segment_retries = 0
+        self.peak_connections = self.connections
+
+        self._threads = [
+            threading.Thread(target=self._worker, args=(i,), daemon=True)
+            for i in range(self.max_connections)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    # ---------- Consumer side ----------
+
+    def readinto(self, b) -> int:
+        """Copy the next in-order bytes into b; 0 at end of range"""
+        out = memoryview(b).cast('B')
+        with self._cond:
+            while True:
+                if self._read_index >= self.segment_count:
+                    return 0
+                segment = self._segments.get(self._read_index)
+                if segment is not None:
+                    break
+                if self.error is not None:
+                    raise self.error
+                if self._closed:
+                    return 0
+                self._cond.wait()
+
+        n = min(len(out), len(segment) - self._read_offset)
+        out[:n] = segment[self._read_offset:self._read_offset + n]
+        self._read_offset += n
+
+        if self._read_offset >= len(segment):
+            with self._cond:
+                del self._segments[self._read_index]
+                self._read_index += 1
+                self._read_offset = 0
+                self._cond.notify_all()
+        return n
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._segments.clear()
+            self._cond.notify_all()
+
+    # ---------- Fetch side ----------
+
+    def _claim(self, worker: int) -> Optional[int]:
+        """Next segment for this worker, or None when done / closed"""
+        with self._cond:
+            while True:
+                if self._closed or self.error is not None or self._next_claim >= self.segment_count:
+                    return None
+                if worker < self.connections:
+                    if self._next_claim - self._read_index < self.max_buffered:
+                        index = self._next_claim
+                        self._next_claim += 1
+                        return index
+                    # Reorder buffer full: consumer-bound, don't read it as a slow network
+                    self._window_blocked = True
+                self._cond.wait(1)
+
+    def _worker(self, worker: int):
+        while True:
+            index = self._claim(worker)
+            if index is None:
+                return
+            try:
+                data = self._fetch(index)
+            except Exception as e:
+                with self._cond:
+                    if self.error is None:
+                        self.error = e
+                        print(f"{self.log_prefix}: ❌ Segment {index} failed: {e}", flush=True)
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                if self._closed:
+                    return
+                self._segments[index] = data
+                self.bytes_fetched += len(data)
+                self._window_bytes += len(data)
+                self._tune()
+                self._cond.notify_all()
+
+    def _fetch(self, index: int) -> memoryview:
+        first = self.start + index * self.segment_size
+        last = min(first + self.segment_size, self.total_size) - 1
+        buf = bytearray(last - first + 1)
+        view = memoryview(buf)
+        got = 0
+
+        for attempt in range(STREAM_SEGMENT_RETRIES + 1):
+            if self._closed:
+                raise IOError("stream closed")
+            try:
+                headers = {**self.headers, 'Range': f'bytes={first + got}-{last}'}
+                with self.session.get(self.url, headers=headers, stream=True, timeout=(10, 60)) as resp:
+                    if resp.status_code != 206:
+                        raise IOError(f"expected 206 for range request, got {resp.status_code}")
+                    resp.raw.decode_content = True
+                    while got < len(buf):
+                        n = resp.raw.readinto(view[got:])
+                        if not n:
+                            break
+                        got += n
+                if got == len(buf):
+                    return view
+                raise IOError(f"short segment: {got}/{len(buf)} bytes")
+            except Exception as e:
+                if attempt >= STREAM_SEGMENT_RETRIES:
+                    raise
+                self.segment_retries += 1
+                print(f"{self.log_prefix}: ⚠️ Segment {index} retry {attempt + 1} from +{got}: {e}", flush=True)
+                time.sleep(1 + attempt)
+
+    def _tune(self):
+        """Hill-climb the active connection count on throughput (called under the lock)"""
+        now = time.monotonic()
+        elapsed = now - self._window_started
+        if elapsed < STREAM_TUNE_INTERVAL:
+            return
+
+        rate = self._window_bytes / elapsed
+        blocked = self._window_blocked
+        self._window_bytes = 0
+        self._window_started = now
+        self._window_blocked = False
+
+        # Upload side is the bottleneck - more connections won't help
+        if blocked:
+            self._last_rate = rate
+            return
+
+        if self._last_rate is not None:
+            if rate < self._last_rate * (1 - STREAM_TUNE_THRESHOLD):
+                self._direction = -self._direction
+            elif rate < self._last_rate * (1 + STREAM_TUNE_THRESHOLD):
+                self._last_rate = rate
+                return  # plateau - hold
+
+        target = min(max(1, self.connections + self._direction), self.max_connections)
+        if target != self.connections:
+            print(f"{self.log_prefix}: 🔧 Connections {self.connections} -> {target} ({rate / 1024 / 1024:.1f} MB/s)", flush=True)
+            self.connections = target
+            self.peak_connections = max(self.peak_connections, target)
+        self._last_rate = rate
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'connections': self.connections,
+                'peak_connections': self.peak_connections,
+                'buffered_segments': len(self._segments),
+                'bytes_fetched': self.bytes_fetched,
+                'segment_retries': self.segment_retries,
+                'error': str(self.error) if self.error else None
+            }
@@ -3,12 +3,26 @@ Smart Cache System for PikPak Deduplication
 Checks database before downloading to avoid duplicate downloads.
 """
 
-import re
+import os
+import json
+import math
+import hashlib
 import time
 import random
+import threading
 import requests
-from typing import Optional, Dict, List, Callable
-from supabase_client import db
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError:  # No cross-process resume guard without it (non-POSIX)
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from typing import Optional, Dict, List, Callable, Iterable, Tuple
+from supabase_client import db, is_db_error
+from account_registry import registry
+from cache_mirror import cache_mirror
+from magnet_parser import extract_hash, normalize_hash
 
 # ============================================
 # CONFIGURATION
@@ -17,59 +31,472 @@ from supabase_client import db
 PIKPAK_API_DRIVE = "https://api-drive.mypikpak.com"
 PIKPAK_CLIENT_ID = "YUMx5nI8ZU8Ap8pm"
 
+# In-process front cache for smart cache lookups
+FRONT_CACHE_MAX_ENTRIES = int(os.environ.get("SMART_CACHE_FRONT_MAX", 5000))
+FRONT_CACHE_TTL = int(os.environ.get("SMART_CACHE_FRONT_TTL", 600))             # seconds (hits)
+FRONT_CACHE_NEGATIVE_TTL = int(os.environ.get("SMART_CACHE_NEGATIVE_TTL", 60))  # seconds (misses)
+
+# Bloom filter over all active magnet hashes (definite misses skip the DB)
+BLOOM_FALSE_POSITIVE_RATE = float(os.environ.get("SMART_CACHE_BLOOM_FP", 0.01))
+BLOOM_MIN_CAPACITY = 10000
+BLOOM_REBUILD_INTERVAL = int(os.environ.get("SMART_CACHE_BLOOM_REBUILD", 900))  # seconds
+BLOOM_PAGE_SIZE = 1000
+
+# Per-account sync watermarks (incremental sync)
+SYNC_STATE_FILE = os.environ.get("SMART_CACHE_SYNC_STATE_FILE", "/tmp/smart_cache_sync_state.json")
+SYNC_STATE_LOCK = threading.Lock()
+
+# Batched writes during sync (through db.bulk_upsert_cache)
+SYNC_BATCH_SIZE = int(os.environ.get("SMART_CACHE_SYNC_BATCH_SIZE", 200))
+SYNC_BATCH_MAX_RETRIES = int(os.environ.get("SMART_CACHE_SYNC_BATCH_RETRIES", 3))
+
+# Multi-account sync concurrency
+SYNC_MAX_CONCURRENCY = int(os.environ.get("SMART_CACHE_SYNC_CONCURRENCY", 3))  # accounts at once
+SYNC_ACCOUNT_MIN_INTERVAL = 1.0   # seconds between PikPak detail calls, per account
+SYNC_ACCOUNT_MAX_INTERVAL = 2.0
+SYNC_ACCOUNT_STAGGER = 5.0        # max random delay before each account starts
+
+# Sync jobs (progress, cancellation, crash resume)
+SYNC_CHECKPOINT_FILE = os.environ.get("SMART_CACHE_SYNC_CHECKPOINT_FILE", "/tmp/smart_cache_sync_checkpoint.json")
+# Held (flock) by the one worker process resuming an interrupted job
+SYNC_RESUME_LOCK_FILE = SYNC_CHECKPOINT_FILE + ".lock"
+
+# Aggregate cache stats are recomputed at most this often
+CACHE_STATS_TTL = int(os.environ.get("SMART_CACHE_STATS_TTL", 30))  # seconds
+
+# Hit tracking and popularity-driven eviction
+HIT_FLUSH_INTERVAL = int(os.environ.get("SMART_CACHE_HIT_FLUSH_INTERVAL", 30))  # seconds
+POPULARITY_HALF_LIFE_DAYS = float(os.environ.get("SMART_CACHE_POPULARITY_HALF_LIFE", 7))
+EVICTION_TARGET_PERCENT = float(os.environ.get("SMART_CACHE_EVICTION_TARGET", 80))
+# A sync evicts from accounts whose storage is at least this full
+EVICTION_TRIGGER_PERCENT = float(os.environ.get("SMART_CACHE_EVICTION_TRIGGER", 90))
+
 
 # ============================================
-# HELPER FUNCTIONS
+# IN-PROCESS FRONT CACHE (LRU + TTL)
 # ============================================
 
-def extract_hash(magnet_link: str) -> Optional[str]:
+class SmartCacheLRU:
     """
-    Extracts the BTIH hash from a magnet link and normalizes it.
+    Bounded LRU with per-entry TTL, sitting in front of the smart cache DB lookup.
+    Stores both hits (the list of replica rows) and misses (an empty list)
+    so repeated lookups for the same hash don't pay a Supabase round trip.
     """
-    if not magnet_link:
-        return None
-    match = re.search(r'xt=urn:btih:([a-zA-Z0-9]+)', magnet_link, re.IGNORECASE)
-    if match:
-        return match.group(1).upper()
-    return None
+
+    def __init__(self, max_entries: int, ttl: int, negative_ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # magnet_hash -> (expires_at, [replica rows])
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, magnet_hash: str):
+        """
+        Returns (found, replicas). found is False when the hash is not cached
+        (or expired), in which case the caller must go to the DB.
+        """
+        with self._lock:
+            entry = self._entries.get(magnet_hash)
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            expires_at, replicas = entry
+            if time.time() >= expires_at:
+                del self._entries[magnet_hash]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(magnet_hash)
+            if replicas:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return True, list(replicas)
+
+    def put(self, magnet_hash: str, replicas: List[Dict]):
+        """Cache the replica rows, or an empty list to remember a miss for negative_ttl seconds."""
+        replicas = list(replicas or [])
+        ttl = self.ttl if replicas else self.negative_ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[magnet_hash] = (time.time() + ttl, replicas)
+            self._entries.move_to_end(magnet_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, magnet_hash: str):
+        with self._lock:
+            if self._entries.pop(magnet_hash, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_files(self, account_id: int, file_ids: Iterable[str]):
+        """Drop entries with a replica pointing at any of these files on this account."""
+        file_ids = set(file_ids)
+        if not file_ids:
+            return
+
+        with self._lock:
+            stale = [
+                h for h, (_, replicas) in self._entries.items()
+                if any(
+                    row.get('account_id') == account_id and row.get('file_id') in file_ids
+                    for row in replicas
+                )
+            ]
+            for h in stale:
+                del self._entries[h]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'hit_rate': round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0
+            }
+
+
+front_cache = SmartCacheLRU(FRONT_CACHE_MAX_ENTRIES, FRONT_CACHE_TTL, FRONT_CACHE_NEGATIVE_TTL)
+
+
+# ============================================
+# BLOOM FILTER OF KNOWN MAGNET HASHES
+# ============================================
+
+class MagnetBloomFilter:
+    """
+    Fixed-size Bloom filter sized for `capacity` items at `fp_rate`.
+    Uses double hashing over a single blake2b digest.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = max(1, capacity)
+        self.fp_rate = fp_rate
+        self.num_bits = max(8, int(math.ceil(-self.capacity * math.log(fp_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / self.capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def estimated_fp_rate(self) -> float:
+        """Theoretical false-positive rate for the current fill level."""
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self.bits)
+
+
+class MagnetHashIndex:
+    """
+    Owns the live Bloom filter: bulk-loads it from pikpak_files, rebuilds it
+    periodically, and answers "might this hash be cached?".
+    Until the first build succeeds every lookup is treated as a possible hit.
+    """
+
+    def __init__(self, fp_rate: float, min_capacity: int):
+        self.fp_rate = fp_rate
+        self.min_capacity = min_capacity
+        self._filter: Optional[MagnetBloomFilter] = None
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._rebuild_scheduled = False
+        self._added_during_rebuild = []
+        self.definite_misses = 0
+        self.possible_hits = 0
+        self.false_positives = 0
+        self.last_build_time = None
+        self.last_build_seconds = None
+
+    @property
+    def ready(self) -> bool:
+        return self._filter is not None
+
+    def might_contain(self, magnet_hash: str) -> bool:
+        bloom = self._filter
+        if bloom is None:
+            return True
+        hit = magnet_hash in bloom
+        with self._lock:
+            if hit:
+                self.possible_hits += 1
+            else:
+                self.definite_misses += 1
+        return hit
+
+    def record_false_positive(self):
+        """Called when the filter said "maybe" but the DB had no row."""
+        with self._lock:
+            self.false_positives += 1
+
+    def add(self, magnet_hash: str):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(magnet_hash)
+                # Rebuild early once we outgrow the sizing assumption (one at a time)
+                if (self._filter.count > self._filter.capacity
+                        and not self._rebuilding and not self._rebuild_scheduled):
+                    self._rebuild_scheduled = True
+                    threading.Thread(target=self.rebuild, daemon=True).start()
+            if self._rebuilding:
+                self._added_during_rebuild.append(magnet_hash)
+
+    def rebuild(self) -> bool:
+        """Bulk load all active hashes into a fresh filter and swap it in."""
+        with self._lock:
+            self._rebuild_scheduled = False
+            if self._rebuilding:
+                return False
+            self._rebuilding = True
+            self._added_during_rebuild = []
+
+        started = time.time()
+        try:
+            if cache_mirror.ready:
+                hashes = cache_mirror.get_active_magnet_hashes()
+            else:
+                hashes = db.get_active_magnet_hashes(page_size=BLOOM_PAGE_SIZE)
+            if is_db_error(hashes):
+                print("⚠️ Smart Cache: Bloom filter rebuild failed, keeping previous filter")
+                return False
+
+            bloom = MagnetBloomFilter(max(len(hashes) * 2, self.min_capacity), self.fp_rate)
+            for h in hashes:
+                bloom.add(h)
+
+            with self._lock:
+                for h in self._added_during_rebuild:
+                    bloom.add(h)
+                self._filter = bloom
+                self.last_build_time = time.time()
+                self.last_build_seconds = round(self.last_build_time - started, 2)
+
+            print(f"🌸 Smart Cache: Bloom filter built with {bloom.count} hashes "
+                  f"({bloom.memory_bytes / 1024:.1f} KB) in {self.last_build_seconds}s")
+            return True
+
+        finally:
+            with self._lock:
+                self._rebuilding = False
+                self._added_during_rebuild = []
+
+    def stats(self) -> Dict:
+        bloom = self._filter
+        if bloom is None:
+            return {'ready': False}
+
+        with self._lock:
+            possible = self.possible_hits
+            definite_misses = self.definite_misses
+            false_positives = self.false_positives
+        return {
+            'ready': True,
+            'items': bloom.count,
+            'capacity': bloom.capacity,
+            'num_bits': bloom.num_bits,
+            'num_hashes': bloom.num_hashes,
+            'memory_bytes': bloom.memory_bytes,
+            'target_fp_rate': bloom.fp_rate,
+            'estimated_fp_rate': round(bloom.estimated_fp_rate(), 6),
+            'observed_fp_rate': round(false_positives / possible, 4) if possible else 0.0,
+            'definite_misses': definite_misses,
+            'possible_hits': possible,
+            'false_positives': false_positives,
+            'last_build_time': self.last_build_time,
+            'last_build_seconds': self.last_build_seconds
+        }
+
+
+hash_index = MagnetHashIndex(BLOOM_FALSE_POSITIVE_RATE, BLOOM_MIN_CAPACITY)
+
+
+def _bloom_refresh_loop():
+    """Build the Bloom filter now, then rebuild it every BLOOM_REBUILD_INTERVAL seconds."""
+    while True:
+        try:
+            hash_index.rebuild()
+        except Exception as e:
+            print(f"❌ Smart Cache: Bloom filter refresh error: {e}")
+        time.sleep(BLOOM_REBUILD_INTERVAL)
+
+
+def _on_mirror_pull(rows: List[Dict], full: bool, new_live_hashes: set):
+    """Carry rows written by other servers into the front cache and Bloom filter"""
+    if full:
+        # Whole table replaced: rebuild the filter from it instead of re-adding
+        # every row (duplicates would inflate its count past capacity)
+        front_cache.clear()
+        threading.Thread(target=hash_index.rebuild, daemon=True).start()
+        return
+    for row in rows:
+        front_cache.invalidate(row['magnet_hash'])
+    for magnet_hash in new_live_hashes:
+        hash_index.add(magnet_hash)
+
+
+def start_cache_mirror() -> threading.Thread:
+    """Start pulling pikpak_files into the local SQLite mirror"""
+    cache_mirror.on_pull = _on_mirror_pull
+    return cache_mirror.start_syncer()
+
+
+def start_bloom_refresher() -> threading.Thread:
+    """Start the background thread that builds and periodically rebuilds the Bloom filter."""
+    thread = threading.Thread(target=_bloom_refresh_loop, daemon=True)
+    thread.start()
+    return thread
 
 
 # ============================================
 # SMART CACHE CHECK (Use Before Download)
 # ============================================
 
-def check_smart_cache(magnet_link: str) -> Optional[Dict]:
+class CacheLookupMetrics:
+    """Process-wide lookup / hit counters for the cache hit rate"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def record(self, hit: bool):
+        with self._lock:
+            self.lookups += 1
+            if hit:
+                self.hits += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': round(self.hits / self.lookups, 4) if self.lookups else None
+            }
+
+
+lookup_metrics = CacheLookupMetrics()
+
+
+def record_cache_lookup(hit: bool):
+    """Count a request-level cache lookup (for lookups that skip get_cache_replicas)"""
+    lookup_metrics.record(hit)
+
+
+def get_cache_replicas(magnet_link: str) -> List[Dict]:
     """
-    Check if file already exists in any PikPak account.
+    Find every live copy of this magnet across all PikPak accounts.
     Call this BEFORE pikpak_add_magnet().
     
     Args:
         magnet_link: The magnet URL
         
     Returns:
-        Dict with account_id, file_id, file_name if found
-        None if not in cache
+        List of cache rows (account_id, file_id, file_name, ...), one per
+        account holding the file; empty if not in cache
     """
     magnet_hash = extract_hash(magnet_link)
     
     if not magnet_hash:
         print("⚠️ Smart Cache: Could not extract hash from magnet")
-        return None
+        lookup_metrics.record(False)
+        return []
     
+    replicas = get_cache_replicas_by_hash(magnet_hash)
+    lookup_metrics.record(bool(replicas))
+    return replicas
+
+
+def get_cache_replicas_by_hash(magnet_hash: str) -> List[Dict]:
+    """Same as get_cache_replicas for an already canonical magnet hash"""
     print(f"🔍 Smart Cache: Checking for hash {magnet_hash[:16]}...")
     
-    # Check database
-    cached = db.check_smart_cache(magnet_hash)
+    # Check in-process front cache first
+    found, replicas = front_cache.get(magnet_hash)
+    if found:
+        if replicas:
+            print(f"⚡ Smart Cache HIT (memory): {replicas[0].get('file_name', 'Unknown')} ({len(replicas)} replicas)")
+            return replicas
+        print("❌ Smart Cache MISS (memory): Hash recently not found")
+        return []
     
-    if cached:
-        print(f"✅ Smart Cache HIT!")
-        print(f"   📁 File: {cached.get('file_name', 'Unknown')}")
-        print(f"   👤 Account: {cached.get('account_id')}")
-        print(f"   🆔 File ID: {cached.get('file_id')}")
-        return cached
+    # Bloom filter: a definite miss never needs a DB round trip
+    if not hash_index.might_contain(magnet_hash):
+        print("❌ Smart Cache MISS (bloom): Hash not in any account")
+        return []
     
-    print(f"❌ Smart Cache MISS: Hash not found in database")
-    return None
+    # Local mirror when loaded, otherwise the database
+    if cache_mirror.ready:
+        replicas = cache_mirror.get_replicas(magnet_hash)
+    else:
+        replicas = db.get_smart_cache_replicas(magnet_hash)
+        if is_db_error(replicas):
+            # Don't remember a miss we never actually observed
+            print("⚠️ Smart Cache: Lookup failed, treating as miss without caching it")
+            return []
+    front_cache.put(magnet_hash, replicas)
+    if not replicas and hash_index.ready:
+        hash_index.record_false_positive()
+    
+    if replicas:
+        print(f"✅ Smart Cache HIT! {len(replicas)} replica(s)")
+        print(f"   📁 File: {replicas[0].get('file_name', 'Unknown')}")
+        print(f"   👤 Accounts: {[r.get('account_id') for r in replicas]}")
+        return replicas
+    
+    print("❌ Smart Cache MISS: Hash not found in database")
+    return []
+
+
+def check_smart_cache(magnet_link: str) -> Optional[Dict]:
+    """
+    Check if file already exists in any PikPak account.
+    
+    Args:
+        magnet_link: The magnet URL
+        
+    Returns:
+        Dict with account_id, file_id, file_name of the first replica if found
+        None if not in cache
+    """
+    replicas = get_cache_replicas(magnet_link)
+    return replicas[0] if replicas else None
 
 
 def save_to_smart_cache(
@@ -101,7 +528,7 @@ def save_to_smart_cache(
     """
     # Get hash from either source
     if magnet_hash:
-        final_hash = magnet_hash.upper()
+        final_hash = normalize_hash(magnet_hash)
     elif magnet_link:
         final_hash = extract_hash(magnet_link)
     else:
@@ -124,6 +551,12 @@ def save_to_smart_cache(
     
     result = db.save_to_smart_cache(data)
     
+    # Drop any stale entry (including a remembered miss) for this hash
+    front_cache.invalidate(final_hash)
+    if result:
+        cache_mirror.upsert([result])
+        hash_index.add(final_hash)
+    
     if result:
         print(f"💾 Smart Cache: Saved {file_name or file_id}")
         return True
@@ -131,11 +564,230 @@ def save_to_smart_cache(
     return False
 
 
+# ============================================
+# HIT TRACKING
+# ============================================
+
+class HitRecorder:
+    """
+    Counts cache hits in memory and writes them to pikpak_files
+    (hit_count, last_hit_at) in batches from a background thread,
+    so the hit path never waits on the DB.
+    """
+
+    def __init__(self, flush_interval: int = HIT_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending: Dict[tuple, Dict] = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.recorded = 0
+        self.flushed = 0
+        self.flush_failures = 0
+
+    def record(self, replica: Dict):
+        """Count one hit on this cache row"""
+        key = (replica['magnet_hash'], replica['account_id'], replica['file_id'])
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            entry = self._pending.setdefault(key, {'hits': 0, 'last_hit_at': now})
+            entry['hits'] += 1
+            entry['last_hit_at'] = now
+            self.recorded += 1
+        self._ensure_thread()
+
+    def pending_hits(self, account_id: int) -> Dict[str, int]:
+        """Unflushed hits per file_id for one account (so planners see fresh counts)"""
+        with self._lock:
+            return {k[2]: v['hits'] for k, v in self._pending.items() if k[1] == account_id}
+
+    def pending_by_row(self) -> Dict[tuple, int]:
+        """Unflushed hits keyed by (magnet_hash, account_id, file_id)"""
+        with self._lock:
+            return {k: v['hits'] for k, v in self._pending.items()}
+
+    def flush(self) -> bool:
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return True
+
+        hits = [
+            {'magnet_hash': k[0], 'account_id': k[1], 'file_id': k[2], **v}
+            for k, v in batch.items()
+        ]
+        if db.record_cache_hits(hits):
+            self.flushed += sum(h['hits'] for h in hits)
+            return True
+
+        # Put them back so the next flush retries
+        self.flush_failures += 1
+        with self._lock:
+            for key, value in batch.items():
+                entry = self._pending.setdefault(key, {'hits': 0, 'last_hit_at': value['last_hit_at']})
+                entry['hits'] += value['hits']
+                entry['last_hit_at'] = max(entry['last_hit_at'], value['last_hit_at'])
+        return False
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Smart Cache: Hit flush error: {e}")
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+                    self._thread.start()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pending = sum(v['hits'] for v in self._pending.values())
+        return {
+            'recorded': self.recorded,
+            'flushed': self.flushed,
+            'pending': pending,
+            'flush_failures': self.flush_failures
+        }
+
+
+hit_recorder = HitRecorder()
+
+
+def record_cache_hit(replica: Dict):
+    """Count a served cache hit (non-blocking; written to the DB in batches)"""
+    hit_recorder.record(replica)
+
+
+def get_popular_magnet_hashes(limit: int) -> List[str]:
+    """
+    The `limit` most requested magnet hashes, by stored hit count plus
+    hits not yet flushed to the DB.
+    """
+    if cache_mirror.ready:
+        counts = cache_mirror.get_hit_counts(limit * 2)
+    else:
+        counts = db.get_popular_magnet_hashes(limit * 2)
+        if is_db_error(counts):
+            counts = {}
+    
+    for (magnet_hash, _, _), hits in hit_recorder.pending_by_row().items():
+        counts[magnet_hash] = counts.get(magnet_hash, 0) + hits
+    
+    ranked = sorted((h for h, c in counts.items() if c > 0), key=lambda h: counts[h], reverse=True)
+    return ranked[:limit]
+
+
+# ============================================
+# POPULARITY-DRIVEN EVICTION
+# ============================================
+
+def popularity_score(entry: Dict, now: datetime = None) -> float:
+    """
+    Hit count decayed by time since the last hit (half-life of
+    POPULARITY_HALF_LIFE_DAYS). Never-hit files score 0.
+    """
+    hits = entry.get('hit_count') or 0
+    if hits <= 0:
+        return 0.0
+
+    now = now or datetime.now(timezone.utc)
+    last_hit = _parse_time(entry.get('last_hit_at')) or _parse_time(entry.get('updated_at'))
+    if last_hit is None:
+        return float(hits)
+    if last_hit.tzinfo is None:
+        last_hit = last_hit.replace(tzinfo=timezone.utc)
+
+    age_days = max((now - last_hit).total_seconds() / 86400, 0)
+    return hits * 0.5 ** (age_days / POPULARITY_HALF_LIFE_DAYS)
+
+
+def needs_eviction(account_id: int) -> bool:
+    """True if the account's last known storage usage is at EVICTION_TRIGGER_PERCENT or above"""
+    stats = registry.get(account_id) or {}
+    used = stats.get('storage_used_bytes') or 0
+    limit = stats.get('storage_limit_bytes') or 0
+    return limit > 0 and used * 100 / limit >= EVICTION_TRIGGER_PERCENT
+
+
+def plan_cache_eviction(
+    account_id: int,
+    used_bytes: int,
+    limit_bytes: int,
+    target_percent: float = None
+) -> Dict:
+    """
+    Pick which cached files to delete from an account to bring its storage
+    down to target_percent, least popular first, keeping hot titles resident.
+    
+    Args:
+        account_id: Account to plan for
+        used_bytes: Current storage usage
+        limit_bytes: Storage limit
+        target_percent: Desired usage after eviction (default SMART_CACHE_EVICTION_TARGET)
+        
+    Returns:
+        Dict with bytes_to_free, bytes_planned, files (to delete) and kept count
+    """
+    target_percent = EVICTION_TARGET_PERCENT if target_percent is None else target_percent
+    bytes_to_free = max(int(used_bytes - limit_bytes * target_percent / 100), 0)
+
+    plan = {
+        'account_id': account_id,
+        'target_percent': target_percent,
+        'bytes_to_free': bytes_to_free,
+        'bytes_planned': 0,
+        'files': [],
+        'kept': 0
+    }
+
+    if bytes_to_free <= 0:
+        return plan
+
+    entries = db.get_cache_entries_for_eviction(account_id)
+    if is_db_error(entries):
+        raise Exception(f"Could not load cache entries for account {account_id}")
+
+    # Fold in hits that haven't been flushed yet
+    pending = hit_recorder.pending_hits(account_id)
+    now = datetime.now(timezone.utc)
+    for entry in entries:
+        entry['hit_count'] = (entry.get('hit_count') or 0) + pending.get(entry['file_id'], 0)
+        entry['score'] = popularity_score(entry, now)
+
+    # Coldest first; among equally cold files, least recently touched first
+    entries.sort(key=lambda e: (e['score'], e.get('last_hit_at') or e.get('updated_at') or ''))
+
+    for entry in entries:
+        if plan['bytes_planned'] >= bytes_to_free:
+            plan['kept'] += 1
+            continue
+        plan['files'].append({
+            'file_id': entry['file_id'],
+            'file_name': entry.get('file_name'),
+            'file_size': entry.get('file_size') or 0,
+            'hit_count': entry['hit_count'],
+            'score': round(entry['score'], 3)
+        })
+        plan['bytes_planned'] += entry.get('file_size') or 0
+
+    return plan
+
+
 # ============================================
 # PIKPAK API FUNCTIONS (For Sync)
 # ============================================
 
-def pikpak_list_files_paginated(parent_id: str, account: Dict, tokens: Dict, captcha_func: Callable = None) -> List[Dict]:
+def pikpak_list_files_paginated(
+    parent_id: str,
+    account: Dict,
+    tokens: Dict,
+    captcha_func: Callable = None,
+    strict: bool = False
+) -> List[Dict]:
     """
     List ALL files in a folder with pagination support.
     
@@ -144,6 +796,8 @@ def pikpak_list_files_paginated(parent_id: str, account: Dict, tokens: Dict, cap
         account: Account dict with device_id
         tokens: Auth tokens with access_token
         captcha_func: Function to generate captcha token (action, device_id, user_id)
+        strict: Raise instead of returning a partial list if any page fails.
+                Sync uses this so a failed listing never looks like deleted files.
         
     Returns:
         List of all file objects
@@ -186,6 +840,9 @@ def pikpak_list_files_paginated(parent_id: str, account: Dict, tokens: Dict, cap
             response = requests.get(url, headers=headers, params=params, timeout=30)
             data = response.json()
             
+            if response.status_code != 200 or "error" in data:
+                raise Exception(f"API returned {response.status_code}: {data.get('error', 'Unknown')}")
+            
             files = data.get("files", [])
             all_files.extend(files)
             
@@ -200,6 +857,8 @@ def pikpak_list_files_paginated(parent_id: str, account: Dict, tokens: Dict, cap
             
         except Exception as e:
             print(f"   ❌ Error fetching page {page_count}: {e}")
+            if strict:
+                raise
             break
     
     print(f"   ✅ Total files found: {len(all_files)}")
@@ -272,7 +931,7 @@ def extract_hash_from_file_info(file_info: Dict) -> Optional[str]:
         if magnet_hash:
             return magnet_hash
     
-    # Fallback: Try hash field
+    # Fallback: Try hash field (PikPak's content hash, not an info hash - kept as is)
     file_hash = file_info.get("hash")
     if file_hash:
         return file_hash.upper()
@@ -285,6 +944,501 @@ def extract_hash_from_file_info(file_info: Dict) -> Optional[str]:
     return None
 
 
+def extract_hash_from_listing(file: Dict) -> Optional[str]:
+    """
+    Extract the magnet hash from a file list entry, when the listing
+    carries params.url. Unlike extract_hash_from_file_info this never
+    falls back to the content hash, since list entries rarely include params
+    and the fallback would store the wrong key.
+    """
+    params_url = (file.get("params") or {}).get("url", "")
+    return extract_hash(params_url) if params_url else None
+
+
+# ============================================
+# SYNC BATCH WRITER
+# ============================================
+
+class SyncWriteMetrics:
+    """Process-wide counters for sync batch flushes (reported in cache stats)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.flushes = 0
+        self.records = 0
+        self.failed_batches = 0
+        self.failed_records = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = None
+        self.max_batch_size = 0
+        self.last_batch_size = None
+
+    def record_flush(self, size: int, latency: float, ok: bool, retries: int):
+        with self._lock:
+            self.retries += retries
+            self.last_batch_size = size
+            self.max_batch_size = max(self.max_batch_size, size)
+            if ok:
+                self.flushes += 1
+                self.records += size
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.last_latency = latency
+            else:
+                self.failed_batches += 1
+                self.failed_records += size
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'batch_size_limit': SYNC_BATCH_SIZE,
+                'flushes': self.flushes,
+                'records': self.records,
+                'avg_batch_size': round(self.records / self.flushes, 1) if self.flushes else 0,
+                'max_batch_size': self.max_batch_size,
+                'last_batch_size': self.last_batch_size,
+                'avg_flush_ms': round(self.total_latency / self.flushes * 1000, 1) if self.flushes else 0,
+                'max_flush_ms': round(self.max_latency * 1000, 1),
+                'last_flush_ms': round(self.last_latency * 1000, 1) if self.last_latency is not None else None,
+                'retries': self.retries,
+                'failed_batches': self.failed_batches,
+                'failed_records': self.failed_records
+            }
+
+
+sync_write_metrics = SyncWriteMetrics()
+
+
+class SyncBatchWriter:
+    """
+    Accumulates smart cache records during a sync and writes them through
+    db.bulk_upsert_cache in batches of `batch_size`, retrying failed batches
+    with exponential backoff.
+    
+    Use as a context manager so the final partial batch is always flushed.
+    """
+
+    def __init__(self, batch_size: int = None, max_retries: int = None, on_flush: Callable = None):
+        self.batch_size = max(1, batch_size or SYNC_BATCH_SIZE)
+        self.max_retries = SYNC_BATCH_MAX_RETRIES if max_retries is None else max_retries
+        self.on_flush = on_flush
+        self._pending: List[Dict] = []
+        self.saved = 0
+        self.failed = 0
+
+    def add(self, record: Dict):
+        self._pending.append(record)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> bool:
+        if not self._pending:
+            return True
+
+        # Same conflict key twice in one statement is rejected by Postgres - keep the last
+        unique = {}
+        for record in self._pending:
+            unique[(record['magnet_hash'], record['account_id'], record['file_id'])] = record
+        batch = list(unique.values())
+        self._pending = []
+
+        started = time.time()
+        ok = False
+        attempt = 0
+        while True:
+            ok = db.bulk_upsert_cache(batch)
+            if ok or attempt >= self.max_retries:
+                break
+            attempt += 1
+            delay = (2 ** attempt) + random.uniform(0, 1)
+            print(f"   ⚠️ Batch of {len(batch)} failed, retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+        latency = time.time() - started
+        sync_write_metrics.record_flush(len(batch), latency, ok, attempt)
+
+        if not ok:
+            print(f"   ❌ Batch of {len(batch)} records failed after {self.max_retries} retries")
+            self.failed += len(batch)
+            return False
+
+        cache_mirror.upsert(batch)
+        for record in batch:
+            front_cache.invalidate(record['magnet_hash'])
+            hash_index.add(record['magnet_hash'])
+
+        self.saved += len(batch)
+        print(f"   💾 Flushed {len(batch)} records in {latency * 1000:.0f}ms")
+        if self.on_flush:
+            self.on_flush(batch)
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+
+class AccountRateLimiter:
+    """
+    Spaces out PikPak calls for one account by a random interval in
+    [min_interval, max_interval]. Each account syncing in parallel gets its
+    own limiter, so concurrency never raises the per-account request rate.
+    """
+
+    def __init__(self, min_interval: float = SYNC_ACCOUNT_MIN_INTERVAL, max_interval: float = SYNC_ACCOUNT_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._next_allowed = 0.0
+
+    def wait(self):
+        delay = self._next_allowed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_allowed = time.time() + random.uniform(self.min_interval, self.max_interval)
+
+
+# ============================================
+# SYNC JOBS (Progress, Cancellation, Resume)
+# ============================================
+
+class SyncJob:
+    """
+    One run of sync_all_accounts_to_cache, tracked as a first-class job.
+    
+    Progress is checkpointed to SYNC_CHECKPOINT_FILE after every account and
+    every flushed batch of records, so a job interrupted by a restart can be
+    resumed: finished accounts are skipped and, for accounts that were
+    mid-sync, files already written to the DB are not fetched again.
+    """
+
+    def __init__(self, full_sync: bool = False, checkpoint: Dict = None):
+        checkpoint = checkpoint or {}
+        self.id = checkpoint.get('job_id') or f"sync-{int(time.time())}"
+        self.full_sync = checkpoint.get('full_sync', full_sync)
+        self.resumed = bool(checkpoint)
+        self.status = 'running'
+        self.started_at = time.time()
+        self.finished_at = None
+        self.error = None
+        self.process_lock = None  # open lock file held until the job ends
+        self.stats = None
+        self.accounts_total = 0
+        self.accounts_done = set(checkpoint.get('accounts_done', []))
+        self.accounts_failed = set(checkpoint.get('accounts_failed', []))
+        self.processed_files = {int(k): set(v) for k, v in checkpoint.get('in_progress', {}).items()}
+        self.prior_stats = checkpoint.get('stats') or {}
+        self.running_stats = None  # total_stats of the live run (includes prior_stats)
+        self.files_total = {}      # account_id -> files listed this run
+        self.files_done = {}       # account_id -> files handled this run
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    # --- cancellation ---
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    # --- progress hooks (called from sync workers) ---
+
+    def account_listed(self, account_id: int, total_files: int, already_done: int = 0):
+        with self._lock:
+            self.files_total[account_id] = total_files
+            self.files_done[account_id] = already_done
+
+    def files_handled(self, account_id: int, count: int = 1):
+        with self._lock:
+            self.files_done[account_id] = self.files_done.get(account_id, 0) + count
+
+    def file_processed(self, account_id: int, file_id: str):
+        self.files_processed(account_id, [file_id])
+
+    def files_processed(self, account_id: int, file_ids: List[str]):
+        with self._lock:
+            self.processed_files.setdefault(account_id, set()).update(file_ids)
+            self.files_done[account_id] = self.files_done.get(account_id, 0) + len(file_ids)
+
+    def already_processed(self, account_id: int) -> set:
+        with self._lock:
+            return set(self.processed_files.get(account_id, ()))
+
+    def account_finished(self, account_id: int, ok: bool):
+        with self._lock:
+            (self.accounts_done if ok else self.accounts_failed).add(account_id)
+            self.processed_files.pop(account_id, None)
+        self.checkpoint()
+
+    # --- persistence ---
+
+    def checkpoint(self):
+        """Write the resumable state of this job to SYNC_CHECKPOINT_FILE"""
+        with self._lock:
+            state = {
+                'job_id': self.id,
+                'full_sync': self.full_sync,
+                'status': self.status,
+                'accounts_done': sorted(self.accounts_done),
+                'accounts_failed': sorted(self.accounts_failed),
+                'in_progress': {str(k): sorted(v) for k, v in self.processed_files.items()},
+                'stats': self.stats or self.running_stats or self.prior_stats,
+                'updated_at': time.time()
+            }
+            try:
+                with open(SYNC_CHECKPOINT_FILE, 'w') as f:
+                    json.dump(state, f)
+            except Exception as e:
+                print(f"   ⚠️ Could not write sync checkpoint: {e}")
+
+    def finish(self, status: str, stats: Dict = None, error: str = None):
+        self.status = status
+        self.stats = stats
+        self.error = error
+        self.finished_at = time.time()
+        self.checkpoint()
+        if self.process_lock is not None:
+            self.process_lock.close()  # releases the flock
+            self.process_lock = None
+
+    def progress(self) -> Dict:
+        with self._lock:
+            now = self.finished_at or time.time()
+            elapsed = max(now - self.started_at, 0.001)
+            files_total = sum(self.files_total.values())
+            files_done = sum(self.files_done.values())
+            accounts_finished = len(self.accounts_done) + len(self.accounts_failed)
+            listed = len(self.files_total)
+
+        rate = files_done / elapsed
+
+        # Estimate files in accounts not listed yet from the average listed account
+        eta = None
+        if self.status == 'running' and rate > 0:
+            unlisted = max(self.accounts_total - accounts_finished - listed, 0)
+            avg_files = files_total / listed if listed else 0
+            remaining = max(files_total - files_done, 0) + unlisted * avg_files
+            eta = round(remaining / rate)
+
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'full_sync': self.full_sync,
+            'resumed': self.resumed,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'elapsed_seconds': round(elapsed, 1),
+            'accounts_total': self.accounts_total,
+            'accounts_done': len(self.accounts_done),
+            'accounts_failed': len(self.accounts_failed),
+            'files_total': files_total,
+            'files_done': files_done,
+            'files_per_second': round(rate, 2),
+            'eta_seconds': eta,
+            'stats': self.stats or self.running_stats,
+            'error': self.error
+        }
+
+
+CURRENT_SYNC_JOB: Optional[SyncJob] = None
+SYNC_JOB_LOCK = threading.Lock()
+
+
+def load_sync_checkpoint() -> Dict:
+    """Load the last sync job checkpoint ({} if none)"""
+    try:
+        with open(SYNC_CHECKPOINT_FILE, 'r') as f:
+            return json.load(f)
+    except:
+        return {}
+
+
+def _run_sync_job(job: SyncJob, login_func: Callable, captcha_func: Callable, evict_func: Callable = None):
+    try:
+        stats = sync_all_accounts_to_cache(
+            login_func=login_func,
+            captcha_func=captcha_func,
+            full_sync=job.full_sync,
+            job=job,
+            evict_func=evict_func
+        )
+        job.finish('cancelled' if job.cancelled else 'completed', stats)
+    except Exception as e:
+        print(f"❌ SMART CACHE: Sync job {job.id} failed - {e}")
+        job.finish('failed', error=str(e))
+
+
+def start_sync_job(
+    login_func: Callable,
+    captcha_func: Callable = None,
+    full_sync: bool = False,
+    resume: bool = False,
+    evict_func: Callable = None,
+    process_lock=None
+) -> Tuple[SyncJob, bool]:
+    """
+    Start a background sync job unless one is already running.
+    
+    Args:
+        login_func: Your pikpak_login function
+        captcha_func: Function to generate captcha token
+        full_sync: Ignore per-account watermarks
+        resume: Continue the last checkpointed job if it did not finish
+        evict_func: Called with an account dict when a synced account is
+                    over EVICTION_TRIGGER_PERCENT storage (see needs_eviction)
+        process_lock: Open lock file the job releases when it ends
+        
+    Returns:
+        (job, started) - started is False if an existing job is still running
+    """
+    global CURRENT_SYNC_JOB
+    
+    with SYNC_JOB_LOCK:
+        if CURRENT_SYNC_JOB and CURRENT_SYNC_JOB.status == 'running':
+            return CURRENT_SYNC_JOB, False
+        
+        checkpoint = load_sync_checkpoint() if resume else {}
+        if checkpoint.get('status') != 'running':
+            checkpoint = {}
+        
+        job = SyncJob(full_sync=full_sync, checkpoint=checkpoint)
+        job.process_lock = process_lock
+        CURRENT_SYNC_JOB = job
+        job.checkpoint()
+    
+    threading.Thread(
+        target=_run_sync_job,
+        args=(job, login_func, captcha_func, evict_func),
+        daemon=True,
+        name=f"cache-{job.id}"
+    ).start()
+    
+    print(f"🔄 SMART CACHE: {'Resumed' if job.resumed else 'Started'} sync job {job.id}")
+    return job, True
+
+
+def resume_interrupted_sync(
+    login_func: Callable,
+    captcha_func: Callable = None,
+    evict_func: Callable = None
+) -> Optional[SyncJob]:
+    """
+    Resume a sync job that was still running when the process stopped.
+    Every worker process calls this at import; an exclusive lock on
+    SYNC_RESUME_LOCK_FILE lets only one of them resume the shared
+    checkpoint, and is held until that job ends.
+    """
+    if load_sync_checkpoint().get('status') != 'running':
+        return None
+    
+    lock = None
+    if fcntl is not None:
+        lock = open(SYNC_RESUME_LOCK_FILE, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            print("🔄 SMART CACHE: Another process is resuming the interrupted sync")
+            return None
+        # Re-read under the lock: the holder may have just finished it
+        if load_sync_checkpoint().get('status') != 'running':
+            lock.close()
+            return None
+    
+    job, started = start_sync_job(login_func, captcha_func, resume=True, evict_func=evict_func, process_lock=lock)
+    if not started and lock is not None:
+        lock.close()
+    return job
+
+
+def cancel_sync_job() -> Optional[SyncJob]:
+    """Request cancellation of the running sync job (returns it, or None)"""
+    job = CURRENT_SYNC_JOB
+    if job and job.status == 'running':
+        job.cancel()
+        return job
+    return None
+
+
+def get_sync_progress() -> Dict:
+    """Live progress of the current (or last) sync job"""
+    job = CURRENT_SYNC_JOB
+    if not job:
+        return {'status': 'idle'}
+    return job.progress()
+
+
+# ============================================
+# SYNC WATERMARKS (Incremental Sync)
+# ============================================
+
+def load_sync_state() -> Dict:
+    """Load per-account sync watermarks from file"""
+    try:
+        with open(SYNC_STATE_FILE, 'r') as f:
+            return json.load(f)
+    except:
+        return {}
+
+
+def get_account_sync_state(account_id: int) -> Dict:
+    """Get the stored watermark for one account ({} if never synced)"""
+    with SYNC_STATE_LOCK:
+        return load_sync_state().get(f"account_{account_id}", {})
+
+
+def set_account_sync_state(account_id: int, state: Dict):
+    """Persist the watermark for one account"""
+    with SYNC_STATE_LOCK:
+        all_state = load_sync_state()
+        all_state[f"account_{account_id}"] = state
+        try:
+            with open(SYNC_STATE_FILE, 'w') as f:
+                json.dump(all_state, f)
+        except Exception as e:
+            print(f"   ⚠️ Could not save sync state: {e}")
+
+
+def listing_fingerprint(files: List[Dict]) -> str:
+    """
+    Fingerprint of a folder listing: changes whenever a file is added,
+    removed, renamed or modified.
+    """
+    digest = hashlib.sha1()
+    for f in sorted(files, key=lambda f: f.get('id') or ''):
+        digest.update(f"{f.get('id')}|{f.get('modified_time')}|{f.get('size')}|{f.get('name')}\n".encode())
+    return digest.hexdigest()
+
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    """Parse a PikPak ISO timestamp; None if missing or malformed"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+
+def _is_modified_since(file: Dict, watermark: Optional[datetime]) -> bool:
+    """True if the file changed after the watermark (or we can't tell)"""
+    if watermark is None:
+        return True
+    modified = _parse_time(file.get('modified_time'))
+    if modified is None:
+        return True
+    try:
+        return modified > watermark
+    except TypeError:
+        # naive vs aware timestamps - treat as changed
+        return True
+
+
 # ============================================
 # SYNC FUNCTIONS
 # ============================================
@@ -293,25 +1447,41 @@ def sync_account_to_cache(
     account: Dict,
     tokens: Dict,
     login_func: Callable = None,
-    captcha_func: Callable = None
+    captcha_func: Callable = None,
+    full_sync: bool = False,
+    rate_limiter: AccountRateLimiter = None,
+    job: SyncJob = None
 ) -> Dict:
     """
     Sync a single account's files to smart cache.
-    Fetches detailed info for each file to get magnet hash.
+    
+    Incremental by default: the folder listing is compared against the
+    account's stored watermark (listing fingerprint + latest modified_time).
+    An unchanged listing finishes without any per-file requests; otherwise
+    only new or modified files are looked at, and deletions are found by
+    set difference against the DB.
+    
+    The per-file detail fetch (one captcha-gated request) is only made for
+    files whose id is not yet in the DB and whose list entry carries no
+    params.url, so steady-state cost scales with new files only.
     
     Args:
         account: Account dict with id, email, my_pack_id, device_id
         tokens: Auth tokens
         login_func: Function to call for login (not used, kept for compatibility)
         captcha_func: Function to generate captcha token
+        full_sync: Ignore the watermark and DB, re-fetch details for every file
+        rate_limiter: Per-account limiter for detail calls (a new one if omitted)
+        job: Sync job to report progress to, checkpoint into and check for cancellation
         
     Returns:
-        Dict with stats: synced, skipped, trashed, errors
+        Dict with stats: synced, skipped, trashed, errors, unchanged
     """
     account_id = account['id']
+    rate_limiter = rate_limiter or AccountRateLimiter()
     my_pack_id = account.get('my_pack_id')
     
-    stats = {'synced': 0, 'skipped': 0, 'trashed': 0, 'errors': 0}
+    stats = {'synced': 0, 'skipped': 0, 'trashed': 0, 'errors': 0, 'unchanged': 0}
     
     if not my_pack_id:
         print(f"   ⚠️ No my_pack_id for account {account_id}, skipping")
@@ -321,79 +1491,193 @@ def sync_account_to_cache(
     
     try:
         # Step 1: Get all files from PikPak (basic info only)
-        api_files = pikpak_list_files_paginated(my_pack_id, account, tokens, captcha_func)
-        api_file_ids = set()
+        api_files = pikpak_list_files_paginated(my_pack_id, account, tokens, captcha_func, strict=True)
+        api_files = [f for f in api_files if f.get('id')]
+        api_file_ids = {f['id'] for f in api_files}
         
-        print(f"   🔍 Fetching detailed info for {len(api_files)} files...")
+        fingerprint = listing_fingerprint(api_files)
+        sync_state = {} if full_sync else get_account_sync_state(account_id)
         
-        # Step 2: For each file, get detailed info and extract hash
-        for idx, file in enumerate(api_files):
-            file_id = file.get('id')
-            file_name = file.get('name', 'Unknown')
-            
-            if not file_id:
-                continue
+        if sync_state.get('fingerprint') == fingerprint:
+            stats['unchanged'] = len(api_files)
+            if job:
+                job.account_listed(account_id, len(api_files), already_done=len(api_files))
+            print(f"   ✅ No changes since last sync ({len(api_files)} files)")
+            return stats
+        
+        # Step 2: Work out which files changed since the watermark
+        if cache_mirror.ready and cache_mirror.pull():
+            db_entries = cache_mirror.get_entries_by_account(account_id)
+        else:
+            db_entries = db.get_cached_entries_by_account(account_id)
+        if is_db_error(db_entries):
+            raise Exception("Could not load cached entries from DB")
+        db_entries = {row['file_id']: row for row in db_entries}
+        db_file_ids = set(db_entries)
+        
+        # Rows saved before hashes were canonicalised (base32, lower-case...)
+        legacy = [
+            (file_id, row['magnet_hash'], normalize_hash(row['magnet_hash']))
+            for file_id, row in db_entries.items()
+            if row.get('magnet_hash') and row['magnet_hash'] != normalize_hash(row['magnet_hash'])
+        ]
+        if legacy:
+            rekeyed = db.rekey_cache_hashes(account_id, legacy)
+            cache_mirror.rekey(account_id, legacy)
+            for file_id, old_hash, new_hash in legacy:
+                db_entries[file_id]['magnet_hash'] = new_hash
+                front_cache.invalidate(old_hash)
+                front_cache.invalidate(new_hash)
+                hash_index.add(new_hash)
+            print(f"   🔑 Canonicalised {rekeyed}/{len(legacy)} legacy magnet hashes")
+        watermark = _parse_time(sync_state.get('max_modified_time'))
+        no_hash_ids = set(sync_state.get('no_hash_ids', []))
+        
+        # Files already written by an interrupted run of this job
+        resumed_ids = job.already_processed(account_id) if job else set()
+        
+        changed_files = [
+            f for f in api_files
+            if f['id'] not in resumed_ids
+            and (full_sync or f['id'] not in db_file_ids or _is_modified_since(f, watermark))
+        ]
+        stats['unchanged'] = len(api_files) - len(changed_files) - len(resumed_ids & api_file_ids)
+        
+        if job:
+            job.account_listed(account_id, len(api_files), already_done=len(api_files) - len(changed_files))
+        
+        print(f"   🔍 Checking {len(changed_files)}/{len(api_files)} new or changed files...")
+        
+        # Step 3: Resolve each changed file's hash, fetching details only when
+        # neither the DB nor the listing already has it
+        def batch_saved(batch):
+            # Only rows that are actually in the DB count as done for a resume
+            job.files_processed(account_id, [record['file_id'] for record in batch])
+            job.checkpoint()
+        
+        writer = SyncBatchWriter(on_flush=batch_saved if job else None)
+        detail_fetches = 0
+        for idx, file in enumerate(changed_files):
+            if job and job.cancelled:
+                print(f"   🛑 Sync cancelled for account {account_id}")
+                break
             
-            api_file_ids.add(file_id)
+            file_id = file['id']
+            file_name = file.get('name', 'Unknown')
+            file_size = int(file.get('size', 0))
+            known = None if full_sync else db_entries.get(file_id)
             
             # Progress indicator
             if (idx + 1) % 10 == 0:
-                print(f"   📊 Progress: {idx + 1}/{len(api_files)}")
+                print(f"   📊 Progress: {idx + 1}/{len(changed_files)}")
             
             try:
-                # Get detailed file info
-                file_info = pikpak_get_file_info(file_id, account, tokens, captcha_func)
-                
-                if not file_info:
-                    print(f"      ⚠️ Could not get info: {file_name[:30]}")
-                    stats['errors'] += 1
-                    continue
-                
-                # Extract magnet hash
-                magnet_hash = extract_hash_from_file_info(file_info)
+                file_hash = file.get("hash") or file.get("md5")
                 
-                if not magnet_hash:
-                    print(f"      ⏭️ No hash found: {file_name[:30]}")
-                    stats['skipped'] += 1
-                    continue
-                
-                # Get file hash (separate from magnet hash)
-                file_hash = file_info.get("hash") or file_info.get("md5")
-                
-                # Save to cache
-                saved = save_to_smart_cache(
-                    file_id=file_id,
-                    account_id=account_id,
-                    magnet_hash=magnet_hash,
-                    file_name=file_name,
-                    file_size=int(file.get('size', 0)),
-                    file_hash=file_hash,
-                    parent_id=file.get('parent_id')
-                )
-                
-                if saved:
-                    stats['synced'] += 1
+                if known:
+                    # Same file id always maps to the same magnet - only metadata can change
+                    if known.get('file_name') == file_name and (known.get('file_size') or 0) == file_size:
+                        stats['unchanged'] += 1
+                        if job:
+                            job.file_processed(account_id, file_id)
+                        continue
+                    magnet_hash = known['magnet_hash']
+                    
                 else:
-                    stats['errors'] += 1
+                    magnet_hash = extract_hash_from_listing(file)
+                    
+                    if not magnet_hash and file_id in no_hash_ids and not full_sync:
+                        # Detail fetch already found no hash for this file last time
+                        stats['skipped'] += 1
+                        if job:
+                            job.file_processed(account_id, file_id)
+                        continue
+                    
+                    if not magnet_hash:
+                        # Rate limiting (avoid API throttling)
+                        rate_limiter.wait()
+                        
+                        # Get detailed file info
+                        file_info = pikpak_get_file_info(file_id, account, tokens, captcha_func)
+                        detail_fetches += 1
+                        
+                        if not file_info:
+                            print(f"      ⚠️ Could not get info: {file_name[:30]}")
+                            stats['errors'] += 1
+                            if job:
+                                job.files_handled(account_id)
+                            continue
+                        
+                        # Extract magnet hash
+                        magnet_hash = extract_hash_from_file_info(file_info)
+                        
+                        # Get file hash (separate from magnet hash)
+                        file_hash = file_info.get("hash") or file_info.get("md5")
+                    
+                    if not magnet_hash:
+                        print(f"      ⏭️ No hash found: {file_name[:30]}")
+                        stats['skipped'] += 1
+                        no_hash_ids.add(file_id)
+                        if job:
+                            job.file_processed(account_id, file_id)
+                        continue
                 
-                # Rate limiting (avoid API throttling)
-                time.sleep(random.uniform(1.0, 2.0))
+                # Queue for the next batched upsert; marked processed once it's flushed
+                writer.add({
+                    'magnet_hash': normalize_hash(magnet_hash),
+                    'file_id': file_id,
+                    'account_id': account_id,
+                    'file_name': file_name,
+                    'file_size': file_size,
+                    'file_hash': file_hash,
+                    'parent_id': file.get('parent_id')
+                })
                 
             except Exception as e:
                 print(f"      ❌ Error processing {file_name[:30]}: {e}")
                 stats['errors'] += 1
+                if job:
+                    job.files_handled(account_id)
                 continue
         
-        # Step 3: Find deleted files (in DB but not in API)
-        db_file_ids = set(db.get_cached_files_by_account(account_id))
+        print(f"   📡 Detail fetches: {detail_fetches}/{len(changed_files)}")
+        
+        writer.flush()
+        stats['synced'] += writer.saved
+        stats['errors'] += writer.failed
+        if job and writer.failed:
+            # Not recorded as processed, so a resumed run retries them
+            job.files_handled(account_id, writer.failed)
+        
+        # A cancelled run saw only part of the files: no deletions, no watermark
+        if job and job.cancelled:
+            return stats
+        
+        # Step 4: Find deleted files (in DB but not in API)
         deleted_file_ids = db_file_ids - api_file_ids
         
         if deleted_file_ids:
-            db.mark_cache_as_trash(account_id, list(deleted_file_ids))
+            mark_files_as_trash(account_id, list(deleted_file_ids))
             stats['trashed'] = len(deleted_file_ids)
             print(f"   🗑️ Marked {len(deleted_file_ids)} deleted files as trash")
         
-        print(f"   ✅ Done! Synced: {stats['synced']} | Skipped: {stats['skipped']} | Trashed: {stats['trashed']} | Errors: {stats['errors']}")
+        # Step 5: Advance the watermark only if every changed file made it in,
+        # otherwise the next run retries the failures
+        if stats['errors'] == 0:
+            modified_times = [t for t in (_parse_time(f.get('modified_time')) for f in api_files) if t]
+            try:
+                max_modified = max(modified_times).isoformat() if modified_times else None
+            except TypeError:
+                max_modified = None
+            set_account_sync_state(account_id, {
+                'fingerprint': fingerprint,
+                'max_modified_time': max_modified,
+                'file_count': len(api_files),
+                'no_hash_ids': sorted(no_hash_ids & api_file_ids),
+                'synced_at': datetime.now(timezone.utc).isoformat()
+            })
+        
+        print(f"   ✅ Done! Synced: {stats['synced']} | Unchanged: {stats['unchanged']} | Skipped: {stats['skipped']} | Trashed: {stats['trashed']} | Errors: {stats['errors']}")
         
     except Exception as e:
         print(f"   ❌ Error syncing account {account_id}: {e}")
@@ -402,21 +1686,82 @@ def sync_account_to_cache(
     return stats
 
 
-def sync_all_accounts_to_cache(login_func: Callable, get_account_func: Callable = None, captcha_func: Callable = None) -> Dict:
+def _sync_account_worker(
+    account: Dict,
+    login_func: Callable,
+    captcha_func: Callable,
+    full_sync: bool,
+    job: SyncJob = None
+) -> Optional[Dict]:
+    """
+    Log in and sync one account. Runs inside the sync worker pool.
+    Returns the account's stats, or None if it could not be synced.
+    """
+    account_id = account.get('id')
+    
+    # Stagger start-up so parallel accounts don't hit PikPak in lockstep
+    time.sleep(random.uniform(0, SYNC_ACCOUNT_STAGGER))
+    
+    if job and job.cancelled:
+        return None
+    
+    try:
+        # Login to account
+        print(f"\n🔐 Logging into Account {account_id}...")
+        tokens = login_func(account)
+        
+        if not tokens or not tokens.get('access_token'):
+            print(f"   ❌ Login failed for account {account_id}")
+            return None
+        
+        return sync_account_to_cache(
+            account=account,
+            tokens=tokens,
+            login_func=login_func,
+            captcha_func=captcha_func,
+            full_sync=full_sync,
+            rate_limiter=AccountRateLimiter(),
+            job=job
+        )
+        
+    except Exception as e:
+        print(f"   ❌ Error with account {account_id}: {e}")
+        return None
+
+
+def sync_all_accounts_to_cache(
+    login_func: Callable,
+    get_account_func: Callable = None,
+    captcha_func: Callable = None,
+    full_sync: bool = False,
+    max_workers: int = None,
+    job: SyncJob = None,
+    evict_func: Callable = None
+) -> Dict:
     """
     Sync ALL accounts to smart cache.
     Call this on startup or after clear-trash.
     
+    Accounts are synced concurrently, at most `max_workers` at a time
+    (SMART_CACHE_SYNC_CONCURRENCY by default), each with its own rate limiter.
+    
     Args:
         login_func: Your pikpak_login function from app.py
         get_account_func: Not used, kept for compatibility
         captcha_func: Function to generate captcha token
+        full_sync: Ignore per-account watermarks and re-fetch every file
+        max_workers: Override the global concurrency cap
+        job: Sync job to report progress to; accounts it already finished are skipped
+        evict_func: Called with each synced account whose storage is over
+                    EVICTION_TRIGGER_PERCENT, to free space before it fills up
         
     Returns:
         Dict with total stats
     """
+    max_workers = max(1, max_workers or SYNC_MAX_CONCURRENCY)
+    
     print("=" * 60)
-    print("🔄 SMART CACHE: Starting Full Sync (With Hash Lookup)")
+    print(f"🔄 SMART CACHE: Starting Sync ({max_workers} accounts in parallel)")
     print("=" * 60)
     
     total_stats = {
@@ -424,18 +1769,19 @@ def sync_all_accounts_to_cache(login_func: Callable, get_account_func: Callable
         'skipped': 0,
         'trashed': 0,
         'errors': 0,
+        'unchanged': 0,
         'accounts': 0,
-        'accounts_failed': 0
+        'accounts_failed': 0,
+        'accounts_evicted': 0
     }
     
     try:
-        # Get all active accounts from DB (both servers)
-        all_accounts = []
-        all_accounts.extend(db.get_all_server_accounts(1))
-        all_accounts.extend(db.get_all_server_accounts(2))
+        # Get all accounts from the shared registry (both servers)
+        all_accounts = registry.all_accounts()
         
         print(f"📊 Found {len(all_accounts)} total accounts")
         
+        runnable = []
         for account in all_accounts:
             account_id = account.get('id')
             
@@ -452,44 +1798,65 @@ def sync_all_accounts_to_cache(login_func: Callable, get_account_func: Callable
                 total_stats['accounts_failed'] += 1
                 continue
             
-            try:
-                # Login to account
-                print(f"\n🔐 Logging into Account {account_id}...")
-                tokens = login_func(account)
+            # Finished by an earlier (interrupted) run of this job
+            if job and (account_id in job.accounts_done or account_id in job.accounts_failed):
+                print(f"   ⏭️ Account {account_id} already synced by this job")
+                continue
+            
+            runnable.append(account)
+        
+        if job:
+            job.accounts_total = len(runnable) + len(job.accounts_done) + len(job.accounts_failed)
+            for key in total_stats:
+                total_stats[key] += job.prior_stats.get(key, 0)
+            job.running_stats = total_stats
+        
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cache-sync") as pool:
+            futures = {
+                pool.submit(_sync_account_worker, account, login_func, captcha_func, full_sync, job): account
+                for account in runnable
+            }
+            
+            for future in as_completed(futures):
+                stats = future.result()
+                account = futures[future]
+                account_id = account['id']
                 
-                if not tokens or not tokens.get('access_token'):
-                    print(f"   ❌ Login failed for account {account_id}")
-                    total_stats['accounts_failed'] += 1
+                if job and job.cancelled:
+                    if stats is not None:
+                        for key in ('synced', 'skipped', 'errors', 'unchanged'):
+                            total_stats[key] += stats[key]
                     continue
                 
-                # Sync this account
-                stats = sync_account_to_cache(
-                    account=account,
-                    tokens=tokens,
-                    login_func=login_func,
-                    captcha_func=captcha_func
-                )
+                if job:
+                    job.account_finished(account_id, stats is not None)
+                
+                if stats is None:
+                    total_stats['accounts_failed'] += 1
+                    continue
                 
                 total_stats['synced'] += stats['synced']
                 total_stats['skipped'] += stats['skipped']
                 total_stats['trashed'] += stats['trashed']
                 total_stats['errors'] += stats['errors']
+                total_stats['unchanged'] += stats['unchanged']
                 total_stats['accounts'] += 1
                 
-                # Rate limiting between accounts
-                wait_time = random.randint(5, 10)
-                print(f"   ⏳ Waiting {wait_time}s before next account...")
-                time.sleep(wait_time)
-                
-            except Exception as e:
-                print(f"   ❌ Error with account {account_id}: {e}")
-                total_stats['accounts_failed'] += 1
+                # Free space before the account fills up, with the cache freshly synced
+                if evict_func and needs_eviction(account_id):
+                    print(f"   🧊 Account {account_id} over {EVICTION_TRIGGER_PERCENT:.0f}% storage, evicting cold files")
+                    try:
+                        evict_func(account)
+                        total_stats['accounts_evicted'] += 1
+                    except Exception as e:
+                        print(f"   ❌ Eviction failed for account {account_id}: {e}")
         
         print("\n" + "=" * 60)
         print(f"🎉 SMART CACHE: Sync Complete!")
         print(f"   📊 Accounts Synced: {total_stats['accounts']}")
         print(f"   ❌ Accounts Failed: {total_stats['accounts_failed']}")
         print(f"   ✅ Files Synced: {total_stats['synced']}")
+        print(f"   💤 Files Unchanged: {total_stats['unchanged']}")
         print(f"   ⏭️ Files Skipped: {total_stats['skipped']}")
         print(f"   🗑️ Files Trashed: {total_stats['trashed']}")
         print(f"   ⚠️ Errors: {total_stats['errors']}")
@@ -501,7 +1868,12 @@ def sync_all_accounts_to_cache(login_func: Callable, get_account_func: Callable
     return total_stats
 
 
-def sync_single_account(account_id: int, login_func: Callable, captcha_func: Callable = None) -> Dict:
+def sync_single_account(
+    account_id: int,
+    login_func: Callable,
+    captcha_func: Callable = None,
+    full_sync: bool = False
+) -> Dict:
     """
     Sync a single account by ID.
     Useful for testing or targeted sync.
@@ -510,15 +1882,15 @@ def sync_single_account(account_id: int, login_func: Callable, captcha_func: Cal
         account_id: Account ID to sync
         login_func: Your pikpak_login function
         captcha_func: Function to generate captcha token
+        full_sync: Ignore the watermark and re-fetch every file
         
     Returns:
         Dict with stats
     """
     print(f"🔄 Syncing single account: {account_id}")
     
-    # Get account from DB
-    all_accounts = db.get_all_server_accounts(1) + db.get_all_server_accounts(2)
-    account = next((a for a in all_accounts if a['id'] == account_id), None)
+    # Get account from the shared registry
+    account = registry.get(account_id)
     
     if not account:
         print(f"❌ Account {account_id} not found")
@@ -533,13 +1905,24 @@ def sync_single_account(account_id: int, login_func: Callable, captcha_func: Cal
         return {'error': 'Login failed'}
     
     # Sync
-    return sync_account_to_cache(account, tokens, login_func, captcha_func)
+    return sync_account_to_cache(account, tokens, login_func, captcha_func, full_sync=full_sync)
 
 
 # ============================================
 # CACHE MAINTENANCE
 # ============================================
 
+def mark_files_as_trash(account_id: int, file_ids: List[str]) -> bool:
+    """
+    Soft-delete files in the smart cache and drop them from the front cache.
+    Use this instead of db.mark_cache_as_trash so memory never serves a trashed file.
+    """
+    result = db.mark_cache_as_trash(account_id, file_ids)
+    cache_mirror.mark_trash(account_id, file_ids)
+    front_cache.invalidate_files(account_id, file_ids)
+    return result
+
+
 def clear_trashed_cache(account_id: int = None) -> int:
     """
     Permanently remove trashed entries from cache.
@@ -550,11 +1933,52 @@ def clear_trashed_cache(account_id: int = None) -> int:
     Returns:
         Number of records deleted
     """
-    return db.clear_trash_from_cache(account_id)
+    count = db.clear_trash_from_cache(account_id)
+    cache_mirror.delete_trashed(account_id)
+    return count
+
 
+_CACHE_STATS = {'value': None, 'at': 0.0}
+_CACHE_STATS_LOCK = threading.Lock()
+
+
+def _aggregate_cache_stats(max_age: int = CACHE_STATS_TTL) -> Dict:
+    """Table-wide counts from one aggregate query, reused for `max_age` seconds"""
+    with _CACHE_STATS_LOCK:
+        cached = _CACHE_STATS['value']
+        if cached is not None and time.time() - _CACHE_STATS['at'] < max_age:
+            return dict(cached, age_seconds=round(time.time() - _CACHE_STATS['at'], 1))
+        
+        stats = cache_mirror.cache_stats() if cache_mirror.ready else db.get_smart_cache_stats()
+        stats['source'] = 'mirror' if cache_mirror.ready else 'db'
+        # Don't pin a failed read for the whole TTL
+        if 'db_error' not in stats:
+            _CACHE_STATS['value'], _CACHE_STATS['at'] = stats, time.time()
+        return dict(stats, age_seconds=0.0)
 
-def get_cache_stats() -> Dict:
+
+def get_cache_stats(max_age: int = CACHE_STATS_TTL) -> Dict:
     """
-    Get smart cache statistics.
+    Get smart cache statistics: active/trashed/per-account counts, total
+    bytes and hits (cached for CACHE_STATS_TTL), plus live hit rate, last
+    sync time and the local mirror, front cache, Bloom filter, sync
+    batch-write and hit tracking counters.
     """
-    return db.get_smart_cache_stats()
\ No newline at end of file
+    stats = _aggregate_cache_stats(max_age)
+    
+    lookups = lookup_metrics.stats()
+    stats['lookups'] = lookups
+    stats['hit_rate'] = lookups['hit_rate']
+    
+    synced = [s.get('synced_at') for s in load_sync_state().values() if isinstance(s, dict) and s.get('synced_at')]
+    job = CURRENT_SYNC_JOB
+    if job and job.status == 'completed' and job.finished_at:
+        synced.append(datetime.fromtimestamp(job.finished_at, timezone.utc).isoformat())
+    stats['last_sync_time'] = max(synced) if synced else 'Never'
+    
+    stats['mirror'] = cache_mirror.stats()
+    stats['front_cache'] = front_cache.stats()
+    stats['bloom_filter'] = hash_index.stats()
+    stats['sync_writes'] = sync_write_metrics.stats()
+    stats['hit_tracking'] = hit_recorder.stats()
+    return stats
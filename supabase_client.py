@@ -1,179 +1,755 @@
 import os
+import time
+import random
+import atexit
+import functools
+import threading
+from collections import OrderedDict
 from datetime import datetime, timezone
-from supabase import create_client, Client
 from dotenv import load_dotenv
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Iterator, Callable, Iterable
+
+try:
+    from supabase import create_client, Client
+    from postgrest.exceptions import APIError
+except ImportError:  # Only the in-memory backend is usable without it
+    create_client = None
+    Client = object
+    APIError = Exception
+
+# Postgres SQLSTATE for a unique constraint violation
+PG_UNIQUE_VIOLATION = '23505'
+# PostgREST error for an RPC whose SQL function isn't installed
+PGRST_MISSING_FUNCTION = 'PGRST202'
+
+
+def is_missing_function(error: Exception) -> bool:
+    return getattr(error, 'code', None) == PGRST_MISSING_FUNCTION
 
 # Load environment variables
 load_dotenv()
 
+# "supabase" (default) or "memory" (fake_supabase, for benchmarks/offline runs)
+SUPABASE_BACKEND = os.getenv("SUPABASE_BACKEND", "supabase")
+
+# Write-behind queue for non-critical mutations
+WRITE_BEHIND_ENABLED = os.getenv("SUPABASE_WRITE_BEHIND", "1") != "0"
+WRITE_BEHIND_INTERVAL = float(os.getenv("SUPABASE_WRITE_BEHIND_INTERVAL", 2.0))  # seconds
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("SUPABASE_WRITE_BEHIND_MAX_PENDING", 100))
+WRITE_BEHIND_MAX_ATTEMPTS = 5
+WRITE_BEHIND_UPSERT_CHUNK = 500
+
+
+# Paging and chunking for bulk reads/writes
+DB_PAGE_SIZE = int(os.getenv("SUPABASE_PAGE_SIZE", 1000))       # rows per range() page
+DB_IN_CHUNK = int(os.getenv("SUPABASE_IN_CHUNK", 200))          # values per in_() filter (URL length)
+DB_WRITE_CHUNK = int(os.getenv("SUPABASE_WRITE_CHUNK", 500))    # rows per upsert request
+
+# Instrumentation / retries for every SupabaseDB call
+DB_READ_RETRIES = int(os.getenv("SUPABASE_READ_RETRIES", 2))
+DB_RETRY_BASE_DELAY = float(os.getenv("SUPABASE_RETRY_BASE_DELAY", 0.2))  # seconds
+DB_LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class DBFailure:
+    """
+    Result of a DB call that failed after all retries.
+    Falsy and empty like the method's old fallback value (None/False/[]/0),
+    so existing `if not result` checks keep working, but callers that care
+    can tell a failure from a genuine empty answer with is_db_error().
+    """
+
+    __slots__ = ('method', 'error', 'default')
+
+    def __init__(self, method: str, error: Exception, default=None):
+        self.method = method
+        self.error = error
+        self.default = default
+
+    def __bool__(self):
+        return False
+
+    def __len__(self):
+        return 0
+
+    def __iter__(self):
+        return iter(())
+
+    def __int__(self):
+        return 0
+
+    __index__ = __int__
+
+    def __format__(self, spec):
+        return format(self.default if self.default is not None else 0, spec)
+
+    def __repr__(self):
+        return f"DBFailure({self.method}: {self.error})"
+
+
+def is_db_error(result) -> bool:
+    """True if a SupabaseDB call failed (rather than returning nothing)"""
+    return isinstance(result, DBFailure)
+
+
+class DBMetrics:
+    """Per-method call counts, errors, retries and latency histograms"""
+
+    def __init__(self, buckets_ms=DB_LATENCY_BUCKETS_MS):
+        self.buckets_ms = tuple(buckets_ms)
+        self._methods: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, method: str, latency: float, ok: bool, retries: int, error: Exception = None):
+        latency_ms = latency * 1000
+        with self._lock:
+            m = self._methods.get(method)
+            if m is None:
+                m = self._methods[method] = {
+                    'calls': 0, 'errors': 0, 'retries': 0,
+                    'total_ms': 0.0, 'max_ms': 0.0,
+                    'histogram': [0] * (len(self.buckets_ms) + 1),
+                    'last_error': None, 'last_error_at': None
+                }
+            m['calls'] += 1
+            m['retries'] += retries
+            m['total_ms'] += latency_ms
+            m['max_ms'] = max(m['max_ms'], latency_ms)
+            bucket = next((i for i, b in enumerate(self.buckets_ms) if latency_ms <= b), len(self.buckets_ms))
+            m['histogram'][bucket] += 1
+            if not ok:
+                m['errors'] += 1
+                m['last_error'] = str(error)
+                m['last_error_at'] = time.time()
+
+    def _percentile(self, histogram: List[int], calls: int, pct: float):
+        """Upper bucket bound containing the pct-th call (None if above the last bucket)"""
+        target = calls * pct
+        seen = 0
+        for i, count in enumerate(histogram):
+            seen += count
+            if seen >= target:
+                return self.buckets_ms[i] if i < len(self.buckets_ms) else None
+        return None
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            methods = {name: dict(m, histogram=list(m['histogram'])) for name, m in self._methods.items()}
+
+        result = {}
+        for name, m in sorted(methods.items()):
+            calls = m['calls']
+            result[name] = {
+                'calls': calls,
+                'errors': m['errors'],
+                'retries': m['retries'],
+                'error_rate': round(m['errors'] / calls, 4) if calls else 0,
+                'avg_ms': round(m['total_ms'] / calls, 1) if calls else 0,
+                'max_ms': round(m['max_ms'], 1),
+                'p50_ms': self._percentile(m['histogram'], calls, 0.5),
+                'p95_ms': self._percentile(m['histogram'], calls, 0.95),
+                'p99_ms': self._percentile(m['histogram'], calls, 0.99),
+                'histogram': {
+                    **{f"le_{b}ms": m['histogram'][i] for i, b in enumerate(self.buckets_ms)},
+                    'inf': m['histogram'][-1]
+                },
+                'last_error': m['last_error'],
+                'last_error_at': m['last_error_at']
+            }
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._methods = {}
+
+
+db_metrics = DBMetrics()
+
+
+def db_call(retry: bool = False, default=None):
+    """
+    Wrap a SupabaseDB method: time it, retry idempotent reads with jittered
+    exponential backoff, and turn a final exception into a DBFailure
+    (or, for methods whose fallback is a dict, that dict plus 'db_error').
+    """
+    def decorator(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            attempts = (DB_READ_RETRIES + 1) if retry else 1
+            started = time.time()
+            for attempt in range(attempts):
+                try:
+                    result = func(*args, **kwargs)
+                    db_metrics.record(name, time.time() - started, True, attempt)
+                    return result
+                except Exception as e:
+                    error = e
+                    if attempt + 1 < attempts:
+                        time.sleep(DB_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+            db_metrics.record(name, time.time() - started, False, attempts - 1, error)
+            print(f"❌ DB Error ({name}): {error}")
+            if isinstance(default, dict):
+                return {**default, 'db_error': str(error)}
+            return DBFailure(name, error, default)
+
+        return wrapper
+    return decorator
+
+
+class WriteBehindQueue:
+    """
+    Queues non-critical mutations off the request path and applies them
+    from a background thread, every WRITE_BEHIND_INTERVAL seconds or as
+    soon as WRITE_BEHIND_MAX_PENDING ops are waiting.
+    
+    Ops on the same row coalesce: later field values win and counter
+    increments add up. Upserts into the same table are sent as one batch.
+    Failed ops are re-queued (up to WRITE_BEHIND_MAX_ATTEMPTS) and the
+    queue is drained at interpreter exit.
+    
+    Synchronous writes that could conflict with queued ops call flush()
+    first, so they land after them. Reads on the request path don't flush;
+    they overlay pending_ops() instead.
+    """
+
+    def __init__(self, client: Client, enabled: bool = WRITE_BEHIND_ENABLED):
+        self.client = client
+        self.enabled = enabled
+        self._pending: "OrderedDict[tuple, Dict]" = OrderedDict()
+        self._inflight: "OrderedDict[tuple, Dict]" = OrderedDict()  # batch being written by flush()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.queued = 0
+        self.coalesced = 0
+        self.applied = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_flush_ms = None
+
+    # ---------- Enqueue ----------
+
+    def update(self, table: str, match_column: str, match_value, fields: Dict = None, increments: Dict = None):
+        """Queue `UPDATE table SET fields, col = col + n WHERE match_column = match_value`"""
+        key = (table, 'row', match_column, match_value)
+        self._enqueue(key, {
+            'table': table,
+            'kind': 'row',
+            'match': (match_column, match_value),
+            'fields': dict(fields or {}),
+            'increments': dict(increments or {}),
+            'attempts': 0
+        })
+
+    def upsert(self, table: str, row: Dict, on_conflict: str):
+        """Queue an upsert; rows with the same conflict key coalesce"""
+        conflict_key = tuple(row.get(col) for col in on_conflict.split(','))
+        key = (table, 'upsert', on_conflict, conflict_key)
+        self._enqueue(key, {
+            'table': table,
+            'kind': 'upsert',
+            'on_conflict': on_conflict,
+            'fields': dict(row),
+            'increments': {},
+            'attempts': 0
+        })
+
+    def _enqueue(self, key: tuple, op: Dict):
+        with self._lock:
+            self.queued += 1
+            existing = self._pending.get(key)
+            if existing:
+                self.coalesced += 1
+                self._merge(existing, op)
+            else:
+                self._pending[key] = self._merge({**op, 'fields': {}, 'increments': {}}, op)
+            pending = len(self._pending)
+
+        if not self.enabled:
+            self.flush()
+            return
+
+        self._ensure_thread()
+        if pending >= WRITE_BEHIND_MAX_PENDING:
+            self._wakeup.set()
+
+    def _requeue(self, key: tuple, op: Dict):
+        """Put a failed op back underneath anything newer for the same row"""
+        op['attempts'] += 1
+        if op['attempts'] >= WRITE_BEHIND_MAX_ATTEMPTS:
+            self.dropped += 1
+            print(f"❌ DB Write-behind: Dropping {op['kind']} on {op['table']} after {op['attempts']} attempts")
+            return
+        with self._lock:
+            newer = self._pending.get(key)
+            if newer:
+                self._merge(op, newer)
+            self._pending[key] = op
+            self._pending.move_to_end(key, last=False)
+
+    @staticmethod
+    def _merge(into: Dict, op: Dict) -> Dict:
+        """
+        Apply `op` on top of `into` in arrival order: an absolute value replaces
+        earlier increments, an increment adds to an earlier absolute value.
+        A column is never in both 'fields' and 'increments' afterwards.
+        """
+        for col, value in op['fields'].items():
+            into['fields'][col] = value
+            into['increments'].pop(col, None)
+        for col, by in op['increments'].items():
+            if col in into['fields']:
+                into['fields'][col] = (into['fields'][col] or 0) + by
+            else:
+                into['increments'][col] = into['increments'].get(col, 0) + by
+        return into
+
+    # ---------- Read-your-writes ----------
+
+    def pending_ops(self, table: str, include_inflight: bool = True) -> List[Dict]:
+        """
+        Copies of the ops queued for `table`, oldest first, so a read can
+        overlay its own queued writes instead of waiting for a flush.
+        include_inflight adds the batch flush() is writing right now
+        (safe for upserts; increments in it may already be in the DB).
+        """
+        with self._lock:
+            ops = list(self._inflight.values()) if include_inflight else []
+            ops += self._pending.values()
+            return [
+                {**op, 'fields': dict(op['fields']), 'increments': dict(op['increments'])}
+                for op in ops if op['table'] == table
+            ]
+
+    # ---------- Flush ----------
+
+    def flush(self) -> bool:
+        """Apply everything queued so far. Returns False if any op failed."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, OrderedDict()
+                self._inflight = batch
+            if not batch:
+                return True
+            try:
+                return self._apply_batch(batch)
+            finally:
+                with self._lock:
+                    self._inflight = OrderedDict()
+
+    def _apply_batch(self, batch: "OrderedDict[tuple, Dict]") -> bool:
+        """Write one swapped-out batch; failed ops are re-queued"""
+        started = time.time()
+        ok = True
+        upserts: Dict[tuple, List] = {}
+
+        for key, op in batch.items():
+            if op['kind'] == 'upsert':
+                group = (op['table'], op['on_conflict'], tuple(sorted(op['fields'])))
+                upserts.setdefault(group, []).append((key, op))
+                continue
+            try:
+                self._apply_row(op)
+                self.applied += 1
+            except Exception as e:
+                ok = False
+                self.failed += 1
+                print(f"❌ DB Write-behind error ({op['table']} {op['match']}): {e}")
+                self._requeue(key, op)
+
+        for (table, on_conflict, _), items in upserts.items():
+            for start in range(0, len(items), WRITE_BEHIND_UPSERT_CHUNK):
+                chunk = items[start:start + WRITE_BEHIND_UPSERT_CHUNK]
+                try:
+                    self.client.table(table)\
+                        .upsert([op['fields'] for _, op in chunk], on_conflict=on_conflict)\
+                        .execute()
+                    self.applied += len(chunk)
+                except Exception as e:
+                    ok = False
+                    self.failed += len(chunk)
+                    print(f"❌ DB Write-behind error (upsert {table} x{len(chunk)}): {e}")
+                    for key, op in chunk:
+                        self._requeue(key, op)
+
+        self.last_flush_ms = round((time.time() - started) * 1000, 1)
+        db_metrics.record('write_behind_flush', time.time() - started, ok, 0)
+        return ok
+
+    def _apply_row(self, op: Dict):
+        column, value = op['match']
+        fields = dict(op['fields'])
+
+        if op['increments']:
+            # Same read-then-write as the synchronous path, once per coalesced batch
+            current = self.client.table(op['table'])\
+                .select(','.join(op['increments']))\
+                .eq(column, value)\
+                .execute()
+            if not current.data:
+                return
+            # Only columns with no queued absolute value are left here (see _merge)
+            for col, by in op['increments'].items():
+                fields[col] = (current.data[0].get(col) or 0) + by
+
+        if fields:
+            self.client.table(op['table']).update(fields).eq(column, value).execute()
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(WRITE_BEHIND_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ DB Write-behind flush error: {e}")
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+                    self._thread.start()
+
+    def drain(self):
+        """Flush until empty (retrying failures) - used at shutdown"""
+        for _ in range(WRITE_BEHIND_MAX_ATTEMPTS):
+            if self.flush() and not self._pending:
+                return
+        if self._pending:
+            print(f"⚠️ DB Write-behind: {len(self._pending)} ops still pending at shutdown")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'enabled': self.enabled,
+            'pending': pending,
+            'queued': self.queued,
+            'coalesced': self.coalesced,
+            'applied': self.applied,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'last_flush_ms': self.last_flush_ms
+        }
+
+
+def chunked(items: Iterable, size: int) -> Iterator[List]:
+    """Split items into lists of at most `size`"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def summarize_cache_groups(groups: List[Dict]) -> Dict:
+    """
+    Fold (account_id, is_trash, files, size_bytes, hits) groups into the
+    smart cache stats shape. Shared by the DB, the local mirror and the
+    in-memory backend so all three report the same thing.
+    """
+    stats = {
+        'active_files': 0,
+        'trashed_files': 0,
+        'total_files': 0,
+        'total_size_bytes': 0,
+        'total_hits': 0,
+        'per_account': {}
+    }
+    
+    for group in groups:
+        files = group.get('files') or 0
+        size = group.get('size_bytes') or 0
+        hits = group.get('hits') or 0
+        account = stats['per_account'].setdefault(str(group.get('account_id')), {
+            'active_files': 0, 'trashed_files': 0, 'size_bytes': 0, 'hits': 0
+        })
+        
+        if group.get('is_trash'):
+            stats['trashed_files'] += files
+            account['trashed_files'] += files
+        else:
+            # Only live files count towards size and hits
+            stats['active_files'] += files
+            stats['total_size_bytes'] += size
+            stats['total_hits'] += hits
+            account['active_files'] += files
+            account['size_bytes'] += size
+            account['hits'] += hits
+    
+    stats['total_files'] = stats['active_files'] + stats['trashed_files']
+    return stats
+
+
 class SupabaseDB:
-    def __init__(self):
-        url = os.getenv("SUPABASE_URL")
-        key = os.getenv("SUPABASE_KEY")
+    def __init__(self, client: Client = None, backend: str = None):
+        """
+        Args:
+            client: Ready-made client (anything with the supabase-py table/rpc API)
+            backend: "supabase" or "memory"; defaults to SUPABASE_BACKEND
+        """
+        backend = backend or SUPABASE_BACKEND
+        
+        if client is not None:
+            self.client = client
+        elif backend == "memory":
+            from fake_supabase import FakeSupabaseClient
+            self.client = FakeSupabaseClient.from_env()
+            print(f"⚠️ SupabaseDB: Using in-memory backend (latency {self.client.latency_ms}ms)")
+        else:
+            url = os.getenv("SUPABASE_URL")
+            key = os.getenv("SUPABASE_KEY")
+            
+            if not url or not key:
+                raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in .env")
+            if create_client is None:
+                raise ImportError("supabase package is not installed (set SUPABASE_BACKEND=memory to run without it)")
+            
+            self.client: Client = create_client(url, key)
+        
+        self.backend = backend if client is None else "custom"
+        self.writes = WriteBehindQueue(self.client)
+        atexit.register(self.writes.drain)
+
+    # ============================================
+    # BULK READ / WRITE HELPERS
+    # ============================================
+
+    def iter_rows(
+        self,
+        table: str,
+        columns: str = '*',
+        where: Callable = None,
+        order: Iterable[tuple] = (('id', False),),
+        page_size: int = None
+    ) -> Iterator[Dict]:
+        """
+        Stream every matching row one range() page at a time, so PostgREST's
+        row cap never truncates the result and only one page is in memory.
         
-        if not url or not key:
-            raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in .env")
+        Args:
+            table: Table name
+            columns: Column projection for select()
+            where: Adds filters to the query, e.g. lambda q: q.eq('is_trash', False)
+            order: (column, desc) pairs; must end in a unique column so pages don't overlap
+            page_size: Rows per request (default SUPABASE_PAGE_SIZE)
+        """
+        page_size = page_size or DB_PAGE_SIZE
+        start = 0
         
-        self.client: Client = create_client(url, key)
+        while True:
+            query = self.client.table(table).select(columns)
+            if where:
+                query = where(query)
+            for column, desc in order:
+                query = query.order(column, desc=desc)
+            page = query.range(start, start + page_size - 1).execute().data or []
+            
+            yield from page
+            
+            if len(page) < page_size:
+                return
+            start += page_size
+
+    def iter_rows_in(
+        self,
+        table: str,
+        column: str,
+        values: Iterable,
+        columns: str = '*',
+        where: Callable = None,
+        chunk_size: int = None
+    ) -> Iterator[Dict]:
+        """Rows whose `column` is in `values`, with the in_() list split into URL-safe chunks"""
+        for chunk in chunked(dict.fromkeys(values), chunk_size or DB_IN_CHUNK):
+            def chunk_filter(query, chunk=chunk):
+                query = query.in_(column, chunk)
+                return where(query) if where else query
+            yield from self.iter_rows(table, columns, where=chunk_filter, order=((column, False), ('id', False)))
+
+    def upsert_rows(self, table: str, rows: List[Dict], on_conflict: str, chunk_size: int = None) -> int:
+        """Upsert in requests of at most `chunk_size` rows; returns rows written"""
+        written = 0
+        for chunk in chunked(rows, chunk_size or DB_WRITE_CHUNK):
+            self.client.table(table).upsert(chunk, on_conflict=on_conflict).execute()
+            written += len(chunk)
+        return written
+
+    def update_rows_in(
+        self,
+        table: str,
+        fields: Dict,
+        column: str,
+        values: Iterable,
+        where: Callable = None,
+        chunk_size: int = None
+    ) -> int:
+        """UPDATE ... WHERE column IN (values) in URL-safe chunks; returns values covered"""
+        covered = 0
+        for chunk in chunked(dict.fromkeys(values), chunk_size or DB_IN_CHUNK):
+            query = self.client.table(table).update(fields)
+            if where:
+                query = where(query)
+            query.in_(column, chunk).execute()
+            covered += len(chunk)
+        return covered
 
+    @db_call(retry=True)
     def get_best_account(self, target_server_id: int, exclude_ids: list = None) -> Optional[Dict]:
         """
         Fetches best account, skipping specific IDs if provided.
         """
         if exclude_ids is None:
             exclude_ids = []
+        
+        # Quota increments may still be queued - count them without flushing
+        # (increments already being flushed are left out so none count twice)
+        pending = {}
+        for op in self.writes.pending_ops('accounts', include_inflight=False):
+            if op['kind'] == 'row' and op['match'][0] == 'id':
+                pending.setdefault(op['match'][1], []).append(op)
             
-        try:
-            # Fetch TOP 5 candidates (Active, Quota < 5, Server Match)
-            # Ordered by: Least Used -> Oldest Used
-            response = self.client.table('accounts')\
-                .select('*')\
-                .eq('server_id', target_server_id)\
-                .eq('status', 'active')\
-                .lt('quota_used', 5)\
-                .order('quota_used', desc=False)\
-                .order('last_used_at', desc=False)\
-                .limit(5)\
-                .execute()
-            
-            candidates = response.data or []
-            
-            # Python-side filtering (Pick first one NOT in exclude_ids)
+        # Fetch TOP 5 candidates (Active, Quota < 5, Server Match), plus one
+        # per account with queued writes in case those push it out
+        # Ordered by: Least Used -> Oldest Used
+        response = self.client.table('accounts')\
+            .select('*')\
+            .eq('server_id', target_server_id)\
+            .eq('status', 'active')\
+            .lt('quota_used', 5)\
+            .order('quota_used', desc=False)\
+            .order('last_used_at', desc=False)\
+            .limit(5 + len(pending))\
+            .execute()
+        
+        candidates = response.data or []
+        if pending:
             for acc in candidates:
-                if acc['id'] not in exclude_ids:
-                    return acc
-            
-            return None
-            
-        except Exception as e:
-            print(f"❌ DB Error (get_best_account): {e}")
-            return None
+                for op in pending.get(acc['id'], ()):
+                    acc.update(op['fields'])
+                    for col, by in op['increments'].items():
+                        acc[col] = (acc.get(col) or 0) + by
+            candidates = [acc for acc in candidates if acc.get('status') == 'active' and (acc.get('quota_used') or 0) < 5]
+            candidates.sort(key=lambda acc: (acc.get('quota_used') or 0, acc.get('last_used_at') is None, acc.get('last_used_at') or ''))
+        
+        # Python-side filtering (Pick first one NOT in exclude_ids)
+        for acc in candidates:
+            if acc['id'] not in exclude_ids:
+                return acc
+        
+        return None
 
+    @db_call(default=False)
     def increment_quota(self, account_id: int) -> bool:
         """
         Call this AFTER a successful download to update quota usage.
+        Queued write-behind; get_best_account counts it before it's flushed.
         """
-        try:
-            # First fetch current usage
-            current = self.client.table('accounts').select('quota_used').eq('id', account_id).execute()
-            if current.data:
-                new_val = current.data[0]['quota_used'] + 1
-                
-                # Update usage and timestamp
-                self.client.table('accounts').update({
-                    'quota_used': new_val,
-                    'last_used_at': datetime.now(timezone.utc).isoformat(),
-                    'updated_at': datetime.now(timezone.utc).isoformat()
-                }).eq('id', account_id).execute()
-                print(f"✅ Quota updated for Account ID {account_id}: {new_val}/5")
-                return True
-            return False
-        except Exception as e:
-            print(f"❌ DB Error (increment_quota): {e}")
-            return False
+        now = datetime.now(timezone.utc).isoformat()
+        self.writes.update('accounts', 'id', account_id,
+                           fields={'last_used_at': now, 'updated_at': now},
+                           increments={'quota_used': 1})
+        print(f"✅ Quota increment queued for Account ID {account_id}")
+        return True
 
+    @db_call()
     def rotate_device(self, account_id: int) -> Optional[str]:
         """
         Call this ONLY if PikPak returns a Device ID error.
         It auto-flags the old ID and assigns a fresh one.
         """
-        try:
-            # Calls our SQL function
-            response = self.client.rpc('rotate_account_device', {'target_account_id': account_id}).execute()
-            new_id = response.data
-            print(f"🔄 Device Rotated! New ID: {new_id}")
-            return new_id
-        except Exception as e:
-            print(f"❌ DB Error (rotate_device): {e}")
-            return None
+        # Calls our SQL function
+        response = self.client.rpc('rotate_account_device', {'target_account_id': account_id}).execute()
+        new_id = response.data
+        print(f"🔄 Device Rotated! New ID: {new_id}")
+        return new_id
 
+    @db_call(retry=True, default=[])
     def get_all_server_accounts(self, server_id: int):
         """Fetch ALL accounts for this server (for Admin Dashboard)"""
-        try:
-            response = self.client.table('accounts')\
-                .select('*')\
-                .eq('server_id', server_id)\
-                .order('id', desc=False)\
-                .execute()
-            return response.data or []
-        except Exception as e:
-            print(f"❌ DB Error (get_all_server_accounts): {e}")
-            return []
+        self.writes.flush()
+        response = self.client.table('accounts')\
+            .select('*')\
+            .eq('server_id', server_id)\
+            .order('id', desc=False)\
+            .execute()
+        return response.data or []
 
+    @db_call(default=False)
     def reset_account_quota(self, account_id: int):
         """Reset quota for specific account"""
-        try:
-            self.client.table('accounts').update({
-                'quota_used': 0,
-                'last_used_at': datetime.now(timezone.utc).isoformat()
-            }).eq('id', account_id).execute()
-            return True
-        except Exception as e:
-            print(f"❌ DB Error (reset_account_quota): {e}")
-            return False
+        self.writes.flush()
+        self.client.table('accounts').update({
+            'quota_used': 0,
+            'last_used_at': datetime.now(timezone.utc).isoformat()
+        }).eq('id', account_id).execute()
+        return True
 
+    @db_call()
     def sync_quota(self, account_id: int, usage: int):
         """Sync local DB quota with real PikPak usage"""
-        try:
-            self.client.table('accounts').update({
-                'quota_used': usage,
-                'last_used_at': datetime.now(timezone.utc).isoformat()
-            }).eq('id', account_id).execute()
-        except Exception as e:
-            print(f"❌ DB Error (sync_quota): {e}")
+        self.writes.flush()
+        self.client.table('accounts').update({
+            'quota_used': usage,
+            'last_used_at': datetime.now(timezone.utc).isoformat()
+        }).eq('id', account_id).execute()
 
+    @db_call()
     def update_storage_stats(self, account_id: int, used_bytes: int, limit_bytes: int):
         """
         Updates the disk space columns in Supabase.
         """
-        try:
-            # Avoid division by zero
-            percent = 0.0
-            if limit_bytes > 0:
-                percent = round((used_bytes / limit_bytes) * 100, 2)
-
-            self.client.table('accounts').update({
-                'storage_used_bytes': used_bytes,
-                'storage_limit_bytes': limit_bytes,
-                'storage_percent': percent,
-                'updated_at': datetime.now(timezone.utc).isoformat()
-            }).eq('id', account_id).execute()
-            
-            print(f"📊 Storage Synced for Account {account_id}: {percent}% Full")
-            
-        except Exception as e:
-            print(f"❌ DB Error (update_storage_stats): {e}")
+        self.writes.flush()
+        # Avoid division by zero
+        percent = 0.0
+        if limit_bytes > 0:
+            percent = round((used_bytes / limit_bytes) * 100, 2)
 
+        self.client.table('accounts').update({
+            'storage_used_bytes': used_bytes,
+            'storage_limit_bytes': limit_bytes,
+            'storage_percent': percent,
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        }).eq('id', account_id).execute()
+        
+        print(f"📊 Storage Synced for Account {account_id}: {percent}% Full")
+
+    @db_call(default=False)
     def sync_account_stats(self, account_id: int, download_usage: int, storage_used: int, storage_limit: int):
         """
         Syncs both download quota AND storage stats in one DB call.
+        Queued write-behind - repeated syncs of an account coalesce.
         """
-        try:
-            percent = 0.0
-            if storage_limit > 0:
-                percent = round((storage_used / storage_limit) * 100, 2)
-
-            self.client.table('accounts').update({
-                'quota_used': download_usage,
-                'storage_used_bytes': storage_used,
-                'storage_limit_bytes': storage_limit,
-                'storage_percent': percent,
-                'last_used_at': datetime.now(timezone.utc).isoformat(),
-                'updated_at': datetime.now(timezone.utc).isoformat()
-            }).eq('id', account_id).execute()
-            
-            print(f"✅ Synced ALL stats for Account {account_id}: Q={download_usage}, S={percent}%")
-            return True
-            
-        except Exception as e:
-            print(f"❌ DB Error (sync_account_stats): {e}")
-            return False
+        percent = 0.0
+        if storage_limit > 0:
+            percent = round((storage_used / storage_limit) * 100, 2)
+
+        now = datetime.now(timezone.utc).isoformat()
+        self.writes.update('accounts', 'id', account_id, fields={
+            'quota_used': download_usage,
+            'storage_used_bytes': storage_used,
+            'storage_limit_bytes': storage_limit,
+            'storage_percent': percent,
+            'last_used_at': now,
+            'updated_at': now
+        })
+        
+        print(f"✅ Queued ALL stats for Account {account_id}: Q={download_usage}, S={percent}%")
+        return True
 
     # ============================================
     # GOFILE UPLOAD METHODS
     # ============================================
 
+    @db_call()
     def add_gofile_upload(self, data: Dict) -> Optional[Dict]:
         """
         Insert a new Gofile upload record.
@@ -182,114 +758,175 @@ class SupabaseDB:
         Optional: folder_id, folder_code, file_name, file_size, 
                   movie_name, quality, direct_link, pikpak_file_id
         """
-        try:
-            response = self.client.table('gofile_uploads').insert({
-                'file_id': data['file_id'],
-                'server': data['server'],
-                'folder_id': data.get('folder_id'),
-                'folder_code': data.get('folder_code'),
-                'file_name': data.get('file_name'),
-                'file_size': data.get('file_size'),
-                'movie_name': data.get('movie_name'),
-                'quality': data.get('quality'),
-                'direct_link': data.get('direct_link'),
-                'pikpak_file_id': data.get('pikpak_file_id')
-            }).execute()
-            
-            print(f"✅ Gofile recorded: {data.get('file_name', data['file_id'])}")
-            return response.data[0] if response.data else None
-            
-        except Exception as e:
-            print(f"❌ DB Error (add_gofile_upload): {e}")
-            return None
+        response = self.client.table('gofile_uploads').insert({
+            'file_id': data['file_id'],
+            'server': data['server'],
+            'folder_id': data.get('folder_id'),
+            'folder_code': data.get('folder_code'),
+            'file_name': data.get('file_name'),
+            'file_size': data.get('file_size'),
+            'movie_name': data.get('movie_name'),
+            'quality': data.get('quality'),
+            'direct_link': data.get('direct_link'),
+            'pikpak_file_id': data.get('pikpak_file_id')
+        }).execute()
+        
+        print(f"✅ Gofile recorded: {data.get('file_name', data['file_id'])}")
+        return response.data[0] if response.data else None
 
-    def get_active_gofile_uploads(self) -> list:
+    @db_call(retry=True, default=[])
+    def get_active_gofile_uploads(self, columns: str = '*') -> list:
         """
-        Get all active Gofile uploads.
+        Get all active Gofile uploads, newest first, paged so the
+        keep-alive sweep sees every row however many there are.
+        
+        Args:
+            columns: Column projection (the keep-alive loop only needs a few)
         """
-        try:
-            response = self.client.table('gofile_uploads')\
-                .select('*')\
-                .eq('status', 'active')\
-                .order('created_at', desc=True)\
-                .execute()
-            
-            return response.data or []
-            
-        except Exception as e:
-            print(f"❌ DB Error (get_active_gofile_uploads): {e}")
-            return []
+        return list(self.iter_rows(
+            'gofile_uploads',
+            columns,
+            where=lambda q: q.eq('status', 'active'),
+            order=(('created_at', True), ('id', False))
+        ))
 
+    @db_call(default=False)
     def update_gofile_keep_alive(self, file_id: str, status: str = None, server: str = None) -> bool:
         """
         Update Gofile record: timestamp always updated, status/server optional.
+        Queued write-behind.
         
         Args:
             file_id: Gofile content ID
             status: Optional - 'active', 'expired', 'deleted'
             server: Optional - new server if migrated
         """
-        try:
-            update_data = {
-                'last_keep_alive': datetime.now(timezone.utc).isoformat()
-            }
-            
-            if status is not None:
-                update_data['status'] = status
-            
-            if server is not None:
-                update_data['server'] = server
-            
-            self.client.table('gofile_uploads')\
-                .update(update_data)\
-                .eq('file_id', file_id)\
-                .execute()
-            
-            print(f"🔄 Gofile updated: {file_id}")
-            return True
-            
-        except Exception as e:
-            print(f"❌ DB Error (update_gofile_keep_alive): {e}")
-            return False
+        update_data = {
+            'last_keep_alive': datetime.now(timezone.utc).isoformat()
+        }
+        
+        if status is not None:
+            update_data['status'] = status
+        
+        if server is not None:
+            update_data['server'] = server
+        
+        self.writes.update('gofile_uploads', 'file_id', file_id, fields=update_data)
+        
+        print(f"🔄 Gofile update queued: {file_id}")
+        return True
 
+    @db_call(default=False)
     def mark_gofile_upload_as_expired(self, file_id: str) -> bool:
         """
         Marks a Gofile upload as 'expired'.
         """
-        try:
-            self.client.table('gofile_uploads').update({
-                'status': 'expired',
-                'updated_at': datetime.now(timezone.utc).isoformat()
-            }).eq('file_id', file_id).execute()
-            
-            print(f"🔄 Gofile status set to EXPIRED for: {file_id}")
-            return True
-            
-        except Exception as e:
-            print(f"❌ DB Error (mark_gofile_upload_as_expired): {e}")
-            return False
+        self.writes.flush()
+        self.client.table('gofile_uploads').update({
+            'status': 'expired',
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        }).eq('file_id', file_id).execute()
+        
+        print(f"🔄 Gofile status set to EXPIRED for: {file_id}")
+        return True
 
+    @db_call(retry=True)
     def get_gofile_by_file_id(self, file_id: str) -> Optional[Dict]:
         """
         Get single Gofile record by file_id.
         """
-        try:
-            response = self.client.table('gofile_uploads')\
-                .select('*')\
-                .eq('file_id', file_id)\
-                .limit(1)\
-                .execute()
-            
-            return response.data[0] if response.data else None
-            
-        except Exception as e:
-            print(f"❌ DB Error (get_gofile_by_file_id): {e}")
-            return None
+        response = self.client.table('gofile_uploads')\
+            .select('*')\
+            .eq('file_id', file_id)\
+            .limit(1)\
+            .execute()
+        
+        return response.data[0] if response.data else None
+
+    # ============================================
+    # TELEGRAM FILE CACHE (re-post without re-upload)
+    # ============================================
+
+    @db_call(retry=True)
+    def get_telegram_file(self, content_key: str) -> Optional[Dict]:
+        """
+        Get the Telegram document previously uploaded for this content.
+        
+        Table:
+            CREATE TABLE telegram_files (
+                id BIGSERIAL PRIMARY KEY,
+                content_key TEXT UNIQUE NOT NULL,
+                magnet_hash TEXT,
+                file_name TEXT,
+                file_size BIGINT,
+                tg_file_id TEXT NOT NULL,
+                chat_id BIGINT,
+                message_id BIGINT,
+                reposts INTEGER DEFAULT 0,
+                created_at TIMESTAMPTZ DEFAULT NOW(),
+                updated_at TIMESTAMPTZ DEFAULT NOW()
+            );
+        
+        Args:
+            content_key: 'btih:<HASH>:<file name>:<size>' or 'name:<file name>:<size>'
+        """
+        # Apply queued writes first so a just-finished upload is visible
+        self.writes.flush()
+        response = self.client.table('telegram_files')\
+            .select('*')\
+            .eq('content_key', content_key)\
+            .limit(1)\
+            .execute()
+        
+        return response.data[0] if response.data else None
+
+    @db_call(default=False)
+    def save_telegram_file(self, data: Dict) -> bool:
+        """
+        Record (or refresh) the Telegram document for a content key.
+        Queued write-behind.
+        
+        Required in data: content_key, tg_file_id
+        Optional: magnet_hash, file_name, file_size, chat_id, message_id
+        """
+        row = {
+            'content_key': data['content_key'],
+            'magnet_hash': data.get('magnet_hash'),
+            'file_name': data.get('file_name'),
+            'file_size': data.get('file_size'),
+            'tg_file_id': data['tg_file_id'],
+            'chat_id': data.get('chat_id'),
+            'message_id': data.get('message_id'),
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        }
+        self.writes.upsert('telegram_files', row, on_conflict='content_key')
+        return True
+
+    @db_call(default=False)
+    def record_telegram_repost(self, content_key: str) -> bool:
+        """Count a re-post served from the cache. Queued write-behind."""
+        self.writes.update(
+            'telegram_files', 'content_key', content_key,
+            fields={'updated_at': datetime.now(timezone.utc).isoformat()},
+            increments={'reposts': 1}
+        )
+        return True
+
+    @db_call(default=False)
+    def delete_telegram_file(self, content_key: str) -> bool:
+        """Forget a cached document Telegram no longer accepts"""
+        self.writes.flush()
+        self.client.table('telegram_files')\
+            .delete()\
+            .eq('content_key', content_key)\
+            .execute()
+        return True
 
     # ============================================
     # SMART CACHE METHODS (PikPak Deduplication)
     # ============================================
 
+    @db_call(retry=True)
     def check_smart_cache(self, magnet_hash: str) -> Optional[Dict]:
         """
         Check if file exists in any account's cache.
@@ -300,56 +937,78 @@ class SupabaseDB:
         Returns:
             Dict with account_id, file_id, file_name if found, else None
         """
-        try:
-            response = self.client.table('pikpak_files')\
-                .select('*')\
-                .eq('magnet_hash', magnet_hash)\
-                .eq('is_trash', False)\
-                .limit(1)\
-                .execute()
-            
-            if response.data and len(response.data) > 0:
-                print(f"✅ Smart Cache HIT: {response.data[0].get('file_name', 'Unknown')}")
-                return response.data[0]
-            
-            return None
+        response = self.client.table('pikpak_files')\
+            .select('*')\
+            .eq('magnet_hash', magnet_hash)\
+            .eq('is_trash', False)\
+            .limit(1)\
+            .execute()
+        
+        if response.data and len(response.data) > 0:
+            print(f"✅ Smart Cache HIT: {response.data[0].get('file_name', 'Unknown')}")
+            return response.data[0]
+        
+        return None
+
+    @db_call(retry=True, default=[])
+    def get_smart_cache_replicas(self, magnet_hash: str) -> List[Dict]:
+        """
+        Get every live (non-trashed) copy of a file across all accounts.
+        Saves still in the write-behind queue are overlaid, so a file saved
+        a moment ago is found without waiting for (or forcing) a flush.
+        
+        Args:
+            magnet_hash: The info_hash extracted from magnet link
             
-        except Exception as e:
-            print(f"❌ DB Error (check_smart_cache): {e}")
-            return None
+        Returns:
+            List of cache rows, empty if none
+        """
+        response = self.client.table('pikpak_files')\
+            .select('*')\
+            .eq('magnet_hash', magnet_hash)\
+            .eq('is_trash', False)\
+            .execute()
+        
+        rows = {(row['account_id'], row['file_id']): row for row in response.data or []}
+        for op in self.writes.pending_ops('pikpak_files'):
+            queued = op['fields']
+            if op['kind'] != 'upsert' or queued.get('magnet_hash') != magnet_hash:
+                continue
+            key = (queued['account_id'], queued['file_id'])
+            if queued.get('is_trash'):
+                rows.pop(key, None)
+            else:
+                rows[key] = {**rows.get(key, {}), **queued}
+        return list(rows.values())
 
+    @db_call()
     def save_to_smart_cache(self, data: Dict) -> Optional[Dict]:
         """
         Save file to smart cache after successful download.
-        Uses UPSERT to handle duplicates gracefully.
+        Uses UPSERT to handle duplicates gracefully. Queued write-behind
+        and batched with other saves; returns the record that will be written.
         
         Required in data: magnet_hash, file_id, account_id
         Optional: file_hash, file_name, file_size, parent_id
         """
-        try:
-            record = {
-                'magnet_hash': data['magnet_hash'],
-                'file_id': data['file_id'],
-                'account_id': data['account_id'],
-                'file_hash': data.get('file_hash'),
-                'file_name': data.get('file_name'),
-                'file_size': data.get('file_size'),
-                'parent_id': data.get('parent_id'),
-                'is_trash': False,
-                'updated_at': datetime.now(timezone.utc).isoformat()
-            }
-            
-            response = self.client.table('pikpak_files')\
-                .upsert(record, on_conflict='magnet_hash,account_id,file_id')\
-                .execute()
-            
-            print(f"💾 Smart Cache saved: {data.get('file_name', data['file_id'])}")
-            return response.data[0] if response.data else None
-            
-        except Exception as e:
-            print(f"❌ DB Error (save_to_smart_cache): {e}")
-            return None
+        record = {
+            'magnet_hash': data['magnet_hash'],
+            'file_id': data['file_id'],
+            'account_id': data['account_id'],
+            'file_hash': data.get('file_hash'),
+            'file_name': data.get('file_name'),
+            'file_size': data.get('file_size'),
+            'parent_id': data.get('parent_id'),
+            'is_trash': False,
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        }
+        
+        self.writes.upsert('pikpak_files', record, on_conflict='magnet_hash,account_id,file_id')
+        
+        print(f"💾 Smart Cache save queued: {data.get('file_name', data['file_id'])}")
+        return record
 
+    @db_call(default=False)
     def mark_cache_as_trash(self, account_id: int, file_ids: List[str]) -> bool:
         """
         Mark files as trashed (soft delete) in smart cache.
@@ -359,26 +1018,59 @@ class SupabaseDB:
             account_id: The account that had these files
             file_ids: List of PikPak file IDs to mark as trash
         """
+        self.writes.flush()
         if not file_ids:
             return True
             
-        try:
-            self.client.table('pikpak_files')\
-                .update({
-                    'is_trash': True,
-                    'updated_at': datetime.now(timezone.utc).isoformat()
-                })\
-                .eq('account_id', account_id)\
-                .in_('file_id', file_ids)\
-                .execute()
-            
-            print(f"🗑️ Smart Cache: Marked {len(file_ids)} files as trash for Account {account_id}")
-            return True
-            
-        except Exception as e:
-            print(f"❌ DB Error (mark_cache_as_trash): {e}")
-            return False
+        # Chunked so a big eviction doesn't overflow the request URL
+        self.update_rows_in(
+            'pikpak_files',
+            {'is_trash': True, 'updated_at': datetime.now(timezone.utc).isoformat()},
+            'file_id',
+            file_ids,
+            where=lambda q: q.eq('account_id', account_id)
+        )
+        
+        print(f"🗑️ Smart Cache: Marked {len(file_ids)} files as trash for Account {account_id}")
+        return True
+
+    @db_call(retry=True)
+    def get_active_magnet_hashes(self, page_size: int = None) -> Optional[List[str]]:
+        """
+        Get every non-trashed magnet_hash, paging through the table so
+        PostgREST's row limit never truncates the result.
+        Used to build the in-memory Bloom filter.
+        
+        Returns:
+            List of magnet_hash strings, or None if any page failed
+        """
+        rows = self.iter_rows(
+            'pikpak_files',
+            'magnet_hash',
+            where=lambda q: q.eq('is_trash', False),
+            page_size=page_size
+        )
+        return [row['magnet_hash'] for row in rows if row.get('magnet_hash')]
 
+    @db_call(retry=True)
+    def get_cache_rows_since(self, since: Optional[str] = None, page_size: int = None) -> Optional[List[Dict]]:
+        """
+        Get every cache row (trashed included) updated at or after `since`,
+        or the whole table when `since` is None. Used to keep the local
+        SQLite mirror in sync.
+        
+        Returns:
+            List of row dicts, or None if any page failed
+        """
+        return list(self.iter_rows(
+            'pikpak_files',
+            '*',
+            where=(lambda q: q.gte('updated_at', since)) if since else None,
+            order=(('updated_at', False), ('id', False)),
+            page_size=page_size
+        ))
+
+    @db_call(retry=True, default=[])
     def get_cached_files_by_account(self, account_id: int) -> List[str]:
         """
         Get all cached file_ids for an account.
@@ -390,19 +1082,71 @@ class SupabaseDB:
         Returns:
             List of file_id strings
         """
-        try:
-            response = self.client.table('pikpak_files')\
-                .select('file_id')\
-                .eq('account_id', account_id)\
-                .eq('is_trash', False)\
-                .execute()
+        rows = self.iter_rows(
+            'pikpak_files',
+            'file_id',
+            where=lambda q: q.eq('account_id', account_id).eq('is_trash', False)
+        )
+        return [row['file_id'] for row in rows]
+
+    @db_call(retry=True)
+    def get_cached_entries_by_account(self, account_id: int) -> Optional[List[Dict]]:
+        """
+        Get file_id, magnet_hash, file_name and file_size of every cached
+        (non-trashed) file for an account.
+        Lets sync reuse known hashes instead of re-fetching file details.
+        
+        Args:
+            account_id: The account to query
             
-            return [row['file_id'] for row in (response.data or [])]
+        Returns:
+            List of row dicts, or None on error
+        """
+        return list(self.iter_rows(
+            'pikpak_files',
+            'file_id,magnet_hash,file_name,file_size',
+            where=lambda q: q.eq('account_id', account_id).eq('is_trash', False)
+        ))
+
+    @db_call(default=0)
+    def rekey_cache_hashes(self, account_id: int, changes: List[tuple]) -> int:
+        """
+        Rewrite stored magnet_hash values to their canonical form.
+        If the canonical row already exists the legacy duplicate is deleted.
+        
+        Args:
+            account_id: Account the rows belong to
+            changes: List of (file_id, old_hash, new_hash)
             
-        except Exception as e:
-            print(f"❌ DB Error (get_cached_files_by_account): {e}")
-            return []
+        Returns:
+            Number of rows rewritten or removed
+        """
+        count = 0
+        for file_id, old_hash, new_hash in changes:
+            match = {'account_id': account_id, 'file_id': file_id, 'magnet_hash': old_hash}
+            try:
+                try:
+                    self.client.table('pikpak_files')\
+                        .update({
+                            'magnet_hash': new_hash,
+                            'updated_at': datetime.now(timezone.utc).isoformat()
+                        })\
+                        .match(match)\
+                        .execute()
+                except APIError as e:
+                    if getattr(e, 'code', None) != PG_UNIQUE_VIOLATION:
+                        raise
+                    # Unique key clash: the canonical row is already there
+                    self.client.table('pikpak_files')\
+                        .delete()\
+                        .match(match)\
+                        .execute()
+                count += 1
+            except Exception as e:
+                print(f"❌ DB Error (rekey_cache_hashes): {e}")
+        return count
 
+    @db_call(default=False)
     def bulk_upsert_cache(self, files: List[Dict]) -> bool:
         """
         Bulk upsert multiple files at once.
@@ -411,55 +1155,164 @@ class SupabaseDB:
         Args:
             files: List of dicts with magnet_hash, file_id, account_id, etc.
         """
+        self.writes.flush()
         if not files:
             return True
             
+        # Add timestamp to all records
+        for f in files:
+            f['updated_at'] = datetime.now(timezone.utc).isoformat()
+            if 'is_trash' not in f:
+                f['is_trash'] = False
+        
+        self.upsert_rows('pikpak_files', files, on_conflict='magnet_hash,account_id,file_id')
+        
+        print(f"💾 Smart Cache: Bulk upserted {len(files)} files")
+        return True
+
+    @db_call(default=False)
+    def record_cache_hits(self, hits: List[Dict]) -> bool:
+        """
+        Add batched hit counts to smart cache rows.
+        
+        The increment happens in the database, so servers flushing hits
+        for the same row at the same time don't overwrite each other.
+        updated_at is bumped so the local mirror's incremental pull picks
+        up the new counts.
+        Uses the record_cache_hits() SQL function:
+        
+            create or replace function record_cache_hits(hits jsonb)
+            returns void language sql as $$
+                update pikpak_files f
+                set hit_count = coalesce(f.hit_count, 0) + (h->>'hits')::int,
+                    last_hit_at = greatest(f.last_hit_at, (h->>'last_hit_at')::timestamptz),
+                    updated_at = now()
+                from jsonb_array_elements(hits) h
+                where f.magnet_hash = h->>'magnet_hash'
+                  and f.account_id = (h->>'account_id')::int
+                  and f.file_id = h->>'file_id'
+            $$;
+        
+        Args:
+            hits: List of dicts with magnet_hash, account_id, file_id,
+                  hits (count to add) and last_hit_at (ISO timestamp)
+        """
+        if not hits:
+            return True
+        
         try:
-            # Add timestamp to all records
-            for f in files:
-                f['updated_at'] = datetime.now(timezone.utc).isoformat()
-                if 'is_trash' not in f:
-                    f['is_trash'] = False
-            
-            self.client.table('pikpak_files')\
-                .upsert(files, on_conflict='magnet_hash,account_id,file_id')\
-                .execute()
-            
-            print(f"💾 Smart Cache: Bulk upserted {len(files)} files")
+            self.client.rpc('record_cache_hits', {'hits': hits}).execute()
             return True
-            
-        except Exception as e:
-            print(f"❌ DB Error (bulk_upsert_cache): {e}")
-            return False
+        except APIError as e:
+            if not is_missing_function(e):
+                raise
+            print("⚠️ DB: record_cache_hits() function missing, falling back to read-then-write (not atomic)")
+        
+        # Read current counts so we can add to them
+        rows = self.iter_rows_in(
+            'pikpak_files',
+            'file_id',
+            (h['file_id'] for h in hits),
+            columns='magnet_hash,account_id,file_id,hit_count'
+        )
+        current = {
+            (row['magnet_hash'], row['account_id'], row['file_id']): row.get('hit_count') or 0
+            for row in rows
+        }
+        
+        # Only update rows that still exist - never insert partial rows
+        now = datetime.now(timezone.utc).isoformat()
+        updates = []
+        for h in hits:
+            key = (h['magnet_hash'], h['account_id'], h['file_id'])
+            if key in current:
+                updates.append({
+                    'magnet_hash': h['magnet_hash'],
+                    'account_id': h['account_id'],
+                    'file_id': h['file_id'],
+                    'hit_count': current[key] + h['hits'],
+                    'last_hit_at': h['last_hit_at'],
+                    'updated_at': now
+                })
+        
+        if updates:
+            self.upsert_rows('pikpak_files', updates, on_conflict='magnet_hash,account_id,file_id')
+        
+        return True
 
+    @db_call(retry=True)
+    def get_cache_entries_for_eviction(self, account_id: int) -> Optional[List[Dict]]:
+        """
+        Get the cached files of an account with their size and popularity.
+        Used by the eviction planner.
+        
+        Returns:
+            List of row dicts, or None on error
+        """
+        return list(self.iter_rows(
+            'pikpak_files',
+            'magnet_hash,file_id,file_name,file_size,hit_count,last_hit_at,updated_at',
+            where=lambda q: q.eq('account_id', account_id).eq('is_trash', False)
+        ))
+
+    @db_call(retry=True)
+    def get_popular_magnet_hashes(self, limit: int) -> Optional[Dict[str, int]]:
+        """
+        Get hit counts for the most requested cache entries.
+        
+        Returns:
+            Dict of magnet_hash -> total hit_count (over its top rows), or None on error
+        """
+        response = self.client.table('pikpak_files')\
+            .select('magnet_hash,hit_count')\
+            .eq('is_trash', False)\
+            .gt('hit_count', 0)\
+            .order('hit_count', desc=True)\
+            .limit(limit)\
+            .execute()
+        
+        counts = {}
+        for row in response.data or []:
+            counts[row['magnet_hash']] = counts.get(row['magnet_hash'], 0) + (row.get('hit_count') or 0)
+        return counts
+
+    @db_call(retry=True, default={'active_files': 0, 'trashed_files': 0, 'total_files': 0, 'total_size_bytes': 0, 'total_hits': 0, 'per_account': {}})
     def get_smart_cache_stats(self) -> Dict:
         """
-        Get statistics about the smart cache.
+        Get statistics about the smart cache in one round trip.
         Useful for admin dashboard.
+        
+        Uses the smart_cache_stats() SQL function:
+        
+            create or replace function smart_cache_stats()
+            returns table(account_id int, is_trash boolean, files bigint, size_bytes bigint, hits bigint)
+            language sql stable as $$
+                select account_id, is_trash, count(*),
+                       coalesce(sum(file_size), 0), coalesce(sum(hit_count), 0)
+                from pikpak_files group by account_id, is_trash
+            $$;
+        
+        Without the function it falls back to paging through pikpak_files
+        and grouping here (one request per page instead of one in total).
         """
         try:
-            # Total cached files
-            total = self.client.table('pikpak_files')\
-                .select('id', count='exact')\
-                .eq('is_trash', False)\
-                .execute()
-            
-            # Trashed files
-            trashed = self.client.table('pikpak_files')\
-                .select('id', count='exact')\
-                .eq('is_trash', True)\
-                .execute()
-            
-            return {
-                'active_files': total.count or 0,
-                'trashed_files': trashed.count or 0,
-                'total_files': (total.count or 0) + (trashed.count or 0)
-            }
-            
-        except Exception as e:
-            print(f"❌ DB Error (get_smart_cache_stats): {e}")
-            return {'active_files': 0, 'trashed_files': 0, 'total_files': 0}
+            response = self.client.rpc('smart_cache_stats', {}).execute()
+            return summarize_cache_groups(response.data or [])
+        except APIError as e:
+            if not is_missing_function(e):
+                raise
+            print("⚠️ DB: smart_cache_stats() function missing, aggregating pikpak_files client-side")
+        
+        groups = {}
+        for row in self.iter_rows('pikpak_files', 'account_id,is_trash,file_size,hit_count'):
+            key = (row.get('account_id'), bool(row.get('is_trash')))
+            group = groups.setdefault(key, {'account_id': key[0], 'is_trash': key[1], 'files': 0, 'size_bytes': 0, 'hits': 0})
+            group['files'] += 1
+            group['size_bytes'] += row.get('file_size') or 0
+            group['hits'] += row.get('hit_count') or 0
+        return summarize_cache_groups(list(groups.values()))
 
+    @db_call(default=0)
     def clear_trash_from_cache(self, account_id: int = None) -> int:
         """
         Permanently delete trashed entries from cache.
@@ -470,23 +1323,19 @@ class SupabaseDB:
         Returns:
             Number of records deleted
         """
-        try:
-            query = self.client.table('pikpak_files')\
-                .delete()\
-                .eq('is_trash', True)
-            
-            if account_id:
-                query = query.eq('account_id', account_id)
-            
-            response = query.execute()
-            count = len(response.data) if response.data else 0
-            
-            print(f"🧹 Smart Cache: Permanently deleted {count} trashed entries")
-            return count
-            
-        except Exception as e:
-            print(f"❌ DB Error (clear_trash_from_cache): {e}")
-            return 0
+        self.writes.flush()
+        query = self.client.table('pikpak_files')\
+            .delete()\
+            .eq('is_trash', True)
+        
+        if account_id:
+            query = query.eq('account_id', account_id)
+        
+        response = query.execute()
+        count = len(response.data) if response.data else 0
+        
+        print(f"🧹 Smart Cache: Permanently deleted {count} trashed entries")
+        return count
 
 # Singleton instance
 db = SupabaseDB()
\ No newline at end of file
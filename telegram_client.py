@@ -0,0 +1,138 @@
+"""
+Long-lived pyrogram client shared by upload jobs and admin notifications.
+Started once on the worker's event loop instead of an `async with Client()`
+per job, health-checked before reuse and rebuilt when the connection dies.
+Callers pair acquire() with release(); the client is only stopped while
+nobody else is using it.
+"""
+
+import os
+import time
+import asyncio
+from typing import Optional, Dict, Callable
+from pyrogram import Client
+from pyrogram.errors import RPCError
+
+# ============================================
+# CONFIGURATION
+# ============================================
+
+# Re-verify an idle client with get_me() after this long
+TG_HEALTH_CHECK_INTERVAL = int(os.environ.get("TG_HEALTH_CHECK_INTERVAL", 60))  # seconds
+TG_HEALTH_CHECK_TIMEOUT = int(os.environ.get("TG_HEALTH_CHECK_TIMEOUT", 15))  # seconds
+
+# Failures that say something about the Telegram connection (source I/O errors don't)
+TELEGRAM_ERRORS = (RPCError, ConnectionError, TimeoutError, asyncio.TimeoutError)
+
+
+def is_telegram_error(error: BaseException) -> bool:
+    return isinstance(error, TELEGRAM_ERRORS)
+
+
+# ============================================
+# SHARED CLIENT
+# ============================================
+
+class SharedTelegramClient:
+    """
+    Owns one started pyrogram Client. get() hands it out on the calling
+    event loop; a client started on a loop that has since gone away
+    (worker thread restarted) is dropped and a new one started.
+    """
+
+    def __init__(self, factory: Callable[[], Client], health_interval: int = TG_HEALTH_CHECK_INTERVAL):
+        self._factory = factory
+        self.health_interval = health_interval
+        self._client: Optional[Client] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._checked_at = 0
+        self._in_use = 0
+        self.starts = 0
+        self.reconnects = 0
+        self.health_failures = 0
+        self.last_error = None
+
+    async def acquire(self) -> Client:
+        """Started, healthy client for the running loop; release() when done with it"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Old loop's client can't be awaited here - let it go
+            self._client = None
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._in_use = 0
+
+        async with self._lock:
+            if self._client is not None and not await self._healthy():
+                if self._in_use:
+                    # Stopping it would kill the uploads still running on it;
+                    # check again once they've let go
+                    print(f"⚠️ Telegram: Client in use by {self._in_use} upload(s), not restarting yet", flush=True)
+                    self._checked_at = 0
+                else:
+                    await self._stop_quietly()
+                    self.reconnects += 1
+
+            if self._client is None:
+                client = self._factory()
+                await client.start()
+                self._client = client
+                self._checked_at = time.time()
+                self.starts += 1
+                print(f"📡 Telegram: Client started (start #{self.starts})", flush=True)
+
+            self._in_use += 1
+            return self._client
+
+    def release(self):
+        self._in_use = max(0, self._in_use - 1)
+
+    def invalidate(self):
+        """Force a health check on the next acquire() (call after a failed Telegram request)"""
+        self._checked_at = 0
+
+    async def reset(self):
+        """Stop the client; the next acquire() starts a fresh one"""
+        if self._lock is None:
+            return
+        async with self._lock:
+            await self._stop_quietly()
+
+    async def _healthy(self) -> bool:
+        if not self._client.is_connected:
+            self.health_failures += 1
+            self.last_error = "disconnected"
+            return False
+        if time.time() - self._checked_at < self.health_interval:
+            return True
+        try:
+            await asyncio.wait_for(self._client.get_me(), TG_HEALTH_CHECK_TIMEOUT)
+            self._checked_at = time.time()
+            return True
+        except Exception as e:
+            self.health_failures += 1
+            self.last_error = str(e)
+            print(f"⚠️ Telegram: Health check failed, reconnecting: {e}", flush=True)
+            return False
+
+    async def _stop_quietly(self):
+        client, self._client = self._client, None
+        if client is None:
+            return
+        try:
+            if client.is_connected:
+                await client.stop()
+        except Exception as e:
+            print(f"⚠️ Telegram: Error stopping client: {e}", flush=True)
+
+    def stats(self) -> Dict:
+        return {
+            'connected': bool(self._client and self._client.is_connected),
+            'in_use': self._in_use,
+            'last_check_age_seconds': round(time.time() - self._checked_at, 1) if self._client and self._checked_at else None,
+            'starts': self.starts,
+            'reconnects': self.reconnects,
+            'health_failures': self.health_failures,
+            'last_error': self.last_error
+        }
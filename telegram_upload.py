@@ -0,0 +1,179 @@
+"""
+Resumable Telegram document uploads.
+Parts are sent with upload.saveBigFilePart / saveFilePart under a file_id
+that stays the same across retries. The parts Telegram has acknowledged
+are recorded, so after a dropped connection or FloodWait the upload
+continues from the first missing part instead of from byte 0.
+"""
+
+import os
+import math
+import asyncio
+from typing import Optional, Callable, Awaitable, Set
+from pyrogram import Client, raw, types, utils, enums
+from pyrogram.errors import FilePartMissing
+from upload_pool import run_blocking
+
+# ============================================
+# CONFIGURATION
+# ============================================
+
+TG_PART_SIZE = 512 * 1024  # Telegram's maximum part size
+TG_BIG_FILE_THRESHOLD = 10 * 1024 * 1024  # saveBigFilePart above this
+TG_PARALLEL_PARTS = int(os.environ.get("TG_PARALLEL_PARTS", 4))  # parts in flight per upload
+
+
+class ResumableUpload:
+    """
+    One document upload. Keep the instance across retries: upload_parts()
+    only sends parts that are not yet acknowledged, and send() re-opens the
+    gap if Telegram reports a part missing.
+    """
+
+    def __init__(self, client: Client, file_size: int, file_name: str, part_size: int = TG_PART_SIZE):
+        self.file_id = client.rnd_id()
+        self.file_size = file_size
+        self.file_name = file_name
+        self.part_size = part_size
+        self.total_parts = max(1, math.ceil(file_size / part_size))
+        self.is_big = file_size > TG_BIG_FILE_THRESHOLD
+        self.acked: Set[int] = set()
+        self.attempts = 0
+
+    def restart(self):
+        """Forget acknowledged parts (source can't be resumed); same file_id, parts are re-sent"""
+        self.acked.clear()
+
+    @property
+    def first_missing(self) -> int:
+        """Index of the first part Telegram hasn't acknowledged (total_parts when complete)"""
+        for part in range(self.total_parts):
+            if part not in self.acked:
+                return part
+        return self.total_parts
+
+    @property
+    def resume_offset(self) -> int:
+        """Source byte offset to (re)open the stream at"""
+        return self.first_missing * self.part_size
+
+    @property
+    def acked_bytes(self) -> int:
+        if not self.acked:
+            return 0
+        last = self.total_parts - 1
+        size = len(self.acked) * self.part_size
+        if last in self.acked:
+            size -= self.total_parts * self.part_size - self.file_size
+        return size
+
+    @property
+    def complete(self) -> bool:
+        return len(self.acked) == self.total_parts
+
+    def _part_request(self, part: int, chunk: bytes):
+        if self.is_big:
+            return raw.functions.upload.SaveBigFilePart(
+                file_id=self.file_id,
+                file_part=part,
+                file_total_parts=self.total_parts,
+                bytes=chunk
+            )
+        return raw.functions.upload.SaveFilePart(file_id=self.file_id, file_part=part, bytes=chunk)
+
+    async def upload_parts(
+        self,
+        client: Client,
+        stream,
+        progress: Optional[Callable[[int, int], Awaitable[None]]] = None
+    ):
+        """
+        Send every unacknowledged part. `stream` must be positioned at
+        resume_offset. Raises the first part error after in-flight parts settle;
+        parts that did land stay acknowledged for the next attempt.
+        """
+        self.attempts += 1
+        window = asyncio.Semaphore(TG_PARALLEL_PARTS)
+        tasks = set()
+        errors = []
+
+        async def send_part(part: int, chunk: bytes):
+            try:
+                await client.invoke(self._part_request(part, chunk))
+                self.acked.add(part)
+                if progress:
+                    await progress(self.acked_bytes, self.file_size)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                window.release()
+
+        try:
+            for part in range(self.first_missing, self.total_parts):
+                await window.acquire()
+                if errors:
+                    window.release()
+                    break
+                # Blocking source read - off the loop so other uploads keep moving
+                chunk = await run_blocking(stream.read, self.part_size)
+                if not chunk:
+                    window.release()
+                    raise IOError(f"Source ended at part {part}/{self.total_parts}")
+                if part in self.acked:
+                    # Landed in an earlier attempt (later parts can finish before an earlier one fails)
+                    window.release()
+                    continue
+                task = asyncio.ensure_future(send_part(part, chunk))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        if errors:
+            raise errors[0]
+
+    def input_file(self):
+        if self.is_big:
+            return raw.types.InputFileBig(id=self.file_id, parts=self.total_parts, name=self.file_name)
+        return raw.types.InputFile(id=self.file_id, parts=self.total_parts, name=self.file_name, md5_checksum="")
+
+    async def send(
+        self,
+        client: Client,
+        chat_id: int,
+        caption: str = "",
+        parse_mode: enums.ParseMode = enums.ParseMode.HTML,
+        thumb: Optional[str] = None
+    ) -> "types.Message":
+        """
+        Post the uploaded parts as a document (what send_document does after
+        save_file). On FILE_PART_X_MISSING the part is un-acknowledged and the
+        error re-raised, so the next attempt re-sends just that part.
+        """
+        media = raw.types.InputMediaUploadedDocument(
+            mime_type=client.guess_mime_type(self.file_name) or "application/zip",
+            file=self.input_file(),
+            force_file=True,
+            thumb=await client.save_file(thumb) if thumb else None,
+            attributes=[raw.types.DocumentAttributeFilename(file_name=self.file_name)]
+        )
+        try:
+            r = await client.invoke(
+                raw.functions.messages.SendMedia(
+                    peer=await client.resolve_peer(chat_id),
+                    media=media,
+                    random_id=client.rnd_id(),
+                    **await utils.parse_text_entities(client, caption, parse_mode, None)
+                )
+            )
+        except FilePartMissing as e:
+            self.acked.discard(e.value)
+            raise
+
+        users = {u.id: u for u in r.users}
+        chats = {c.id: c for c in r.chats}
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await types.Message._parse(client, update.message, users, chats)
+        raise Exception("SendMedia returned no message")
@@ -0,0 +1,250 @@
+"""
+Concurrent upload workers on one asyncio loop.
+Jobs come off the shared JOB_QUEUE. Each worker takes the oldest job whose
+destination chat is under its concurrency cap. All uploads share one
+bandwidth ceiling, so a 2 GB upload no longer blocks every small job
+queued behind it.
+"""
+
+import os
+import time
+import queue
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Callable, Awaitable
+
+# ============================================
+# CONFIGURATION
+# ============================================
+
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 3))
+UPLOAD_PER_CHAT_LIMIT = int(os.environ.get("UPLOAD_PER_CHAT_LIMIT", 1))
+UPLOAD_BANDWIDTH_LIMIT_MBPS = float(os.environ.get("UPLOAD_BANDWIDTH_LIMIT_MBPS", 0))  # 0 = unlimited
+UPLOAD_SUPERVISE_INTERVAL = 5  # seconds
+UPLOAD_IO_THREADS = int(os.environ.get("UPLOAD_IO_THREADS", UPLOAD_WORKERS * 2 + 2))
+
+# Blocking source I/O (HEAD, GET, stream reads, DB lookups) runs here,
+# never on the upload loop: one stalled source must not freeze the other
+# workers or the shared Telegram client's keepalive.
+_io_executor = ThreadPoolExecutor(max_workers=UPLOAD_IO_THREADS, thread_name_prefix="upload-io")
+
+
+async def run_blocking(func, *args):
+    """Await a blocking call on the upload I/O threads"""
+    return await asyncio.get_running_loop().run_in_executor(_io_executor, func, *args)
+
+
+# ============================================
+# BANDWIDTH LIMITER
+# ============================================
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by every upload on the loop. consume() sleeps just
+    long enough to keep the combined rate under `rate_mbps`.
+    """
+
+    def __init__(self, rate_mbps: float = UPLOAD_BANDWIDTH_LIMIT_MBPS):
+        self.rate = rate_mbps * 1024 * 1024  # bytes/s
+        self._next_free = 0.0
+        self.bytes_sent = 0
+        self.throttled_seconds = 0.0
+
+    async def consume(self, nbytes: int):
+        self.bytes_sent += nbytes
+        if self.rate <= 0 or nbytes <= 0:
+            return
+        now = time.monotonic()
+        start = max(now, self._next_free)
+        self._next_free = start + nbytes / self.rate
+        delay = start - now
+        if delay > 0:
+            self.throttled_seconds += delay
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict:
+        return {
+            'limit_mbps': self.rate / (1024 * 1024) if self.rate else None,
+            'bytes_sent': self.bytes_sent,
+            'throttled_seconds': round(self.throttled_seconds, 1)
+        }
+
+
+# ============================================
+# WORKER POOL
+# ============================================
+
+class UploadPool:
+    """
+    One daemon thread running an event loop with `workers` upload coroutines.
+    handler(job_id, data) is awaited for every job and must handle its own errors;
+    anything it raises is logged and the worker carries on.
+    
+    The per-chat cap applies per chat_key(data). The default is the raw
+    'chat_id' target string; pass a chat_key that maps '@name' and numeric
+    ids of one chat to the same key to cap them together.
+    """
+
+    def __init__(
+        self,
+        job_queue: queue.Queue,
+        handler: Callable[[str, Dict], Awaitable[None]],
+        workers: int = UPLOAD_WORKERS,
+        per_chat_limit: int = UPLOAD_PER_CHAT_LIMIT,
+        bandwidth: BandwidthLimiter = None,
+        name: str = "upload",
+        chat_key: Callable[[Dict], str] = None
+    ):
+        self.job_queue = job_queue
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.per_chat_limit = max(1, per_chat_limit)
+        self.bandwidth = bandwidth or BandwidthLimiter()
+        self.name = name
+        self.chat_key = chat_key or self.target_key
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._pending = deque()
+        self._active: Dict[str, int] = {}
+        self._changed: Optional[asyncio.Condition] = None
+        self.completed = 0
+        self.crashed = 0
+        self.restarts = 0
+
+    # ---------- Thread side ----------
+
+    def ensure_running(self):
+        """Start the pool thread if it isn't running (called from request handlers)"""
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is not None:
+                    self.restarts += 1
+                print(f"SYSTEM: Starting {self.workers} {self.name} workers...", flush=True)
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            elif self._loop is not None and self.alive_workers() < self.workers:
+                self._loop.call_soon_threadsafe(self._spawn_missing)
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def alive_workers(self) -> int:
+        return sum(1 for task in list(self._tasks.values()) if not task.done())
+
+    def queued(self) -> int:
+        """Jobs waiting for a worker (shared queue + picked up but held by chat caps)"""
+        return self.job_queue.qsize() + len(self._pending)
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        try:
+            loop.run_until_complete(self._main())
+        finally:
+            self._loop = None
+
+    # ---------- Loop side ----------
+
+    async def _main(self):
+        self._changed = asyncio.Condition()
+        self._requeue_pending()
+        self._active.clear()
+        self._tasks.clear()
+        self._spawn_missing()
+        feeder = asyncio.ensure_future(self._feed())
+        while True:
+            await asyncio.sleep(UPLOAD_SUPERVISE_INTERVAL)
+            if feeder.done():
+                print(f"❌ {self.name} pool: Feeder stopped ({feeder.exception()}), restarting", flush=True)
+                feeder = asyncio.ensure_future(self._feed())
+            self._spawn_missing()
+
+    def _requeue_pending(self):
+        """Hand jobs a previous loop took off the queue but never started back to the queue"""
+        if not self._pending:
+            return
+        print(f"⚠️ {self.name} pool: Re-queueing {len(self._pending)} jobs from the stopped loop", flush=True)
+        while self._pending:
+            self.job_queue.put(self._pending.popleft())
+            self.job_queue.task_done()  # the put() above re-counts it
+
+    def _spawn_missing(self):
+        for index in range(self.workers):
+            task = self._tasks.get(index)
+            if task is None or task.done():
+                if task is not None:
+                    self.crashed += 1
+                    print(f"⚠️ {self.name} pool: Worker {index} died, respawning", flush=True)
+                self._tasks[index] = asyncio.ensure_future(self._worker(index))
+
+    def _get_job(self):
+        try:
+            return self.job_queue.get(timeout=1)
+        except queue.Empty:
+            return None
+
+    async def _feed(self):
+        """Move jobs from the thread-safe queue into the loop's pending list"""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await loop.run_in_executor(None, self._get_job)
+            if item is None:
+                continue
+            async with self._changed:
+                self._pending.append(item)
+                self._changed.notify_all()
+
+    @staticmethod
+    def target_key(data: Dict) -> str:
+        return str(data.get('chat_id', '')).strip()
+
+    def _take_runnable(self):
+        """Oldest pending job whose chat is under its cap, or None"""
+        for item in self._pending:
+            if self._active.get(self.chat_key(item[1]), 0) < self.per_chat_limit:
+                self._pending.remove(item)
+                return item
+        return None
+
+    async def _worker(self, index: int):
+        while True:
+            async with self._changed:
+                item = self._take_runnable()
+                while item is None:
+                    await self._changed.wait()
+                    item = self._take_runnable()
+                chat = self.chat_key(item[1])
+                self._active[chat] = self._active.get(chat, 0) + 1
+
+            job_id, data = item
+            try:
+                await self.handler(job_id, data)
+            except Exception as e:
+                print(f"❌ {self.name} pool: Worker {index} job {job_id} error: {e}", flush=True)
+            finally:
+                self.completed += 1
+                self.job_queue.task_done()
+                async with self._changed:
+                    self._active[chat] -= 1
+                    if not self._active[chat]:
+                        del self._active[chat]
+                    self._changed.notify_all()
+
+    def stats(self) -> Dict:
+        return {
+            'alive': self.is_alive(),
+            'workers': self.workers,
+            'alive_workers': self.alive_workers(),
+            'per_chat_limit': self.per_chat_limit,
+            'queued': self.queued(),
+            'active_by_chat': dict(self._active),
+            'completed': self.completed,
+            'crashed_workers': self.crashed,
+            'thread_restarts': self.restarts,
+            'bandwidth': self.bandwidth.stats()
+        }